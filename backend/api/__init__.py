@@ -1,30 +1,74 @@
+import time
 import importlib
 from fastapi import APIRouter
 from pathlib import Path
 
+from ..utils import Utils
+from ..utils.capabilities import Capabilities
+from ..utils.logger import Logger
+
 router = APIRouter() # Use default FastAPI router here incase some routes have customized routers
 
+logger = Logger.get("api")
+
+# Import time in seconds of every mounted endpoint module, filled when STARTUP_PROFILE is enabled.
+import_times = {}
+
 def mount_api_routes(directory: str, package_name: str) -> None:
     """
     Recursively mounts api routes from all Python files in the specified directory and its subdirectories.
 
+    Endpoint files are expected to be cheap to import, heavy libraries (torch, diffusers, gpt4all, etc.)
+    should be declared with Utils.LazyImport and models loaded on first use rather than at import time.
+
+    Endpoint files can declare `requirements = Capabilities.Requirements(...)`, their router is only
+    mounted if this node's capability manifest satisfies those requirements.
+
     :param directory: The directory to search for router files.
     :param package_name: The name of the package where the routers are located.
     """
     # Utilizing pathlib for more readable and reliable path handling
     directory_path = Path(directory)
 
-    for item in directory_path.iterdir():
+    for item in sorted(directory_path.iterdir()):
         if item.is_dir():
+            if item.name == "__pycache__":
+                continue
             # Recursive call to handle subdirectories
             mount_api_routes(str(item), f"{package_name}.{item.name}")
         elif item.suffix == '.py' and item.name != '__init__.py':
             # Importing module and including router if exists
             module_name = item.stem  # Getting filename without extension using pathlib
+            start = time.perf_counter()
             module = importlib.import_module(f'.{module_name}', package=package_name)
+            if Utils.startup_profile:
+                import_times[f"{package_name}.{module_name}"] = time.perf_counter() - start
 
             # Including router from module if it has one
             if hasattr(module, 'router'):
+                requirements = getattr(module, 'requirements', None)
+                if requirements is not None:
+                    missing = Capabilities.get_manifest().missing(requirements)
+                    if missing:
+                        logger.info(
+                            "Not mounting %s.%s, node is missing: %s", package_name, module_name, ", ".join(missing)
+                        )
+                        continue
                 router.include_router(module.router)
 
+
+def report_import_times() -> None:
+    """
+    Prints the import time of each mounted endpoint module, slowest first. Only has data when the
+    STARTUP_PROFILE env var is enabled.
+    """
+    total = sum(import_times.values())
+    logger.info("Mounted %d api modules in %.3fs", len(import_times), total)
+    for module_name, seconds in sorted(import_times.items(), key=lambda item: item[1], reverse=True):
+        logger.info("  %8.3fs  %s", seconds, module_name)
+
+
 mount_api_routes(str(Path(__file__).parent.absolute()), __name__)
+
+if Utils.startup_profile:
+    report_import_times()
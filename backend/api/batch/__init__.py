@@ -0,0 +1,491 @@
+"""
+Batch inference jobs, an OpenAI compatible batch api for offline workloads like evaluation sets.
+
+A job is a JSONL upload where every line is a chat completion request:
+    {"custom_id": "q1", "method": "POST", "url": "/v1/chat/completions",
+     "body": {"model": "...", "messages": [...], "max_tokens": 200, "temperature": 0}}
+
+Jobs and their requests are stored in Mongo so that progress survives restarts. A pool of background
+workers per process claims pending requests, runs them and writes their results back, clients poll the
+job or stream its results as they are completed instead of holding a connection open per request.
+"""
+
+import os
+import time
+import uuid
+import asyncio
+from pydantic import BaseModel, Field, validator
+from typing import Any, Container, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from pymongo import UpdateOne
+
+from ...utils.capabilities import Capabilities
+from ...utils.logger import Logger
+from ...utils.mongo import MongoDBManager
+
+logger = Logger.get("batch")
+
+batches_collection = "batch_jobs"
+batch_requests_collection = "batch_requests"
+
+max_requests = int(os.getenv("BATCH_MAX_REQUESTS", 50000))
+# Requests claimed by a worker at once, results are written back in one round trip per claim
+claim_size = int(os.getenv("BATCH_CLAIM_SIZE", 8))
+# Seconds after which a request claimed by a worker that stopped (e.g. a restart) is claimed again,
+# a running worker renews its claim every time it finishes one of the requests. Followed outputs also
+# read the results of the last lease again, in case one committed after a newer one
+lease_seconds = int(os.getenv("BATCH_LEASE_SECONDS", 600))
+poll_interval = float(os.getenv("BATCH_POLL_INTERVAL", 2))
+
+requirements = Capabilities.Requirements(inference=True, libraries=["gpt4all"])
+
+
+class Batch:
+    class Message(BaseModel):
+        role: str = Field(..., regex="^(system|user|assistant)$")
+        content: str
+
+    class ChatCompletionBody(BaseModel):
+        model: Optional[str] = None
+        messages: List["Batch.Message"]
+        max_tokens: int = Field(1000, gt=0, le=4096)
+        temperature: float = Field(0.7, ge=0, le=2)
+
+        @validator("messages")
+        def validate_messages(cls, v: List["Batch.Message"]) -> List["Batch.Message"]:
+            if not v:
+                raise ValueError("At least one message is required")
+            return v
+
+        @validator("model")
+        def validate_model(cls, v: Optional[str]) -> Optional[str]:
+            if v is not None and (os.path.basename(v) != v or v.startswith(".")):
+                raise ValueError("Model must be the file name of a model")
+            return v
+
+    class RequestLine(BaseModel):
+        custom_id: str = Field(..., min_length=1, max_length=256)
+        method: str = Field("POST", regex="^POST$")
+        url: str = Field("/v1/chat/completions", regex="^/v1/chat/completions$")
+        body: "Batch.ChatCompletionBody"
+
+    endpoint = "/v1/chat/completions"
+    # Statuses of a finished job, following the OpenAI batch object
+    final_statuses = ["completed", "failed", "cancelled", "expired"]
+
+
+Batch.ChatCompletionBody.update_forward_refs()
+Batch.RequestLine.update_forward_refs()
+
+
+class BatchUtils:
+    @staticmethod
+    def parse_lines(data: bytes) -> List[Batch.RequestLine]:
+        """
+        Parses and validates a JSONL upload.
+
+        Raises:
+        - ValueError: With the line number of the first invalid line.
+        """
+        lines = []
+        custom_ids = set()
+        for number, line in enumerate(data.decode("utf-8").splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                request_line = Batch.RequestLine.parse_raw(line)
+            except ValueError as e:
+                raise ValueError(f"Line {number} is invalid: {e}")
+            if request_line.custom_id in custom_ids:
+                raise ValueError(f"Line {number} reuses custom_id '{request_line.custom_id}'")
+            custom_ids.add(request_line.custom_id)
+            lines.append(request_line)
+            if len(lines) > max_requests:
+                raise ValueError(f"A batch can't have more than {max_requests} requests")
+        if not lines:
+            raise ValueError("The batch doesn't contain any requests")
+        return lines
+
+    @staticmethod
+    def to_public(document: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns a job document as an OpenAI batch object."""
+        return {
+            key: value
+            for key, value in document.items()
+            if key not in ("_id", "default_model")
+        }
+
+    @staticmethod
+    def result_line(document: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns a finished request document as a line of the OpenAI batch output file."""
+        return {
+            "id": document["id"],
+            "custom_id": document["custom_id"],
+            "response": document.get("response"),
+            "error": document.get("error"),
+        }
+
+
+class BatchMongo:
+    @staticmethod
+    async def create_indexes():
+        await MongoDBManager().create_index(batches_collection, [("id", 1)], unique=True)
+        await MongoDBManager().create_index(batch_requests_collection, [("id", 1)], unique=True)
+        # Claim order of pending requests and the results of a job in the order they finished
+        await MongoDBManager().create_index(
+            batch_requests_collection,
+            [("status", 1), ("batch_created_at", 1), ("model", 1), ("index", 1)],
+        )
+        await MongoDBManager().create_index(
+            batch_requests_collection, [("batch_id", 1), ("status", 1), ("finished_at", 1)]
+        )
+
+    @staticmethod
+    async def create_batch(
+        lines: List[Batch.RequestLine], default_model: str, metadata: Dict[str, str]
+    ) -> Dict[str, Any]:
+        now = int(time.time())
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": Batch.endpoint,
+            "status": "validating",
+            "default_model": default_model,
+            "created_at": now,
+            "in_progress_at": None,
+            "completed_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        await MongoDBManager().insert_document(batches_collection, dict(batch))
+
+        requests = []
+        for index, line in enumerate(lines):
+            model = line.body.model or default_model
+            requests.append(
+                {
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "batch_id": batch["id"],
+                    "batch_created_at": now,
+                    "index": index,
+                    "custom_id": line.custom_id,
+                    "model": model,
+                    "body": line.body.dict(),
+                    "status": "pending",
+                    "claimed_at": None,
+                    "finished_at": None,
+                    "response": None,
+                    "error": None,
+                }
+            )
+        # Large uploads are inserted in chunks to keep each insert under Mongo's message size limit
+        for start in range(0, len(requests), 1000):
+            await MongoDBManager().insert_documents(
+                batch_requests_collection, requests[start : start + 1000]
+            )
+
+        batch["status"] = "in_progress"
+        batch["in_progress_at"] = int(time.time())
+        await MongoDBManager().update_document(
+            batches_collection,
+            {"id": batch["id"]},
+            {"status": batch["status"], "in_progress_at": batch["in_progress_at"]},
+        )
+        return batch
+
+    @staticmethod
+    async def get_batch(batch_id: str) -> Optional[Dict[str, Any]]:
+        batches = await MongoDBManager().find_documents(batches_collection, {"id": batch_id}, limit=1)
+        return batches[0] if batches else None
+
+    @staticmethod
+    async def list_batches(limit: int) -> List[Dict[str, Any]]:
+        return await MongoDBManager().find_documents(
+            batches_collection, {}, sort=[("created_at", -1)], limit=limit
+        )
+
+    @staticmethod
+    async def cancel_batch(batch_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Cancels the pending requests of a job, requests already claimed by a worker finish first.
+        """
+        batch = await MongoDBManager().find_one_and_update(
+            batches_collection,
+            {"id": batch_id, "status": {"$in": ["validating", "in_progress"]}},
+            {"status": "cancelling"},
+        )
+        if batch is None:
+            return await BatchMongo.get_batch(batch_id)
+
+        await MongoDBManager().update_documents(
+            batch_requests_collection,
+            {"batch_id": batch_id, "status": "pending"},
+            {"status": "cancelled", "finished_at": time.time()},
+        )
+        return await BatchMongo.finalize_batch(batch_id) or batch
+
+    @staticmethod
+    async def claim_requests(worker_id: str) -> List[Dict[str, Any]]:
+        """
+        Atomically claims up to claim_size requests of the same model, pending ones or ones whose claim
+        expired. Requests are claimed oldest job first and grouped by model, so a worker keeps running
+        the model it already has loaded.
+        """
+        claimed = []
+        model = None
+        for _ in range(claim_size):
+            now = time.time()
+            query = {
+                "$or": [
+                    {"status": "pending"},
+                    {"status": "running", "claimed_at": {"$lt": now - lease_seconds}},
+                ]
+            }
+            if model is not None:
+                query["model"] = model
+            request = await MongoDBManager().find_one_and_update(
+                batch_requests_collection,
+                query,
+                {"status": "running", "claimed_at": now, "worker": worker_id},
+                sort=[("batch_created_at", 1), ("model", 1), ("index", 1)],
+            )
+            if request is None:
+                break
+            model = request["model"]
+            claimed.append(request)
+        return claimed
+
+    @staticmethod
+    async def renew_claims(worker_id: str, request_ids: List[str]) -> int:
+        """
+        Extends the lease of requests claimed by a worker so that a claim taking longer than
+        lease_seconds to run isn't taken over by another worker. Returns the number of claims renewed.
+        """
+        if not request_ids:
+            return 0
+        return await MongoDBManager().update_documents(
+            batch_requests_collection,
+            {"id": {"$in": request_ids}, "status": "running", "worker": worker_id},
+            {"claimed_at": time.time()},
+        )
+
+    @staticmethod
+    async def save_results(worker_id: str, results: List[Dict[str, Any]]) -> None:
+        """
+        Writes the results of claimed requests and updates the counters of their jobs, in one round trip
+        per collection.
+        """
+        now = time.time()
+        matched = await MongoDBManager().bulk_write(
+            batch_requests_collection,
+            [
+                UpdateOne(
+                    {"id": result["id"], "status": "running", "worker": worker_id},
+                    {
+                        "$set": {
+                            "status": "failed" if result["error"] else "completed",
+                            "response": result["response"],
+                            "error": result["error"],
+                            "finished_at": now,
+                        }
+                    },
+                )
+                for result in results
+            ],
+        )
+
+        counts: Dict[str, Dict[str, int]] = {}
+        for result in results:
+            batch_counts = counts.setdefault(result["batch_id"], {"completed": 0, "failed": 0})
+            batch_counts["failed" if result["error"] else "completed"] += 1
+
+        if matched == len(results):
+            operations = [
+                UpdateOne(
+                    {"id": batch_id},
+                    {"$inc": {f"request_counts.{name}": count for name, count in batch_counts.items()}},
+                )
+                for batch_id, batch_counts in counts.items()
+            ]
+        else:
+            # Some requests were claimed again by another worker after their lease expired, count
+            # the finished requests instead of double counting them.
+            operations = []
+            for batch_id in counts:
+                operations.append(
+                    UpdateOne(
+                        {"id": batch_id},
+                        {
+                            "$set": {
+                                f"request_counts.{status}": await MongoDBManager().count_documents(
+                                    batch_requests_collection, {"batch_id": batch_id, "status": status}
+                                )
+                                for status in ("completed", "failed")
+                            }
+                        },
+                    )
+                )
+        await MongoDBManager().bulk_write(batches_collection, operations)
+
+        for batch_id in counts:
+            await BatchMongo.finalize_batch(batch_id)
+
+    @staticmethod
+    async def finalize_batch(batch_id: str) -> Optional[Dict[str, Any]]:
+        """Marks a job completed or cancelled once none of its requests are left to run."""
+        remaining = await MongoDBManager().find_documents(
+            batch_requests_collection,
+            {"batch_id": batch_id, "status": {"$in": ["pending", "running"]}},
+            limit=1,
+        )
+        if remaining:
+            return None
+
+        now = int(time.time())
+        batch = await MongoDBManager().find_one_and_update(
+            batches_collection,
+            {"id": batch_id, "status": "cancelling"},
+            {"status": "cancelled", "cancelled_at": now},
+        )
+        if batch is None:
+            batch = await MongoDBManager().find_one_and_update(
+                batches_collection,
+                {"id": batch_id, "status": "in_progress"},
+                {"status": "completed", "completed_at": now},
+            )
+        return batch
+
+    @staticmethod
+    async def get_results(
+        batch_id: str, finished_after: float, exclude: Container[str] = ()
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns the finished requests of a job in the order they finished, except the ones whose id is in
+        exclude. Only the ids are read first so that results already sent aren't read again.
+        """
+        sort = [("finished_at", 1), ("index", 1)]
+        finished = await MongoDBManager().find_documents(
+            batch_requests_collection,
+            {
+                "batch_id": batch_id,
+                "status": {"$in": ["completed", "failed"]},
+                "finished_at": {"$gte": finished_after},
+            },
+            sort=sort,
+            projection={"id": 1, "_id": 0},
+        )
+        ids = [document["id"] for document in finished if document["id"] not in exclude]
+        if not ids:
+            return []
+        return await MongoDBManager().find_documents(
+            batch_requests_collection, {"id": {"$in": ids}}, sort=sort
+        )
+
+
+class BatchWorker:
+    """
+    Background workers running batch requests, one per model instance this node runs at once
+    (MAX_CONCURRENCY) so the hardware is kept busy while interactive requests still get served.
+    """
+
+    _tasks: List[asyncio.Task] = []
+    _wake = None  # asyncio.Event set when a job is submitted to this process
+
+    @staticmethod
+    def start():
+        if BatchWorker._tasks:
+            return
+        BatchWorker._wake = asyncio.Event()
+        for number in range(max(Capabilities.get_manifest().max_concurrency, 1)):
+            worker_id = f"{os.getpid()}-{number}"
+            BatchWorker._tasks.append(asyncio.create_task(BatchWorker.run(worker_id)))
+
+    @staticmethod
+    def wake():
+        if BatchWorker._wake is not None:
+            BatchWorker._wake.set()
+
+    @staticmethod
+    async def run(worker_id: str):
+        while True:
+            try:
+                requests = await BatchMongo.claim_requests(worker_id)
+                if not requests:
+                    BatchWorker._wake.clear()
+                    try:
+                        await asyncio.wait_for(BatchWorker._wake.wait(), timeout=poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                results = []
+                for request in requests:
+                    results.append(await BatchWorker.run_request(request))
+                    # Finished results are only written with the last one, keep the whole claim
+                    await BatchMongo.renew_claims(worker_id, [claimed["id"] for claimed in requests])
+                await BatchMongo.save_results(worker_id, results)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Batch worker %s failed: %s", worker_id, e)
+                await asyncio.sleep(poll_interval)
+
+    @staticmethod
+    async def run_request(request: Dict[str, Any]) -> Dict[str, Any]:
+        from ..distributed_inference.test_inference_request_endpoint import generate_text
+
+        body = Batch.ChatCompletionBody(**request["body"])
+        result = {"id": request["id"], "batch_id": request["batch_id"], "response": None, "error": None}
+        token_count = 0
+
+        def count_tokens(token_id: int, text: str) -> bool:
+            nonlocal token_count
+            token_count += 1
+            return True
+
+        try:
+            content = await run_in_threadpool(
+                generate_text,
+                request["model"],
+                [message.dict() for message in body.messages],
+                max_tokens=body.max_tokens,
+                temp=body.temperature,
+                callback=count_tokens,
+            )
+        except Exception as e:
+            result["error"] = {"code": "inference_failed", "message": str(e)}
+            return result
+
+        result["response"] = {
+            "status_code": 200,
+            "request_id": request["id"],
+            "body": {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "length" if token_count >= body.max_tokens else "stop",
+                    }
+                ],
+                "usage": {"completion_tokens": token_count},
+            },
+        }
+        return result
+
+
+class BatchTasks:
+    @staticmethod
+    async def startup():
+        """
+        Starts the batch workers if this node can run the batch models, requests left running by a
+        previous process are claimed again once their lease expires.
+        """
+        await BatchMongo.create_indexes()
+        if Capabilities.get_manifest().satisfies(requirements):
+            BatchWorker.start()
@@ -0,0 +1,55 @@
+# Streams the results of a batch job
+
+import json
+import asyncio
+from typing import AsyncIterator, Dict
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+
+from . import Batch, BatchMongo, BatchUtils, lease_seconds, poll_interval, requirements
+
+router = APIRouter()
+
+
+@router.get(
+    "/v1/batches/{batch_id}/output",
+    tags=["Batch Inference"],
+    summary="Get the results of a batch job",
+    description="Returns the results of the finished requests of a batch job as JSONL, with follow=true the response stays open and streams results until the job is done.",
+    response_class=StreamingResponse,
+)
+async def batch_output_endpoint(batch_id: str, follow: bool = False) -> StreamingResponse:
+    """
+    Each line is an OpenAI batch output line, results are in the order the requests finished:
+        {"id": "batch_req_...", "custom_id": "q1",
+         "response": {"status_code": 200, "request_id": "batch_req_...", "body": {"object": "chat.completion", ...}},
+         "error": null}
+    """
+    if await BatchMongo.get_batch(batch_id) is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    async def results() -> AsyncIterator[str]:
+        sent: Dict[str, float] = {}  # id -> finished_at of the results already sent
+        newest = 0.0
+        while True:
+            # Read the status first so that results finished before the job did aren't missed
+            batch = await BatchMongo.get_batch(batch_id)
+            # Workers stamp finished_at before their write commits, so a result stamped before the newest
+            # one read can still show up. Results of the last lease are read again, skipping the sent ones.
+            finished_after = max(newest - lease_seconds, 0.0)
+            for document in await BatchMongo.get_results(batch_id, finished_after, exclude=sent):
+                sent[document["id"]] = document["finished_at"]
+                newest = max(newest, document["finished_at"])
+                yield json.dumps(BatchUtils.result_line(document)) + "\n"
+
+            # Results older than the window can't be read again, no need to remember them
+            for result_id, finished_at in list(sent.items()):
+                if finished_at < finished_after:
+                    del sent[result_id]
+
+            if not follow or batch is None or batch["status"] in Batch.final_statuses:
+                return
+            await asyncio.sleep(poll_interval)
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
@@ -0,0 +1,63 @@
+# Accepts batch inference jobs as JSONL uploads
+
+import os
+import json
+from typing import Dict, Any, Optional
+
+from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+
+from . import BatchMongo, BatchUtils, BatchWorker, requirements
+from ..distributed_inference.test_inference_request_endpoint import model_name
+
+router = APIRouter()
+
+max_upload_bytes = int(os.getenv("BATCH_MAX_UPLOAD_MB", 100)) * 1024 * 1024
+
+
+@router.post(
+    "/v1/batches",
+    tags=["Batch Inference"],
+    summary="Create a batch job",
+    description="Accepts a JSONL file of chat completion requests and queues them as a batch job that is run in the background.",
+)
+async def create_batch_endpoint(
+    file: UploadFile = File(...),
+    metadata: Optional[str] = Form(None),
+) -> Dict[str, Any]:
+    """
+    Queues every line of the uploaded JSONL file as a request of a new batch job and returns the job,
+    poll it with GET /v1/batches/{batch_id} and fetch its results with GET /v1/batches/{batch_id}/output.
+
+    Each line is an OpenAI batch request line:
+        {"custom_id": "q1", "method": "POST", "url": "/v1/chat/completions",
+         "body": {"messages": [{"role": "user", "content": "Hi"}], "max_tokens": 200, "temperature": 0}}
+
+    Example response:
+        {
+            "id": "batch_6f0c...",
+            "object": "batch",
+            "endpoint": "/v1/chat/completions",
+            "status": "in_progress",
+            "created_at": 1718000000,
+            "in_progress_at": 1718000001,
+            "completed_at": null,
+            "cancelled_at": null,
+            "request_counts": {"total": 2, "completed": 0, "failed": 0},
+            "metadata": {}
+        }
+    """
+    data = await file.read(max_upload_bytes + 1)
+    if len(data) > max_upload_bytes:
+        raise HTTPException(status_code=413, detail="Batch file is too large")
+
+    try:
+        lines = BatchUtils.parse_lines(data)
+        parsed_metadata = json.loads(metadata) if metadata else {}
+        if not isinstance(parsed_metadata, dict):
+            raise ValueError("metadata must be a json object")
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    batch = await BatchMongo.create_batch(lines, default_model=model_name, metadata=parsed_metadata)
+    BatchWorker.wake()
+    return BatchUtils.to_public(batch)
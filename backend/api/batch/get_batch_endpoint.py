@@ -0,0 +1,49 @@
+# Batch job status
+
+from typing import Dict, Any
+
+from fastapi import APIRouter, HTTPException, Query
+
+from . import BatchMongo, BatchUtils, requirements
+
+router = APIRouter()
+
+
+@router.get(
+    "/v1/batches",
+    tags=["Batch Inference"],
+    summary="List batch jobs",
+    description="Returns the most recent batch jobs, newest first.",
+)
+async def list_batches_endpoint(limit: int = Query(20, ge=1, le=100)) -> Dict[str, Any]:
+    batches = await BatchMongo.list_batches(limit)
+    return {
+        "object": "list",
+        "data": [BatchUtils.to_public(batch) for batch in batches],
+    }
+
+
+@router.get(
+    "/v1/batches/{batch_id}",
+    tags=["Batch Inference"],
+    summary="Get a batch job",
+    description="Returns the status and request counts of a batch job.",
+)
+async def get_batch_endpoint(batch_id: str) -> Dict[str, Any]:
+    batch = await BatchMongo.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return BatchUtils.to_public(batch)
+
+
+@router.post(
+    "/v1/batches/{batch_id}/cancel",
+    tags=["Batch Inference"],
+    summary="Cancel a batch job",
+    description="Cancels the requests of a batch job that haven't started yet, results of finished requests are kept.",
+)
+async def cancel_batch_endpoint(batch_id: str) -> Dict[str, Any]:
+    batch = await BatchMongo.cancel_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return BatchUtils.to_public(batch)
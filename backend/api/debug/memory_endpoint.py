@@ -0,0 +1,40 @@
+from typing import Dict, Any
+
+from fastapi import APIRouter
+
+from ..distributed_inference.model_manager import ModelLoader
+
+router = APIRouter()
+
+
+@router.get(
+    "/debug/memory",
+    tags=["Debug"],
+    summary="Get worker memory usage",
+    description="Returns the resident memory of the worker process handling the request split into shared and private memory, and how much of it is memory mapped model weights.",
+)
+async def memory_endpoint() -> Dict[str, Any]:
+    """
+    Reports the memory usage of the worker process that handled this request. When running multiple
+    uvicorn workers each request may be answered by a different worker, the pid identifies which one.
+
+    Model weights are memory mapped, so their pages show up as shared memory once more than one worker
+    has loaded the same model and the rss of each worker shouldn't grow by the size of the weights.
+
+    Example response:
+        {
+            "content": {
+                "pid": 4242,
+                "rss_kb": 4512340,
+                "pss_kb": 2410112,
+                "shared_kb": 4203520,
+                "private_kb": 308820,
+                "model_files": {"mistral-7b-openorca.gguf2.Q4_0.gguf": 4012612}
+            },
+            "status_code": 200
+        }
+    """
+    return {
+        "content": ModelLoader.memory_report(),
+        "status_code": 200,
+    }
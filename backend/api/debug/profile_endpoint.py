@@ -0,0 +1,83 @@
+import ipaddress
+from pydantic import BaseModel, Field
+from typing import Dict, Any, List, Optional
+
+from fastapi import APIRouter, HTTPException, Request
+
+from ...utils.profiler import Profiler
+
+router = APIRouter()
+
+
+class ProfileSettingsInput(BaseModel):
+    routes: Optional[List[str]] = Field(None, max_items=64)
+    sample_rate: Optional[float] = Field(None, ge=0, le=1)
+    interval_ms: Optional[float] = Field(None, ge=1, le=1000)
+
+
+def get_profile_status(limit: int) -> Dict[str, Any]:
+    return {
+        **Profiler.settings.dict(),
+        "directory": Profiler.directory,
+        "recent": list(Profiler.recent)[-limit:][::-1],
+    }
+
+
+@router.get(
+    "/debug/profile",
+    tags=["Debug"],
+    summary="Get request profiling settings and recently profiled requests",
+    description="Returns which routes the worker process handling the request profiles, at what sample rate, and the wall and CPU time of the last profiled requests. Their stacks are written to the profile directory in the collapsed flamegraph format.",
+)
+async def get_profile_endpoint(limit: int = 20) -> Dict[str, Any]:
+    """
+    Example response:
+        {
+            "content": {
+                "routes": ["/register"],
+                "sample_rate": 0.01,
+                "interval_ms": 5.0,
+                "directory": ".cache/profiles",
+                "recent": [
+                    {
+                        "time": 1718000000.12, "method": "POST", "path": "/register", "route": "/register",
+                        "status": 200, "wall_seconds": 0.0421, "cpu_seconds": 0.0183, "samples": 4, "interval_ms": 5.0
+                    }
+                ]
+            },
+            "status_code": 200
+        }
+    """
+    return {
+        "content": get_profile_status(limit),
+        "status_code": 200,
+    }
+
+
+@router.post(
+    "/debug/profile",
+    tags=["Debug"],
+    summary="Change request profiling settings",
+    description="Changes which routes are profiled and at what sample rate in the worker process handling the request until it restarts. Only accepted from the node itself.",
+)
+async def set_profile_endpoint(settings_input: ProfileSettingsInput, request: Request) -> Dict[str, Any]:
+    """
+    Set routes to [] to stop profiling. With multiple workers, send the request to each worker.
+
+    Example request:
+        {"routes": ["/register", "/inference/*"], "sample_rate": 0.05}
+    """
+    try:
+        local = ipaddress.ip_address(request.client.host).is_loopback
+    except ValueError:
+        local = False
+    if not local:
+        raise HTTPException(status_code=403, detail="Profiling can only be changed from the node itself")
+
+    Profiler.settings = Profiler.Settings(
+        **{**Profiler.settings.dict(), **settings_input.dict(exclude_none=True)}
+    )
+    return {
+        "content": get_profile_status(limit=0),
+        "status_code": 200,
+    }
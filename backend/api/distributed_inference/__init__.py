@@ -1,5 +1,23 @@
+import os
+import time
+import random
+import asyncio
 from pydantic import BaseModel
-from typing import Union, Dict, Any
+from typing import Union, Dict, Any, Awaitable, Callable, List, Optional, Tuple
+
+import httpx
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+from ...utils import Utils, Peer
+from ...utils.capabilities import Capabilities
+from ...utils.logger import Logger
+from ...utils.scheduler import scheduler
+from ...utils.metrics import metrics, Tracing
+
+logger = Logger.get("inference")
 
 
 class DisInfUtils:
@@ -45,9 +63,98 @@ class Data:
             pass
 
 
+class InferenceMetrics:
+    """
+    Latency breakdown and throughput of the inference requests run on this node, per model.
+    """
+
+    tokens_per_second_buckets = (1, 2, 5, 10, 20, 35, 50, 75, 100, 200, 500)
+
+    queue_wait = metrics.histogram(
+        "bitorch_inference_queue_wait_seconds",
+        "Time a request waits for a free generation slot of the model.",
+        labels=["model"],
+    )
+    prefill = metrics.histogram(
+        "bitorch_inference_prefill_seconds",
+        "Time from the start of a generation to its first token, processing the uncached part of the prompt.",
+        labels=["model"],
+    )
+    time_to_first_token = metrics.histogram(
+        "bitorch_inference_time_to_first_token_seconds",
+        "Time from receiving a request to generating its first token, including queueing and model loading.",
+        labels=["model"],
+    )
+    tokens_per_second = metrics.histogram(
+        "bitorch_inference_tokens_per_second",
+        "Decoding speed of a generation after its first token.",
+        labels=["model"],
+        buckets=tokens_per_second_buckets,
+    )
+    generated_tokens = metrics.counter(
+        "bitorch_inference_generated_tokens_total", "Tokens generated.", labels=["model"]
+    )
+    image_steps_per_second = metrics.histogram(
+        "bitorch_inference_image_steps_per_second",
+        "Denoising steps per second of image generations.",
+        labels=["model"],
+        buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50),
+    )
+
+    class Generation:
+        """
+        Times a text generation from its token callback. Call started() once the generation has a model
+        slot, the prompt is being processed from then on until the first token.
+        """
+
+        def __init__(self, model: str, callback: Optional[Callable[[int, str], bool]] = None):
+            self.model = model
+            self._callback = callback
+            trace = Tracing.current_trace()
+            # Requests are timed from their arrival, generations outside of a request from this call
+            self.requested = time.perf_counter() - (trace.elapsed() if trace is not None else 0.0)
+            self.start = time.perf_counter()
+            self.first_token: Optional[float] = None
+            self.tokens = 0
+
+        def started(self) -> None:
+            self.start = time.perf_counter()
+
+        def callback(self, token_id: int, text: str) -> bool:
+            if self.first_token is None:
+                self.first_token = time.perf_counter()
+            self.tokens += 1
+            return self._callback(token_id, text) if self._callback is not None else True
+
+        def finish(self) -> None:
+            end = time.perf_counter()
+            InferenceMetrics.generated_tokens.inc(self.tokens, model=self.model)
+            if self.first_token is None:
+                return
+            prefill = self.first_token - self.start
+            InferenceMetrics.prefill.observe(prefill, model=self.model)
+            InferenceMetrics.time_to_first_token.observe(self.first_token - self.requested, model=self.model)
+            Tracing.add_span("inference.prefill", self.start, prefill, model=self.model)
+            Tracing.add_span(
+                "inference.decode", self.first_token, end - self.first_token, model=self.model, tokens=self.tokens
+            )
+            if self.tokens > 1 and end > self.first_token:
+                InferenceMetrics.tokens_per_second.observe(
+                    (self.tokens - 1) / (end - self.first_token), model=self.model
+                )
+
+
 class ModelDispatcher:
     """
-    This class is designed to take in an InferenceRequest, search the available models on the server, review if they are present, then run the model given the input data and returns the output to the inference requestor.
+    Routes inference requests to the least loaded peer able to serve them. Every node counts the
+    inference requests it is running or queueing (its queue depth) and reports it in the
+    X-Bitorch-Queue-Depth header of inference responses and on /inference/load, which is polled from
+    the peers that advertise inference capabilities.
+
+    When a request comes in the node compares its own load with the last known load of every capable
+    peer and either runs the model locally or forwards the request to the least loaded peer and streams
+    its response back. If the peer can't be connected to in time the next least loaded peer is tried.
+    Forwarded requests carry the X-Bitorch-Forwarded header so that they are never forwarded a second time.
     """
 
     # TODO: Somehow figure out a way to take in the inference request, map it to the model, and map the data sent by the inference-request to the model running in the huggingface library dynamically so that we don't
@@ -55,6 +162,289 @@ class ModelDispatcher:
     # transformer model params needs to be agnostic of the params and the model itself. Params should be automatically applied to the model, and running the model, input/output, shouldn't be hard-coded and should
     # be dynamic to whatever the model is that the user of my peer has uploaded if supported by huggingface.transformers.
 
+    queue_depth_header = "X-Bitorch-Queue-Depth"
+    forwarded_header = "X-Bitorch-Forwarded"
+
+    # Headers passed on to the peer a request is forwarded to and back from its response
+    forwarded_request_headers = ["cache-control"]
+    relayed_response_headers = ["content-type", "content-encoding", "x-cache", "age"]
+
+    max_attempts = 3
+    # Seconds to wait for a connection to a peer before failing over to the next one
+    timeout = float(os.getenv("DISPATCH_TIMEOUT", 30))
+    # Seconds to wait for each part of a peer's answer, unlimited by default since a generation or the
+    # gap between two streamed chunks can take minutes
+    generation_timeout = float(os.getenv("DISPATCH_GENERATION_TIMEOUT", 0)) or None
+    # Errors raised before the request reached the peer, the only ones safe to fail over from
+    connect_errors = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+    dispatched = metrics.counter(
+        "bitorch_dispatch_requests_total",
+        "Inference requests by where they were run: local, peer or unavailable.",
+        labels=["target"],
+    )
+    forward_failures = metrics.counter(
+        "bitorch_dispatch_forward_failures_total", "Requests a peer failed to answer before failing over."
+    )
+    queue_depth_gauge = metrics.gauge(
+        "bitorch_inference_queue_depth", "Inference requests running or waiting for a model on this node."
+    )
+
+    queue_depth = 0  # Inference requests running or waiting for a model on this node
+    peer_loads: Dict[str, Tuple[int, int]] = {}  # peer url -> (queue depth, max concurrency)
+    forwarded: Dict[str, int] = {}  # peer url -> requests forwarded by this node still in flight
+
+    @staticmethod
+    def get_load() -> Dict[str, Any]:
+        manifest = Capabilities.get_manifest()
+        return {
+            "queue_depth": ModelDispatcher.queue_depth,
+            "max_concurrency": manifest.max_concurrency,
+            "inference": manifest.inference,
+        }
+
+    @staticmethod
+    def score(queue_depth: int, max_concurrency: int) -> float:
+        """Load of a node relative to how many requests it runs at once, lower is better."""
+        return queue_depth / max(max_concurrency, 1)
+
+    @staticmethod
+    def peer_url(peer: Union[Peer.Public, Peer.Record]) -> str:
+        return f"http://{peer.ip}:{peer.port}"
+
+    @staticmethod
+    async def get_candidates(requirements: Capabilities.Requirements) -> List[Tuple[float, str]]:
+        """
+        Returns (load score, url) of every other peer able to serve the requirements, least loaded
+        first. Peers with the same load are shuffled so that requests spread between them.
+        """
+        from ..pex import PexMongo
+
+        my_url = ModelDispatcher.peer_url(await Utils.get_my_peer())
+        peers = await PexMongo.get_capable_peers(requirements)
+
+        candidates = []
+        for peer in peers:
+            url = ModelDispatcher.peer_url(peer)
+            if url == my_url:
+                continue
+            queue_depth, max_concurrency = ModelDispatcher.peer_loads.get(
+                url, (0, peer.capabilities.max_concurrency)
+            )
+            queue_depth += ModelDispatcher.forwarded.get(url, 0)
+            candidates.append(
+                (ModelDispatcher.score(queue_depth, max_concurrency), random.random(), url)
+            )
+        return [(score, url) for score, _, url in sorted(candidates)]
+
+    @staticmethod
+    async def dispatch(
+        request: Request,
+        body: Dict[str, Any],
+        requirements: Capabilities.Requirements,
+        run_local: Callable[[], Awaitable[Any]],
+        local_requirements: Optional[Capabilities.Requirements] = None,
+    ) -> Response:
+        """
+        Runs an inference request on this node or forwards it to the least loaded capable peer.
+
+        Parameters:
+        - request (Request): The incoming request, forwarded to the same path on the chosen peer.
+        - body (Dict[str, Any]): The validated json body to forward.
+        - requirements (Capabilities.Requirements): What a peer must be able to serve to run the request.
+        - run_local (Callable): Runs the request on this node and returns its response or result.
+        - local_requirements (Capabilities.Requirements): What this node needs to run the request itself,
+          defaults to requirements.
+
+        Returns:
+        - Response: The local response or the chosen peer's response streamed back, 503 if no node can
+          serve the request.
+        """
+        manifest = Capabilities.get_manifest()
+        local_capable = manifest.satisfies(local_requirements or requirements)
+        forwarded = ModelDispatcher.forwarded_header in request.headers
+
+        local_score = ModelDispatcher.score(ModelDispatcher.queue_depth, manifest.max_concurrency)
+        # No peer can be less loaded than an idle node, it runs the request without looking up peers
+        idle = local_capable and local_score == 0
+        candidates = [] if forwarded or idle else await ModelDispatcher.get_candidates(requirements)
+
+        for remote_score, url in candidates[: ModelDispatcher.max_attempts]:
+            if local_capable and local_score <= remote_score:
+                break
+            with Tracing.span("dispatch.forward", peer=url):
+                response = await ModelDispatcher.forward(url, request, body)
+            if response is not None:
+                ModelDispatcher.dispatched.inc(target="peer")
+                return response
+            ModelDispatcher.forward_failures.inc()
+
+        if not local_capable:
+            ModelDispatcher.dispatched.inc(target="unavailable")
+            raise HTTPException(
+                status_code=503,
+                detail="No peer able to serve this request is available",
+            )
+        ModelDispatcher.dispatched.inc(target="local")
+        return await ModelDispatcher.run_tracked(run_local)
+
+    @staticmethod
+    async def run_tracked(run_local: Callable[[], Awaitable[Any]]) -> Response:
+        """
+        Runs a request on this node counting it in the queue depth until its response, or the stream of
+        a streaming response, is done.
+        """
+        ModelDispatcher.queue_depth += 1
+        ModelDispatcher.queue_depth_gauge.set(ModelDispatcher.queue_depth)
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                ModelDispatcher.queue_depth -= 1
+                ModelDispatcher.queue_depth_gauge.set(ModelDispatcher.queue_depth)
+
+        try:
+            result = await run_local()
+        except BaseException:
+            release()
+            raise
+
+        response = result if isinstance(result, Response) else JSONResponse(jsonable_encoder(result))
+        response.headers[ModelDispatcher.queue_depth_header] = str(ModelDispatcher.queue_depth)
+        if isinstance(response, StreamingResponse):
+            body_iterator = response.body_iterator
+
+            async def tracked_iterator():
+                try:
+                    async for chunk in body_iterator:
+                        yield chunk
+                finally:
+                    release()
+
+            response.body_iterator = tracked_iterator()
+        else:
+            release()
+        return response
+
+    @staticmethod
+    async def forward(url: str, request: Request, body: Dict[str, Any]) -> Optional[Response]:
+        """
+        Forwards a request to a peer and streams its response back. Returns None if the peer couldn't be
+        connected to or answered with a server error so the caller can fail over to another peer. Once
+        the request was sent the peer may be running it, so failing to read its answer is a 502 (504 on
+        a timeout) rather than a failover that would run the request twice.
+        """
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                connect=ModelDispatcher.timeout,
+                pool=ModelDispatcher.timeout,
+                write=ModelDispatcher.timeout,
+                read=ModelDispatcher.generation_timeout,
+            )
+        )
+        ModelDispatcher.forwarded[url] = ModelDispatcher.forwarded.get(url, 0) + 1
+        try:
+            peer_response = await client.send(
+                client.build_request(
+                    request.method,
+                    f"{url}{request.url.path}",
+                    params=request.query_params,
+                    json=body,
+                    headers={
+                        ModelDispatcher.forwarded_header: "1",
+                        **{
+                            name: request.headers[name]
+                            for name in ModelDispatcher.forwarded_request_headers
+                            if name in request.headers
+                        },
+                    },
+                ),
+                stream=True,
+            )
+        except ModelDispatcher.connect_errors as e:
+            logger.warning("Forwarding inference request to %s failed: %s", url, e)
+            await ModelDispatcher.close_forwarded(url, client)
+            return None
+        except httpx.HTTPError as e:
+            logger.warning("Peer %s failed to answer a forwarded inference request: %s", url, e)
+            await ModelDispatcher.close_forwarded(url, client)
+            raise HTTPException(
+                status_code=504 if isinstance(e, httpx.TimeoutException) else 502,
+                detail="The peer running this request failed to answer",
+            )
+
+        ModelDispatcher.update_load(url, peer_response.headers)
+        if peer_response.status_code >= 500:
+            logger.warning("Forwarding inference request to %s failed: %s", url, peer_response.status_code)
+            await ModelDispatcher.close_forwarded(url, client, peer_response)
+            return None
+
+        return StreamingResponse(
+            peer_response.aiter_raw(),
+            status_code=peer_response.status_code,
+            headers={
+                name: value
+                for name, value in peer_response.headers.items()
+                if name.lower() in ModelDispatcher.relayed_response_headers
+            },
+            background=BackgroundTask(ModelDispatcher.close_forwarded, url, client, peer_response),
+        )
+
+    @staticmethod
+    async def close_forwarded(
+        url: str, client: httpx.AsyncClient, response: Optional[httpx.Response] = None
+    ):
+        ModelDispatcher.forwarded[url] = max(ModelDispatcher.forwarded.get(url, 1) - 1, 0)
+        if response is not None:
+            await response.aclose()
+        await client.aclose()
+
+    @staticmethod
+    def update_load(url: str, headers) -> None:
+        queue_depth = headers.get(ModelDispatcher.queue_depth_header)
+        if queue_depth is not None and queue_depth.isdigit():
+            _, max_concurrency = ModelDispatcher.peer_loads.get(url, (0, 1))
+            ModelDispatcher.peer_loads[url] = (int(queue_depth), max_concurrency)
+
+    @scheduler.schedule_task(
+        trigger="delay",
+        seconds=int(os.getenv("DISPATCH_POLL_INTERVAL", 10)),
+        timeout=timeout,
+        id="dispatcher_load_poll",
+    )
+    @staticmethod
+    async def poll_loads():
+        """
+        Polls the queue depth of every peer that advertises inference capabilities. Peers that don't
+        answer are dropped from the known loads and tried again on the next poll.
+        """
+        from ..pex import PexMongo
+
+        my_url = ModelDispatcher.peer_url(await Utils.get_my_peer())
+        peers = await PexMongo.get_capable_peers(Capabilities.Requirements(inference=True))
+        urls = [
+            ModelDispatcher.peer_url(peer)
+            for peer in peers
+            if ModelDispatcher.peer_url(peer) != my_url
+        ]
+
+        async def poll(client: httpx.AsyncClient, url: str):
+            try:
+                response = await client.get(f"{url}/inference/load")
+                response.raise_for_status()
+                load = response.json()["content"]
+                ModelDispatcher.peer_loads[url] = (
+                    int(load["queue_depth"]),
+                    int(load["max_concurrency"]),
+                )
+            except (httpx.HTTPError, KeyError, TypeError, ValueError):
+                ModelDispatcher.peer_loads.pop(url, None)
+
+        async with httpx.AsyncClient(timeout=5.0) as client:
+            await asyncio.gather(*(poll(client, url) for url in urls))
+
 
 class InferenceRequest:
     """
@@ -6,3 +6,156 @@ when we build out the bittorrent protocal for model distribution.
 - Checksums: Provide checksums with downloadable files to enable verification of file integrity after download.
 - Secure Connections: Use HTTPS to ensure the security of transfers and prevent man-in-the-middle attacks somehow.
 """
+
+import ipaddress
+from typing import Dict, Any
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+
+from .model_manager import model_registry
+from .model_transfer import ModelTransfer, ModelDownloader, FileRangeResponse
+
+router = APIRouter()
+
+
+@router.get(
+    "/models/{model_id}",
+    tags=["Distributed Inference"],
+    summary="Get model metadata",
+    description="Returns the format, size, quantization, checksum and load state of a model hosted by this peer.",
+)
+async def get_model_endpoint(model_id: str) -> Dict[str, Any]:
+    model = model_registry.get_model(model_id)
+    if model is None:
+        raise HTTPException(status_code=404, detail=f"Model '{model_id}' is not hosted by this peer.")
+
+    return {
+        "content": {"model": model.public_dict()},
+        "status_code": 200,
+    }
+
+
+@router.post(
+    "/models/{model_id}/pull",
+    tags=["Distributed Inference"],
+    summary="Download a model from peers",
+    description="Starts downloading a model from every known peer hosting it, rarest pieces first, and returns 202 while the download runs. Call it again to follow the progress, it returns 200 once the model is hosted. Only accepted from the node itself.",
+)
+async def pull_model_endpoint(model_id: str, request: Request) -> JSONResponse:
+    """
+    An interrupted download resumes from the pieces already verified when the model is pulled again.
+
+    Example response:
+        {
+            "content": {"model_id": "sdxl-turbo", "state": "downloading", "pieces": 1650, "downloaded": 412},
+            "status_code": 202
+        }
+    """
+    try:
+        local = ipaddress.ip_address(request.client.host).is_loopback
+    except ValueError:
+        local = False
+    if not local:
+        raise HTTPException(status_code=403, detail="Models can only be pulled from the node itself")
+
+    try:
+        progress = ModelTransfer.start_pull(model_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    status_code = 200 if progress["state"] == "hosted" else 202
+    return JSONResponse(
+        {"content": {"model_id": model_id, **progress}, "status_code": status_code}, status_code=status_code
+    )
+
+
+@router.get(
+    "/models/{model_id}/manifest",
+    tags=["Distributed Inference"],
+    summary="Get model piece manifest",
+    description="Returns the piece size and the sha256 of every piece of every file of a model, used by peers to download the model.",
+)
+async def get_model_manifest_endpoint(model_id: str) -> Dict[str, Any]:
+    if model_registry.get_model(model_id) is None and model_id not in ModelDownloader.active:
+        raise HTTPException(status_code=404, detail=f"Model '{model_id}' is not hosted by this peer.")
+
+    manifest = ModelTransfer.get_manifest(model_id)
+    if manifest is None:
+        # The model registry hasn't finished hashing the model yet
+        raise HTTPException(
+            status_code=503, detail="Manifest not ready yet.", headers={"Retry-After": "30"}
+        )
+
+    return {
+        "content": {"manifest": manifest.dict()},
+        "status_code": 200,
+    }
+
+
+@router.get(
+    "/models/{model_id}/have",
+    tags=["Distributed Inference"],
+    summary="Get available model pieces",
+    description="Returns whether this peer has the complete model or the indices of the pieces it has downloaded so far.",
+)
+async def get_model_pieces_endpoint(model_id: str) -> Dict[str, Any]:
+    available = ModelTransfer.get_available_pieces(model_id)
+    if available is None:
+        raise HTTPException(
+            status_code=404, detail=f"Model '{model_id}' is not available from this peer."
+        )
+
+    return {
+        "content": available,
+        "status_code": 200,
+    }
+
+
+@router.get(
+    "/models/{model_id}/pieces/{piece_hash}",
+    tags=["Distributed Inference"],
+    summary="Download a model piece",
+    description="Returns the piece of a model with the given sha256, supports HTTP range requests within the piece.",
+    response_class=FileRangeResponse,
+)
+async def get_model_piece_endpoint(model_id: str, piece_hash: str, request: Request) -> Response:
+    location = ModelTransfer.locate_piece(model_id, piece_hash.lower())
+    if location is None:
+        raise HTTPException(status_code=404, detail="Piece not available from this peer.")
+    file_path, offset, length = location
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{piece_hash.lower()}"',
+        "Cache-Control": "public, max-age=31536000, immutable",  # Content addressed, never changes
+    }
+    status_code = 200
+    range_header = request.headers.get("range")
+    if range_header:
+        byte_range = ModelTransfer.parse_range(range_header, length)
+        if byte_range is None:
+            raise HTTPException(
+                status_code=416,
+                detail="Range not satisfiable.",
+                headers={"Content-Range": f"bytes */{length}"},
+            )
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+        offset, length, status_code = offset + start, end - start + 1, 206
+
+    if not ModelTransfer.acquire_upload_slot():
+        raise HTTPException(
+            status_code=503,
+            detail="Upload limit reached, try another peer.",
+            headers={"Retry-After": "1"},
+        )
+
+    return FileRangeResponse(
+        file_path,
+        offset,
+        length,
+        status_code=status_code,
+        headers=headers,
+        on_complete=ModelTransfer.release_upload_slot,
+    )
@@ -0,0 +1,27 @@
+from typing import Dict, Any
+
+from fastapi import APIRouter
+
+from . import ModelDispatcher
+
+router = APIRouter()
+
+
+@router.get(
+    "/inference/load",
+    tags=["Distributed Inference"],
+    summary="Get inference queue depth",
+    description="Returns how many inference requests this node is running or queueing, polled by peers to pick the least loaded node for a request.",
+)
+async def inference_load_endpoint() -> Dict[str, Any]:
+    """
+    Example response:
+        {
+            "content": {"queue_depth": 3, "max_concurrency": 2, "inference": true},
+            "status_code": 200
+        }
+    """
+    return {
+        "content": ModelDispatcher.get_load(),
+        "status_code": 200,
+    }
@@ -1,2 +1,47 @@
 # List out models hosted and available and in what formats, full, chunked, and metadata about what they are and where else they are hosted or whatever is needed to display to the user.
 
+from fastapi import APIRouter, Request, Response
+
+from .model_manager import model_registry
+
+router = APIRouter()
+
+
+@router.get(
+    "/models",
+    tags=["Distributed Inference"],
+    summary="List hosted models",
+    description="Returns the models hosted by this peer with their format, size, quantization, checksum and load state.",
+)
+async def list_models_endpoint(request: Request) -> Response:
+    """
+    Lists the models hosted by this peer from the in memory model registry.
+
+    The response carries an ETag, peers polling this endpoint should send it back in the
+    If-None-Match header and will receive an empty 304 response if nothing has changed.
+
+    Example response:
+        {
+            "content": {
+                "models": [
+                    {
+                        "id": "mistral-7b-openorca.gguf2.Q4_0.gguf",
+                        "format": "gguf",
+                        "size": 4108916384,
+                        "quantization": "Q4_0",
+                        "checksum": "f6f1c5f5...",
+                        "load_state": "loaded"
+                    }
+                ]
+            },
+            "status_code": 200
+        }
+    """
+    etag, body = model_registry.snapshot()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -1 +1,691 @@
 # Util file that handles the model loading, downloading from hugging face hub, deletion, etc. File handling operations for loading and saving models, including splitting and reconstructing models if necessary (eventually).
+
+import os
+import re
+import json
+import mmap
+import time
+import struct
+import asyncio
+import hashlib
+import warnings
+import threading
+from contextlib import contextmanager
+from pydantic import BaseModel, Field
+from typing import Optional, List, Dict, Tuple, Any, Iterator
+
+from ...utils import Utils
+from ...utils.logger import Logger
+from ...utils.metrics import metrics, Tracing
+from ...utils.scheduler import scheduler
+from ...utils.capabilities import Capabilities
+
+torch = Utils.LazyImport("torch")
+gpt4all = Utils.LazyImport("gpt4all")
+diffusers = Utils.LazyImport("diffusers")
+transformers = Utils.LazyImport("transformers")
+
+
+model_path = os.path.join("models")
+
+logger = Logger.get("models")
+
+model_load_seconds = metrics.histogram(
+    "bitorch_model_load_seconds",
+    "Time to load a model into memory, by model and result.",
+    labels=["model", "result"],
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0),
+)
+
+# Size of the content addressed pieces models are split into for distribution between peers
+piece_size = int(os.getenv("MODEL_PIECE_SIZE", 4 * 1024 * 1024))
+
+# Models loaded by every worker on startup, before it accepts requests
+warm_models = [model_id.strip() for model_id in os.getenv("WARM_MODELS", "").split(",") if model_id.strip()]
+# Workers (by WORKER_INDEX) that warm up models loaded onto a gpu, every worker holds its own copy of such
+# a model so warming them in every worker of WORKERS=auto would run out of gpu memory
+warm_gpu_workers = int(os.getenv("WARM_GPU_WORKERS", 1))
+
+# Matches the quantization tag in model file names, e.g. "mistral-7b-openorca.gguf2.Q4_0.gguf" -> "Q4_0"
+quantization_pattern = re.compile(
+    r"(?<![A-Za-z0-9])(I?Q\d+(?:_[0-9A-Z]+)*|F16|F32|BF16|fp16|fp32|bf16|int8|int4)(?![A-Za-z0-9])"
+)
+
+file_formats = {
+    ".gguf": "gguf",
+    ".safetensors": "safetensors",
+    ".bin": "pytorch",
+    ".pt": "pytorch",
+    ".pth": "pytorch",
+    ".onnx": "onnx",
+}
+
+
+class ModelInfo(BaseModel):
+    """
+    Metadata about a single model hosted in the models/ directory. A model is either a single weights
+    file (e.g. a .gguf) or a directory (e.g. a diffusers or transformers model).
+    """
+
+    id: str
+    format: str
+    size: int
+    quantization: Optional[str] = None
+    checksum: Optional[str] = None  # sha256, None until it has been computed in the background
+    load_state: str = "unloaded"  # unloaded, loading, loaded or failed
+    piece_size: int = piece_size
+    # Relative path -> [size, mtime_ns, sha256, piece sha256s] of every file in the model, used to only
+    # re-hash changed files and to build the manifest peers download the model with.
+    files: Dict[str, List[Any]] = Field(default_factory=dict)
+
+    def public_dict(self) -> Dict[str, Any]:
+        return self.dict(exclude={"files", "piece_size"})
+
+    def manifest(self) -> Optional[Dict[str, Any]]:
+        """
+        Returns the piece manifest of the model, None until all of its files have been hashed.
+
+        Example:
+            {
+                "model_id": "mistral-7b-openorca.gguf2.Q4_0.gguf",
+                "checksum": "f6f1c5f5...",
+                "single_file": true,
+                "piece_size": 4194304,
+                "files": [
+                    {"path": "mistral-7b-openorca.gguf2.Q4_0.gguf", "size": 4108916384, "sha256": "f6f1c5f5...", "pieces": ["ab12...", ...]}
+                ]
+            }
+        """
+        if self.checksum is None:
+            return None
+        return {
+            "model_id": self.id,
+            "checksum": self.checksum,
+            "single_file": self.format in file_formats.values() or self.format == "unknown",
+            "piece_size": self.piece_size,
+            "files": [
+                {"path": name, "size": stat[0], "sha256": stat[2], "pieces": stat[3]}
+                for name, stat in sorted(self.files.items())
+            ],
+        }
+
+
+class ModelRegistry:
+    """
+    In memory index of the models hosted by this node, persisted to models/.registry.json so that
+    checksums of multi gigabyte files are only computed once.
+
+    The models/ directory is scanned once at startup and then watched by a scheduled task that only
+    stats files, so only new or changed files are re-hashed. The serialized model list and its ETag are
+    cached and only rebuilt when something changes, allowing peers to cheaply poll /models.
+    """
+
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(ModelRegistry, cls).__new__(cls)
+            cls._instance.models = {}
+            cls._instance.lock = threading.Lock()
+            cls._instance.hash_lock = threading.Lock()
+            cls._instance.index_file = os.path.join(model_path, ".registry.json")
+            cls._instance.etag = None
+            cls._instance.body = b""
+            cls._instance.load_index()
+        return cls._instance
+
+    def load_index(self):
+        """Loads the persisted index, ignoring it if it is missing or unreadable."""
+        try:
+            with open(self.index_file, "r") as file:
+                index = json.load(file)
+            self.models = {model_id: ModelInfo(**info) for model_id, info in index.items()}
+        except FileNotFoundError:
+            self.models = {}
+        except (ValueError, TypeError) as e:
+            logger.warning("Ignoring unreadable model registry index %s: %s", self.index_file, e)
+            self.models = {}
+        for info in self.models.values():
+            info.load_state = "unloaded"  # Nothing is loaded in a freshly started process
+        self._rebuild()
+
+    def save_index(self):
+        os.makedirs(model_path, exist_ok=True)
+        temp_file = f"{self.index_file}.tmp"
+        with open(temp_file, "w") as file:
+            json.dump({model_id: info.dict() for model_id, info in self.models.items()}, file)
+        os.replace(temp_file, self.index_file)
+
+    def _rebuild(self):
+        """Re-serializes the public model list and its ETag, call with the lock held."""
+        models = [info.public_dict() for _, info in sorted(self.models.items())]
+        self.body = json.dumps(
+            {"content": {"models": models}, "status_code": 200}, separators=(",", ":")
+        ).encode("utf-8")
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+        Capabilities.get_manifest().models = sorted(self.models)
+
+    @staticmethod
+    def stat_files(entry_path: str) -> Dict[str, Tuple[int, int]]:
+        """Returns relative path -> (size, mtime_ns) of every file of a model entry."""
+        if os.path.isfile(entry_path):
+            stat = os.stat(entry_path)
+            return {os.path.basename(entry_path): (stat.st_size, stat.st_mtime_ns)}
+
+        files = {}
+        for root, dirs, names in os.walk(entry_path):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                if name.startswith("."):
+                    continue
+                file_path = os.path.join(root, name)
+                stat = os.stat(file_path)
+                files[os.path.relpath(file_path, entry_path)] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    @staticmethod
+    def detect_format(entry_path: str, files: Dict[str, Tuple[int, int]]) -> str:
+        if os.path.isfile(entry_path):
+            return file_formats.get(os.path.splitext(entry_path)[1].lower(), "unknown")
+        if "model_index.json" in files:
+            return "diffusers"
+        if "config.json" in files:
+            return "transformers"
+        return "directory"
+
+    @staticmethod
+    def detect_quantization(model_id: str, files: Dict[str, Tuple[int, int]]) -> Optional[str]:
+        for name in [model_id, *sorted(files)]:
+            match = quantization_pattern.search(os.path.basename(name))
+            if match:
+                return match.group(1)
+        return None
+
+    def scan(self) -> bool:
+        """
+        Stats every entry in models/ and updates the registry for new, changed and removed models.
+        Checksums of changed files are invalidated and computed later by compute_checksums.
+
+        Returns:
+        - bool: True if the registry changed.
+        """
+        entries = {}
+        if os.path.isdir(model_path):
+            for entry in os.scandir(model_path):
+                if entry.name.startswith("."):
+                    continue  # Hidden files, the index and partial downloads
+                try:
+                    entries[entry.name] = (entry.path, self.stat_files(entry.path))
+                except FileNotFoundError:
+                    continue  # Removed while scanning
+
+        changed = False
+        with self.lock:
+            for model_id in list(self.models):
+                if model_id not in entries:
+                    del self.models[model_id]
+                    changed = True
+
+            for model_id, (entry_path, files) in entries.items():
+                info = self.models.get(model_id)
+                if (
+                    info is not None
+                    and info.piece_size == piece_size
+                    and {name: tuple(stat[:2]) for name, stat in info.files.items()} == files
+                ):
+                    continue
+
+                old_files = info.files if info is not None else {}
+                new_files = {}
+                for name, (size, mtime_ns) in files.items():
+                    old = old_files.get(name)
+                    # Keep the checksum and piece hashes of files that haven't changed
+                    if (
+                        old is not None
+                        and len(old) == 4
+                        and tuple(old[:2]) == (size, mtime_ns)
+                        and info.piece_size == piece_size
+                    ):
+                        new_files[name] = list(old)
+                    else:
+                        new_files[name] = [size, mtime_ns, None, None]
+
+                self.models[model_id] = ModelInfo(
+                    id=model_id,
+                    format=self.detect_format(entry_path, files),
+                    size=sum(size for size, _ in files.values()),
+                    quantization=self.detect_quantization(model_id, files),
+                    checksum=None,
+                    load_state=info.load_state if info is not None else "unloaded",
+                    piece_size=piece_size,
+                    files=new_files,
+                )
+                changed = True
+
+            if changed:
+                self._rebuild()
+                self.save_index()
+        return changed
+
+    @staticmethod
+    def hash_file(file_path: str) -> Tuple[str, List[str]]:
+        """
+        Hashes a file in a single read pass, returning its sha256 and the sha256 of each of its pieces.
+        """
+        sha256 = hashlib.sha256()
+        pieces = []
+        with open(file_path, "rb") as file:
+            while piece := file.read(piece_size):
+                sha256.update(piece)
+                pieces.append(hashlib.sha256(piece).hexdigest())
+        return sha256.hexdigest(), pieces
+
+    def compute_checksums(self) -> bool:
+        """
+        Hashes the files that don't have a checksum yet and derives the model checksums. Blocking,
+        meant to be run in a thread.
+
+        A model's checksum is the sha256 of its files' relative paths and sha256s, for a single file
+        model it is the sha256 of the file itself.
+
+        Returns:
+        - bool: True if any checksum was computed.
+        """
+        with self.hash_lock:  # Only one hashing pass at a time, they can take minutes for large models
+            with self.lock:
+                pending = [
+                    (model_id, name, info.files[name][:2])
+                    for model_id, info in self.models.items()
+                    if info.checksum is None
+                    for name in info.files
+                    if info.files[name][2] is None or info.files[name][3] is None
+                ]
+
+            hashes = {}
+            for model_id, name, stat in pending:
+                entry_path = os.path.join(model_path, model_id)
+                file_path = entry_path if os.path.isfile(entry_path) else os.path.join(entry_path, name)
+                try:
+                    hashes[(model_id, name)] = (stat, self.hash_file(file_path))
+                except OSError:
+                    continue  # Removed while hashing, the next scan will pick it up
+
+            changed = False
+            with self.lock:
+                for (model_id, name), (stat, (sha256, pieces)) in hashes.items():
+                    info = self.models.get(model_id)
+                    if info is None or name not in info.files or info.files[name][:2] != stat:
+                        continue  # Changed while hashing, hashed again on the next pass
+                    info.files[name][2:] = [sha256, pieces]
+                    info.piece_size = piece_size
+
+                for model_id, info in self.models.items():
+                    if info.checksum is not None or any(
+                        f[2] is None or f[3] is None for f in info.files.values()
+                    ):
+                        continue
+                    if os.path.isfile(os.path.join(model_path, model_id)):
+                        info.checksum = next(iter(info.files.values()))[2]
+                    else:
+                        combined = hashlib.sha256()
+                        for name in sorted(info.files):
+                            combined.update(f"{name}\0{info.files[name][2]}\n".encode("utf-8"))
+                        info.checksum = combined.hexdigest()
+                    changed = True
+
+                if changed:
+                    self._rebuild()
+                    self.save_index()
+        return changed
+
+    async def refresh(self):
+        """Rescans models/ and computes any missing checksums without blocking the event loop."""
+        await asyncio.to_thread(self.scan)
+        await asyncio.to_thread(self.compute_checksums)
+
+    def set_load_state(self, model_id: str, load_state: str):
+        """Records if a model is unloaded, loading, loaded or failed to load in this process."""
+        with self.lock:
+            info = self.models.get(model_id)
+            if info is None or info.load_state == load_state:
+                return
+            info.load_state = load_state
+            self._rebuild()
+
+    def get_model(self, model_id: str) -> Optional[ModelInfo]:
+        return self.models.get(model_id)
+
+    def get_models(self) -> List[ModelInfo]:
+        return [info for _, info in sorted(self.models.items())]
+
+    def snapshot(self) -> Tuple[str, bytes]:
+        """Returns the current ETag and serialized model list."""
+        with self.lock:
+            return self.etag, self.body
+
+
+# This will always return the same instance
+model_registry = ModelRegistry()
+
+
+class ModelLoader:
+    """
+    Loads models once per worker process and shares their weights between workers on the same node.
+
+    Weight files are memory mapped read-only instead of being read into private memory, so every worker
+    process maps the same page cache pages and running N uvicorn workers doesn't need N copies of the
+    weights in RAM:
+    - gguf models are loaded through gpt4all whose llama.cpp backend mmaps the model file.
+    - safetensors weights used on the cpu are mapped with map_safetensors and assigned to the module
+      without a copy by share_module_weights.
+    Weights moved to a gpu are copied into that process' gpu memory and can't be shared this way.
+    """
+
+    _lock = threading.Lock()  # Held while a model loads, so that a model is only loaded once
+    _mapping_lock = threading.Lock()  # Guards _mapped_files, taken while _lock is held
+    _pipelines: Dict[str, Any] = {}
+    _transformers_models: Dict[str, Tuple[Any, Any]] = {}
+    _mapped_files: Dict[str, mmap.mmap] = {}
+
+    safetensors_dtypes = {
+        "F64": "float64",
+        "F32": "float32",
+        "F16": "float16",
+        "BF16": "bfloat16",
+        "I64": "int64",
+        "I32": "int32",
+        "I16": "int16",
+        "I8": "int8",
+        "U8": "uint8",
+        "BOOL": "bool",
+    }
+
+    @staticmethod
+    @contextmanager
+    def loading(model_id: str) -> Iterator[None]:
+        """
+        Wraps loading a model: updates its load state in the registry and records the load time.
+        """
+        model_registry.set_load_state(model_id, "loading")
+        start = time.perf_counter()
+        try:
+            with Tracing.span("model.load", model=model_id):
+                yield
+        except Exception:
+            model_registry.set_load_state(model_id, "failed")
+            model_load_seconds.observe(time.perf_counter() - start, model=model_id, result="failed")
+            raise
+        model_registry.set_load_state(model_id, "loaded")
+        model_load_seconds.observe(time.perf_counter() - start, model=model_id, result="loaded")
+
+    @staticmethod
+    def load_gpt4all(model_name: str):
+        abs_model_path = os.path.abspath(model_path)
+        os.makedirs(abs_model_path, exist_ok=True)
+        with ModelLoader.loading(model_name):
+            return gpt4all.GPT4All(
+                model_name=model_name,  # compatible models: https://raw.githubusercontent.com/nomic-ai/gpt4all/main/gpt4all-chat/metadata/models2.json
+                allow_download=True,
+                model_path=abs_model_path,
+                verbose=Utils.env == "development",
+            )
+
+    @staticmethod
+    def get_diffusers_pipeline(model_id: str, device: str, **kwargs):
+        """
+        Loads a diffusers pipeline once per process. On the cpu the safetensors weights of every component
+        are memory mapped and shared with the other workers instead of being copied into each worker.
+        Blocking, don't call from the event loop.
+        """
+        with ModelLoader._lock:
+            pipeline = ModelLoader._pipelines.get(model_id)
+            if pipeline is not None:
+                return pipeline
+
+            with ModelLoader.loading(model_id):
+                pipeline_path = os.path.join(model_path, model_id)
+                pipeline = diffusers.AutoPipelineForText2Image.from_pretrained(
+                    pretrained_model_or_path=pipeline_path,
+                    use_safetensors=True,
+                    low_cpu_mem_usage=True,
+                    **kwargs,
+                )
+                if device == "cpu":
+                    variant = kwargs.get("variant")
+                    for name, component in pipeline.components.items():
+                        if not isinstance(component, torch.nn.Module):
+                            continue
+                        component_path = os.path.join(pipeline_path, name)
+                        for file_name in ModelLoader.component_weight_files(component_path, variant):
+                            ModelLoader.share_module_weights(component, file_name)
+                pipeline.to(device)
+
+            ModelLoader._pipelines[model_id] = pipeline
+            return pipeline
+
+    @staticmethod
+    def get_transformers_model(model_id: str) -> Tuple[Any, Any]:
+        """
+        Loads a transformers causal language model and its tokenizer from models/<model_id> once per
+        process, on the cpu in eval mode. safetensors weights are memory mapped while loading. Blocking,
+        don't call from the event loop.
+
+        Returns:
+        - (model, tokenizer)
+        """
+        with ModelLoader._lock:
+            loaded = ModelLoader._transformers_models.get(model_id)
+            if loaded is not None:
+                return loaded
+
+            with ModelLoader.loading(model_id):
+                path = os.path.join(model_path, model_id)
+                tokenizer = transformers.AutoTokenizer.from_pretrained(path)
+                model = transformers.AutoModelForCausalLM.from_pretrained(
+                    path, torch_dtype="auto", low_cpu_mem_usage=True
+                )
+                model.eval()
+
+            loaded = ModelLoader._transformers_models[model_id] = (model, tokenizer)
+            return loaded
+
+    @staticmethod
+    def component_weight_files(component_path: str, variant: Optional[str] = None) -> List[str]:
+        if not os.path.isdir(component_path):
+            return []
+        files = sorted(f for f in os.listdir(component_path) if f.endswith(".safetensors"))
+        suffix = f".{variant}.safetensors" if variant else None
+        matching = [f for f in files if suffix and f.endswith(suffix)] or [
+            f for f in files if f.count(".") == 1
+        ]
+        return [os.path.join(component_path, f) for f in matching]
+
+    @staticmethod
+    def map_safetensors(file_path: str) -> Dict[str, Any]:
+        """
+        Memory maps a safetensors file read-only and returns its tensors as views into the mapping, no
+        weights are copied into the process. The mapping is kept open for the lifetime of the process.
+        """
+        with ModelLoader._mapping_lock:
+            mapped = ModelLoader._mapped_files.get(file_path)
+            if mapped is None:
+                with open(file_path, "rb") as file:
+                    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                ModelLoader._mapped_files[file_path] = mapped
+
+        (header_length,) = struct.unpack("<Q", mapped[:8])
+        header = json.loads(mapped[8 : 8 + header_length])
+        data_offset = 8 + header_length
+
+        tensors = {}
+        with warnings.catch_warnings():
+            # torch warns that the buffer is read-only, the weights are never written to.
+            warnings.simplefilter("ignore", UserWarning)
+            for name, info in header.items():
+                if name == "__metadata__":
+                    continue
+                dtype = getattr(torch, ModelLoader.safetensors_dtypes[info["dtype"]])
+                start, end = info["data_offsets"]
+                if end == start:
+                    tensors[name] = torch.empty(info["shape"], dtype=dtype)
+                    continue
+                element_size = torch.tensor([], dtype=dtype).element_size()
+                tensors[name] = torch.frombuffer(
+                    mapped,
+                    dtype=dtype,
+                    count=(end - start) // element_size,
+                    offset=data_offset + start,
+                ).view(info["shape"])
+        return tensors
+
+    @staticmethod
+    def share_module_weights(module, file_path: str):
+        """
+        Replaces the parameters of a torch module with memory mapped views of the tensors in a
+        safetensors file. Tensors whose dtype doesn't match the module's are copied as usual.
+        """
+        state = module.state_dict()
+        mapped = {
+            name: tensor
+            for name, tensor in ModelLoader.map_safetensors(file_path).items()
+            if name in state and state[name].dtype == tensor.dtype and state[name].shape == tensor.shape
+        }
+        module.load_state_dict(mapped, strict=False, assign=True)
+
+    @staticmethod
+    def memory_report() -> Dict[str, Any]:
+        """
+        Reports this worker's resident memory split into memory shared with other processes and private
+        memory, plus how much of the resident memory is memory mapped model files. Read from
+        /proc/self/smaps, only available on Linux.
+        """
+        report = {
+            "pid": os.getpid(),
+            "rss_kb": 0,
+            "pss_kb": 0,
+            "shared_kb": 0,
+            "private_kb": 0,
+            "model_files": {},  # Resident kb of each memory mapped file in models/
+        }
+        abs_model_path = os.path.abspath(model_path)
+        try:
+            with open("/proc/self/smaps", "r") as smaps:
+                mapped_file = None
+                for line in smaps:
+                    fields = line.split()
+                    if not fields:
+                        continue
+                    if not fields[0].endswith(":"):
+                        # Start of a new mapping: address perms offset dev inode [path]
+                        path = fields[5] if len(fields) >= 6 else ""
+                        mapped_file = path if path.startswith(abs_model_path) else None
+                        continue
+
+                    key, value = fields[0][:-1], int(fields[1]) if fields[1].isdigit() else 0
+                    if key == "Rss":
+                        report["rss_kb"] += value
+                        if mapped_file is not None:
+                            name = os.path.relpath(mapped_file, abs_model_path)
+                            report["model_files"][name] = report["model_files"].get(name, 0) + value
+                    elif key == "Pss":
+                        report["pss_kb"] += value
+                    elif key in ("Shared_Clean", "Shared_Dirty"):
+                        report["shared_kb"] += value
+                    elif key in ("Private_Clean", "Private_Dirty"):
+                        report["private_kb"] += value
+        except FileNotFoundError:
+            report["error"] = "/proc/self/smaps is not available on this platform"
+        return report
+
+
+class ModelTasks:
+    @staticmethod
+    async def startup():
+        """
+        Index the models/ directory so that /models can be served from memory, checksums of new
+        models are computed in the background by the model_registry_watch task. Then loads the models
+        of WARM_MODELS.
+        """
+        await asyncio.to_thread(model_registry.scan)
+
+        if not warm_models:
+            return
+        if not Capabilities.get_manifest().inference:
+            logger.warning("Not warming up %s, this node doesn't run inference", ", ".join(warm_models))
+            return
+        models = ModelTasks.get_warm_models()
+        skipped = [model_id for model_id in warm_models if model_id not in models]
+        if skipped:
+            logger.info(
+                "Not warming up %s on the gpu, only the first %d workers do (WARM_GPU_WORKERS)",
+                ", ".join(skipped),
+                warm_gpu_workers,
+            )
+        for model_id in models:
+            try:
+                await asyncio.to_thread(ModelTasks.warm, model_id)
+            except Exception as e:
+                logger.exception("Failed to warm up model %s: %s", model_id, e)
+
+    @staticmethod
+    def get_warm_models() -> List[str]:
+        """
+        Returns the models of WARM_MODELS this worker warms up: none if the node doesn't run inference, and
+        models loaded onto a gpu only in the first WARM_GPU_WORKERS workers.
+        """
+        if not Capabilities.get_manifest().inference:
+            return []
+        if int(os.getenv("WORKER_INDEX", 0)) < warm_gpu_workers:
+            return list(warm_models)
+        return [model_id for model_id in warm_models if not ModelTasks.loads_on_gpu(model_id)]
+
+    @staticmethod
+    def loads_on_gpu(model_id: str) -> bool:
+        """Whether warm loads the model onto a gpu, gguf and transformers models are loaded on the cpu."""
+        model = model_registry.get_model(model_id)
+        return model is not None and model.format == "diffusers" and torch.cuda.is_available()
+
+    @staticmethod
+    def warm(model_id: str):
+        """
+        Loads a model of WARM_MODELS the way the endpoints serving it load it, so that the first request
+        doesn't pay for loading it. Runs during the lifespan startup, the worker only starts accepting
+        connections once its models are loaded. gguf models missing from models/ are downloaded by
+        gpt4all like on the first request. Blocking, don't call from the event loop.
+        """
+        model = model_registry.get_model(model_id)
+        if model is None and not model_id.endswith(".gguf"):
+            raise FileNotFoundError(f"Model {model_id} not found in {model_path}")
+
+        if model is None or model.format == "gguf":
+            from .prompt_cache import PromptCache
+
+            PromptCache.warm(model_id)
+            if model is None:
+                # Index the downloaded model so that its load state is reported
+                model_registry.scan()
+                model_registry.set_load_state(model_id, "loaded")
+        elif model.format == "diffusers":
+            if torch.cuda.is_available():
+                ModelLoader.get_diffusers_pipeline(
+                    model_id, device="cuda", torch_dtype=torch.float16, variant="fp16"
+                )
+            else:
+                ModelLoader.get_diffusers_pipeline(model_id, device="cpu")
+        elif model.format == "transformers":
+            ModelLoader.get_transformers_model(model_id)
+        else:
+            raise ValueError(f"Models of format {model.format} can't be warmed up")
+
+    @scheduler.schedule_task(
+        trigger="delay",
+        seconds=int(os.getenv("MODEL_SCAN_INTERVAL", 30)),
+        id="model_registry_watch",
+    )
+    @staticmethod
+    async def watch():
+        """
+        Watches models/ for added, changed and removed models by comparing file sizes and modification
+        times, only changed files are re-hashed.
+        """
+        await model_registry.refresh()
@@ -0,0 +1,549 @@
+"""
+Model distribution between peers.
+
+Models are split into fixed size pieces (MODEL_PIECE_SIZE, 4MiB by default) addressed by their sha256, the
+piece hashes of every file are listed in the model's manifest which is built by the model registry while it
+computes the model checksum. Peers download a model by fetching its manifest and then downloading pieces
+from every peer that has them in parallel, rarest pieces first, verifying each piece against its hash before
+writing it to disk.
+
+Downloads are written to models/.partial/<model_id>/ together with a state file listing the verified pieces,
+so an interrupted download resumes where it left off, and pieces of a partial download are already served
+to other peers.
+
+A download is started from the node itself with POST /models/{model_id}/pull.
+"""
+
+import os
+import json
+import random
+import asyncio
+import hashlib
+import shutil
+from urllib.parse import quote
+from pydantic import BaseModel, Field, validator
+from typing import Optional, List, Dict, Tuple, Set, Any
+
+import anyio
+import httpx
+from starlette.responses import Response
+from starlette.types import Scope, Receive, Send
+
+from ...utils.logger import Logger
+
+from .model_manager import model_registry, model_path
+
+logger = Logger.get("models")
+
+
+partial_path = os.path.join(model_path, ".partial")
+
+
+class ManifestFile(BaseModel):
+    path: str = Field(..., max_length=1024)
+    size: int = Field(..., ge=0)
+    sha256: str = Field(..., regex=r"^[0-9a-f]{64}$")
+    pieces: List[str]
+
+    @validator("path")
+    def validate_path(cls, v: str) -> str:
+        """Rejects absolute paths and parent directory references sent by a malicious peer."""
+        normalized = os.path.normpath(v)
+        if os.path.isabs(normalized) or normalized.startswith("..") or normalized.startswith("."):
+            raise ValueError("Manifest file paths must be relative to the model directory")
+        return normalized
+
+    @validator("pieces", each_item=True)
+    def validate_piece(cls, v: str) -> str:
+        if len(v) != 64 or any(c not in "0123456789abcdef" for c in v):
+            raise ValueError("Piece hashes must be sha256 hex digests")
+        return v
+
+
+class Manifest(BaseModel):
+    model_id: str = Field(..., max_length=255)
+    checksum: str = Field(..., regex=r"^[0-9a-f]{64}$")
+    single_file: bool
+    piece_size: int = Field(..., gt=0, le=256 * 1024 * 1024)
+    files: List[ManifestFile]
+
+    @validator("model_id")
+    def validate_model_id(cls, v: str) -> str:
+        if v in ("", ".", "..") or v.startswith(".") or "/" in v or "\\" in v:
+            raise ValueError("Invalid model id")
+        return v
+
+    def pieces(self) -> List[Tuple[int, int, int, str]]:
+        """
+        Flattens the pieces of all files into a single list of (file index, offset, length, sha256), the
+        position of a piece in this list is its piece index.
+        """
+        pieces = []
+        for file_index, file in enumerate(self.files):
+            for piece_index, sha256 in enumerate(file.pieces):
+                offset = piece_index * self.piece_size
+                pieces.append(
+                    (file_index, offset, min(self.piece_size, file.size - offset), sha256)
+                )
+        return pieces
+
+
+class FileRangeResponse(Response):
+    """
+    Sends a byte range of a file, streamed in chunks read with os.pread in a worker thread so that the
+    response itself never reads a whole piece into memory. The ASGI zero-copy send extension is only
+    used when the server offers it and no BaseHTTPMiddleware wraps the app, neither is the case with
+    uvicorn and this app's middlewares.
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(
+        self,
+        path: str,
+        offset: int,
+        length: int,
+        status_code: int = 200,
+        headers: Optional[Dict[str, str]] = None,
+        on_complete=None,
+    ):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.status_code = status_code
+        self.media_type = "application/octet-stream"
+        self.background = None
+        self.on_complete = on_complete
+        self.init_headers(headers)
+        self.headers["content-length"] = str(length)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            file = await anyio.to_thread.run_sync(open, self.path, "rb")
+            try:
+                await send(
+                    {"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers}
+                )
+                if scope.get("method") == "HEAD":
+                    await send({"type": "http.response.body", "body": b"", "more_body": False})
+                elif "http.response.zerocopysend" in scope.get("extensions", {}):
+                    await send(
+                        {
+                            "type": "http.response.zerocopysend",
+                            "file": file,
+                            "offset": self.offset,
+                            "count": self.length,
+                            "more_body": False,
+                        }
+                    )
+                else:
+                    position, remaining = self.offset, self.length
+                    while remaining > 0:
+                        chunk = await anyio.to_thread.run_sync(
+                            os.pread, file.fileno(), min(self.chunk_size, remaining), position
+                        )
+                        if not chunk:
+                            break  # File was truncated while sending
+                        position += len(chunk)
+                        remaining -= len(chunk)
+                        await send(
+                            {"type": "http.response.body", "body": chunk, "more_body": remaining > 0}
+                        )
+                    if remaining > 0:
+                        await send({"type": "http.response.body", "body": b"", "more_body": False})
+            finally:
+                file.close()
+        finally:
+            if self.on_complete is not None:
+                self.on_complete()
+
+
+class ModelTransfer:
+    """
+    Serving side of model distribution, locates pieces of complete models and of partial downloads.
+    """
+
+    # model_id -> (checksum, piece sha256 -> (file path, offset, length))
+    _piece_index: Dict[str, Tuple[str, Dict[str, Tuple[str, int, int]]]] = {}
+
+    max_uploads = int(os.getenv("MODEL_MAX_UPLOADS", 8))
+    active_uploads = 0
+
+    # model_id -> background download started by start_pull
+    pulls: Dict[str, "asyncio.Task[bool]"] = {}
+
+    @staticmethod
+    def get_manifest(model_id: str) -> Optional[Manifest]:
+        """Returns the manifest of a complete or partially downloaded model."""
+        downloader = ModelDownloader.active.get(model_id)
+        if downloader is not None and downloader.manifest is not None:
+            return downloader.manifest
+
+        model = model_registry.get_model(model_id)
+        if model is None:
+            return None
+        manifest = model.manifest()
+        return Manifest(**manifest) if manifest is not None else None
+
+    @staticmethod
+    def get_available_pieces(model_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns which pieces of a model this node can serve, {"complete": True} for complete models or the
+        piece indices of a partial download, None if the model isn't available at all.
+        """
+        model = model_registry.get_model(model_id)
+        if model is not None and model.checksum is not None:
+            return {"checksum": model.checksum, "complete": True}
+        downloader = ModelDownloader.active.get(model_id)
+        if downloader is not None and downloader.manifest is not None:
+            return {
+                "checksum": downloader.manifest.checksum,
+                "complete": False,
+                "pieces": sorted(downloader.done),
+            }
+        return None
+
+    @staticmethod
+    def locate_piece(model_id: str, piece_hash: str) -> Optional[Tuple[str, int, int]]:
+        """
+        Finds a piece by its sha256, returning the file it is in with its offset and length.
+        """
+        model = model_registry.get_model(model_id)
+        if model is not None and model.checksum is not None:
+            cached = ModelTransfer._piece_index.get(model_id)
+            if cached is None or cached[0] != model.checksum:
+                manifest = Manifest(**model.manifest())
+                entry_path = os.path.join(model_path, model_id)
+                index = {}
+                for file_index, offset, length, sha256 in manifest.pieces():
+                    file = manifest.files[file_index]
+                    file_path = (
+                        entry_path if manifest.single_file else os.path.join(entry_path, file.path)
+                    )
+                    index.setdefault(sha256, (file_path, offset, length))
+                cached = (model.checksum, index)
+                ModelTransfer._piece_index[model_id] = cached
+            return cached[1].get(piece_hash)
+
+        downloader = ModelDownloader.active.get(model_id)
+        if downloader is not None:
+            return downloader.locate_piece(piece_hash)
+        return None
+
+    @staticmethod
+    def acquire_upload_slot() -> bool:
+        if ModelTransfer.active_uploads >= ModelTransfer.max_uploads:
+            return False
+        ModelTransfer.active_uploads += 1
+        return True
+
+    @staticmethod
+    def release_upload_slot():
+        ModelTransfer.active_uploads -= 1
+
+    @staticmethod
+    def parse_range(range_header: str, length: int) -> Optional[Tuple[int, int]]:
+        """
+        Parses a single "bytes=start-end" range header into an inclusive (start, end) tuple, returns None if
+        the range is invalid or can't be satisfied.
+        """
+        unit, _, byte_range = range_header.partition("=")
+        if unit.strip().lower() != "bytes" or "," in byte_range:
+            return None
+        start, _, end = byte_range.strip().partition("-")
+        try:
+            if start == "":
+                suffix = int(end)
+                if suffix <= 0:
+                    return None
+                return max(length - suffix, 0), length - 1
+            start = int(start)
+            end = int(end) if end else length - 1
+        except ValueError:
+            return None
+        if start > end or start >= length:
+            return None
+        return start, min(end, length - 1)
+
+    @staticmethod
+    def start_pull(model_id: str) -> Dict[str, Any]:
+        """
+        Starts downloading a model from the peers hosting it in the background, unless it is already hosted
+        or being downloaded. Raises ValueError for an invalid model id.
+
+        Returns:
+        - Dict[str, Any]: The state of the model, "hosted", "started" or "downloading", and the number of
+          pieces downloaded so far once the manifest has been fetched.
+        """
+        Manifest.validate_model_id(model_id)
+        if model_registry.get_model(model_id) is not None:
+            return {"state": "hosted"}
+
+        state = "downloading"
+        task = ModelTransfer.pulls.get(model_id)
+        if (task is None or task.done()) and model_id not in ModelDownloader.active:
+            state = "started"
+            task = ModelTransfer.pulls[model_id] = asyncio.create_task(ModelTransfer.pull(model_id))
+            task.add_done_callback(
+                lambda done: ModelTransfer.pulls.pop(model_id, None)
+                if ModelTransfer.pulls.get(model_id) is done
+                else None
+            )
+
+        progress = {"state": state}
+        downloader = ModelDownloader.active.get(model_id)
+        if downloader is not None and downloader.manifest is not None:
+            progress.update(pieces=len(downloader.pieces), downloaded=len(downloader.done))
+        return progress
+
+    @staticmethod
+    async def pull(model_id: str) -> bool:
+        """
+        Downloads a model from every known peer advertising it in their capability manifest.
+        """
+        from ..pex import PexMongo
+        from ...utils.capabilities import Capabilities
+
+        peers = await PexMongo.get_capable_peers(Capabilities.Requirements(models=[model_id]))
+        if not peers:
+            logger.warning("No known peers are hosting model '%s'.", model_id)
+            return False
+        return await ModelDownloader(model_id, peers).run()
+
+
+class ModelDownloader:
+    """
+    Downloads a model's pieces from multiple peers in parallel.
+
+    Every peer gets MODEL_DOWNLOAD_CONNECTIONS concurrent connections, each connection repeatedly picks the
+    rarest piece among the peers that is still needed, not already being downloaded and available on its
+    peer. Pieces are verified against their sha256 before being written, peers that fail repeatedly or send
+    bad pieces are dropped. Verified pieces are recorded in a state file so interrupted downloads resume.
+    """
+
+    active: Dict[str, "ModelDownloader"] = {}
+
+    max_peer_failures = 3
+    save_state_every = 16
+
+    def __init__(
+        self,
+        model_id: str,
+        peers: List[Any],
+        connections_per_peer: Optional[int] = None,
+        timeout: float = 60.0,
+    ):
+        self.model_id = model_id
+        self.peers = {f"http://{peer.ip}:{peer.port}": None for peer in peers}  # url -> available pieces
+        self.connections_per_peer = connections_per_peer or int(
+            os.getenv("MODEL_DOWNLOAD_CONNECTIONS", 4)
+        )
+        self.timeout = timeout
+        self.download_dir = os.path.join(partial_path, model_id)
+        self.state_file = os.path.join(self.download_dir, "state.json")
+        self.manifest: Optional[Manifest] = None
+        self.pieces: List[Tuple[int, int, int, str]] = []
+        self.done: Set[int] = set()
+        self.in_flight: Set[int] = set()
+        self.rarity: Dict[int, int] = {}  # piece index -> number of peers that have it
+        self.failures: Dict[str, int] = {}
+        self.unsaved = 0
+
+    def file_path(self, file_index: int) -> str:
+        return os.path.join(self.download_dir, "data", self.manifest.files[file_index].path)
+
+    def locate_piece(self, piece_hash: str) -> Optional[Tuple[str, int, int]]:
+        for index in self.done:
+            file_index, offset, length, sha256 = self.pieces[index]
+            if sha256 == piece_hash:
+                return self.file_path(file_index), offset, length
+        return None
+
+    def peer_url(self, peer: str, suffix: str = "") -> str:
+        return f"{peer}/models/{quote(self.model_id, safe='')}{suffix}"
+
+    async def run(self) -> bool:
+        """
+        Downloads the model into models/, returns True once every piece has been downloaded and verified.
+        """
+        if self.model_id in ModelDownloader.active or model_registry.get_model(self.model_id):
+            return False  # Already downloading or already hosted
+
+        ModelDownloader.active[self.model_id] = self
+        try:
+            async with httpx.AsyncClient(timeout=self.timeout) as client:
+                self.manifest = await self.fetch_manifest(client)
+                if self.manifest is None:
+                    logger.warning("Could not fetch a manifest for model '%s' from any peer.", self.model_id)
+                    return False
+                self.pieces = self.manifest.pieces()
+                await anyio.to_thread.run_sync(self.prepare)
+
+                await asyncio.gather(*(self.fetch_available(client, peer) for peer in self.peers))
+                workers = [
+                    self.worker(client, peer)
+                    for peer, available in self.peers.items()
+                    if available is not None
+                    for _ in range(self.connections_per_peer)
+                ]
+                await asyncio.gather(*workers)
+
+            await anyio.to_thread.run_sync(self.save_state)
+            if len(self.done) != len(self.pieces):
+                logger.warning(
+                    "Download of model '%s' incomplete, %d/%d pieces. Resume by downloading it again.",
+                    self.model_id,
+                    len(self.done),
+                    len(self.pieces),
+                )
+                return False
+
+            await anyio.to_thread.run_sync(self.finalize)
+            logger.info("Downloaded model '%s', %d pieces verified.", self.model_id, len(self.pieces))
+            return True
+        finally:
+            ModelDownloader.active.pop(self.model_id, None)
+            await model_registry.refresh()
+
+    async def fetch_manifest(self, client: httpx.AsyncClient) -> Optional[Manifest]:
+        for peer in self.peers:
+            try:
+                response = await client.get(self.peer_url(peer, "/manifest"))
+                response.raise_for_status()
+                manifest = Manifest(**response.json()["content"]["manifest"])
+                if manifest.model_id != self.model_id:
+                    raise ValueError(f"Peer sent the manifest of model '{manifest.model_id}'")
+                return manifest
+            except Exception as e:
+                logger.warning("Failed to fetch manifest of '%s' from %s: %s", self.model_id, peer, e)
+        return None
+
+    async def fetch_available(self, client: httpx.AsyncClient, peer: str):
+        """Fetches which pieces a peer has, peers without the model or with a different manifest are skipped."""
+        try:
+            response = await client.get(self.peer_url(peer, "/have"))
+            response.raise_for_status()
+            content = response.json()["content"]
+            if content.get("checksum") != self.manifest.checksum:
+                self.peers[peer] = None
+            elif content.get("complete"):
+                self.peers[peer] = set(range(len(self.pieces)))
+            else:
+                self.peers[peer] = {i for i in content.get("pieces", []) if 0 <= i < len(self.pieces)}
+        except Exception as e:
+            logger.warning("Failed to fetch available pieces of '%s' from %s: %s", self.model_id, peer, e)
+            self.peers[peer] = None
+        self.update_rarity()
+
+    def update_rarity(self):
+        self.rarity = {}
+        for pieces in self.peers.values():
+            for index in pieces or ():
+                self.rarity[index] = self.rarity.get(index, 0) + 1
+
+    def prepare(self):
+        """
+        Creates the partial files, resuming from the state file if it belongs to the same manifest. Pieces
+        listed in the state file are verified again since they may not have been flushed before a crash.
+        """
+        try:
+            with open(self.state_file, "r") as file:
+                state = json.load(file)
+        except (FileNotFoundError, ValueError):
+            state = {}
+
+        if state.get("checksum") != self.manifest.checksum:
+            shutil.rmtree(self.download_dir, ignore_errors=True)
+            state = {}
+
+        for file_index, manifest_file in enumerate(self.manifest.files):
+            file_path = self.file_path(file_index)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "ab") as file:
+                file.truncate(manifest_file.size)
+
+        for index in state.get("pieces", []):
+            if 0 <= index < len(self.pieces) and self.verify_written_piece(index):
+                self.done.add(index)
+
+        if self.done:
+            logger.info(
+                "Resuming download of model '%s' with %d/%d pieces.", self.model_id, len(self.done), len(self.pieces)
+            )
+
+    def verify_written_piece(self, index: int) -> bool:
+        file_index, offset, length, sha256 = self.pieces[index]
+        with open(self.file_path(file_index), "rb") as file:
+            return hashlib.sha256(os.pread(file.fileno(), length, offset)).hexdigest() == sha256
+
+    def write_piece(self, index: int, data: bytes):
+        file_index, offset, _, _ = self.pieces[index]
+        with open(self.file_path(file_index), "r+b") as file:
+            os.pwrite(file.fileno(), data, offset)
+
+    def save_state(self):
+        temp_file = f"{self.state_file}.tmp"
+        with open(temp_file, "w") as file:
+            json.dump({"checksum": self.manifest.checksum, "pieces": sorted(self.done)}, file)
+        os.replace(temp_file, self.state_file)
+
+    def finalize(self):
+        """Moves the completed files into models/ and removes the partial download."""
+        data_path = os.path.join(self.download_dir, "data")
+        source = self.file_path(0) if self.manifest.single_file else data_path
+        os.replace(source, os.path.join(model_path, self.model_id))
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+
+    def next_piece(self, peer: str) -> Optional[int]:
+        """Picks the rarest needed piece this peer has, ties are broken randomly so peers spread out."""
+        available = self.peers.get(peer)
+        if not available:
+            return None
+
+        best, best_key = None, None
+        for index in available:
+            if index in self.done or index in self.in_flight:
+                continue
+            key = (self.rarity.get(index, 0), random.random())
+            if best_key is None or key < best_key:
+                best, best_key = index, key
+        return best
+
+    async def worker(self, client: httpx.AsyncClient, peer: str):
+        while len(self.done) < len(self.pieces) and self.peers.get(peer) is not None:
+            index = self.next_piece(peer)
+            if index is None:
+                if self.peers[peer] == set(range(len(self.pieces))) or not self.in_flight:
+                    return  # Nothing left that this peer could give us
+                # A partial peer may have gained pieces or another connection may fail its piece
+                await asyncio.sleep(2)
+                await self.fetch_available(client, peer)
+                continue
+
+            self.in_flight.add(index)
+            try:
+                _, _, length, sha256 = self.pieces[index]
+                response = await client.get(self.peer_url(peer, f"/pieces/{sha256}"))
+                if response.status_code == 503:
+                    await asyncio.sleep(1)  # Peer is at its upload limit
+                    continue
+                response.raise_for_status()
+                data = response.content
+                if len(data) != length or hashlib.sha256(data).hexdigest() != sha256:
+                    raise ValueError(f"piece {index} failed verification")
+
+                await anyio.to_thread.run_sync(self.write_piece, index, data)
+                self.done.add(index)
+                self.unsaved += 1
+                if self.unsaved >= self.save_state_every:
+                    self.unsaved = 0
+                    await anyio.to_thread.run_sync(self.save_state)
+            except Exception as e:
+                self.failures[peer] = self.failures.get(peer, 0) + 1
+                logger.warning("Failed to download piece %d of '%s' from %s: %s", index, self.model_id, peer, e)
+                if self.failures[peer] >= self.max_peer_failures:
+                    logger.warning("Dropping %s from the download of '%s'.", peer, self.model_id)
+                    self.peers[peer] = None
+                    self.update_rarity()
+            finally:
+                self.in_flight.discard(index)
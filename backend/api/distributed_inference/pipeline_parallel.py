@@ -0,0 +1,297 @@
+"""
+Pipeline parallel inference, a model is split into contiguous blocks of layers hosted by different peers so
+that models larger than the memory of any single peer can be served by the network.
+
+A peer hosts layers [start, end) of a model (PIPELINE_SHARDS env var) and advertises them in its capability
+manifest. The coordinator builds a route through hosting peers that covers every layer of the model and
+sends the input to the first peer, each peer runs its layers and streams the activations straight to the
+next peer in the route, the last peer's output travels back along the chain to the coordinator.
+
+Models are defined in code with PipelineParallel.register_model, a definition knows its number of layers
+and how to build any contiguous block of them so that a peer never has to build the whole model.
+"""
+
+import json
+import random
+import threading
+from urllib.parse import quote, urlsplit
+from pydantic import BaseModel, Field
+from typing import Callable, Dict, List, Optional, Tuple, Any
+
+import httpx
+
+from ...utils import Utils
+from ...utils.capabilities import Capabilities
+from ...utils.logger import Logger
+
+torch = Utils.LazyImport("torch")
+logger = Logger.get("inference")
+
+
+class ShardDefinition(BaseModel):
+    num_layers: int = Field(..., gt=0)
+    # build_layers(start, end) -> list of end - start torch modules, one per layer
+    build_layers: Callable[[int, int], List[Any]]
+
+
+class RouteHop(BaseModel):
+    url: str
+    start: int = Field(..., ge=0)
+    end: int = Field(..., gt=0)
+
+
+class PipelineParallel:
+    """
+    Hosts this node's shards and (de)serializes activations sent between peers.
+    """
+
+    definitions: Dict[str, ShardDefinition] = {}
+    _shards: Dict[str, Tuple[int, Any]] = {}  # model_id -> (first layer, torch.nn.ModuleList)
+    _lock = threading.Lock()
+
+    # Headers carrying the activations' metadata and the rest of the route between peers.
+    dtype_header = "X-Tensor-Dtype"
+    shape_header = "X-Tensor-Shape"
+    route_header = "X-Pipeline-Route"
+
+    @staticmethod
+    def register_model(
+        model_id: str, num_layers: int, build_layers: Callable[[int, int], List[Any]]
+    ):
+        PipelineParallel.definitions[model_id] = ShardDefinition(
+            num_layers=num_layers, build_layers=build_layers
+        )
+
+    @staticmethod
+    def get_shard(model_id: str) -> Tuple[int, Any]:
+        """
+        Builds the layers this node hosts for a model on first use. Blocking, don't call from the event loop.
+        """
+        with PipelineParallel._lock:
+            shard = PipelineParallel._shards.get(model_id)
+            if shard is None:
+                hosted = Capabilities.get_manifest().shards.get(model_id)
+                definition = PipelineParallel.definitions.get(model_id)
+                if hosted is None or definition is None:
+                    raise KeyError(f"This node doesn't host layers of model '{model_id}'")
+                if hosted.end > definition.num_layers:
+                    raise ValueError(
+                        f"Model '{model_id}' only has {definition.num_layers} layers, "
+                        f"can't host {hosted.start}-{hosted.end}"
+                    )
+
+                layers = torch.nn.ModuleList(definition.build_layers(hosted.start, hosted.end))
+                layers.eval()
+                shard = (hosted.start, layers)
+                PipelineParallel._shards[model_id] = shard
+        return shard
+
+    @staticmethod
+    def forward(model_id: str, start: int, end: int, activations):
+        """
+        Runs layers [start, end) of a model on the given activations, the range must be within the
+        block this node hosts.
+        """
+        first_layer, layers = PipelineParallel.get_shard(model_id)
+        if start < first_layer or end > first_layer + len(layers) or start >= end:
+            raise ValueError(
+                f"Layers {start}-{end} of '{model_id}' aren't hosted here, "
+                f"hosting {first_layer}-{first_layer + len(layers)}"
+            )
+
+        with torch.inference_mode():
+            for layer in layers[start - first_layer : end - first_layer]:
+                activations = layer(activations)
+        return activations
+
+    @staticmethod
+    def serialize(tensor) -> Tuple[bytes, Dict[str, str]]:
+        """Serializes a tensor to its raw bytes, the dtype and shape are sent as headers."""
+        tensor = tensor.detach().to("cpu").contiguous()
+        headers = {
+            PipelineParallel.dtype_header: str(tensor.dtype).replace("torch.", ""),
+            PipelineParallel.shape_header: ",".join(str(dim) for dim in tensor.shape),
+        }
+        return tensor.reshape(-1).view(torch.uint8).numpy().tobytes(), headers
+
+    @staticmethod
+    def deserialize(data: bytes, headers) -> Any:
+        dtype_name = headers.get(PipelineParallel.dtype_header, "")
+        dtype = getattr(torch, dtype_name, None)
+        if not isinstance(dtype, torch.dtype):
+            raise ValueError(f"Unsupported tensor dtype '{dtype_name}'")
+
+        shape_header = headers.get(PipelineParallel.shape_header, "")
+        shape = [int(dim) for dim in shape_header.split(",")] if shape_header else []
+        if not data:
+            return torch.empty(shape, dtype=dtype)
+        return torch.frombuffer(bytearray(data), dtype=torch.uint8).view(dtype).reshape(shape)
+
+    @staticmethod
+    def encode_route(route: List[RouteHop]) -> str:
+        return json.dumps([hop.dict() for hop in route], separators=(",", ":"))
+
+    @staticmethod
+    def decode_route(header: str) -> List[RouteHop]:
+        if not header:
+            return []
+        hops = json.loads(header)
+        if not isinstance(hops, list) or not all(isinstance(hop, dict) for hop in hops):
+            raise ValueError("The route must be a list of hops")
+        return [RouteHop(**hop) for hop in hops]
+
+
+class PipelineCoordinator:
+    """
+    Builds routes through peers hosting blocks of a model's layers and runs inference along them.
+    """
+
+    max_attempts = 3
+
+    @staticmethod
+    def build_route(
+        num_layers: int, hosts: List[Tuple[str, int, int]], exclude: Optional[set] = None
+    ) -> List[RouteHop]:
+        """
+        Builds the shortest chain of hosts covering layers [0, num_layers). At every layer the host that
+        covers it and reaches furthest is picked, ties are broken randomly to spread load between peers
+        hosting the same block.
+
+        Parameters:
+        - num_layers (int): Number of layers of the model.
+        - hosts (List[Tuple[str, int, int]]): (peer url, start, end) of every hosted block.
+        - exclude (set): Peer urls to leave out, e.g. peers that just failed.
+
+        Raises:
+        - ValueError: If the hosts don't cover every layer.
+        """
+        exclude = exclude or set()
+        route = []
+        position = 0
+        while position < num_layers:
+            candidates = [
+                (min(end, num_layers), random.random(), url)
+                for url, start, end in hosts
+                if url not in exclude and start <= position < end
+            ]
+            if not candidates:
+                raise ValueError(f"No reachable peer hosts layer {position}")
+            end, _, url = max(candidates)
+            route.append(RouteHop(url=url, start=position, end=end))
+            position = end
+        return route
+
+    @staticmethod
+    async def get_hosts(model_id: str, ips: Optional[List[str]] = None) -> List[Tuple[str, int, int]]:
+        """
+        Collects the blocks of a model advertised by known peers and by this node, only by the peers of
+        the given ips if any are given.
+        """
+        from ..pex import PexMongo
+
+        peers = await PexMongo.get_all_peers() if ips is None else await PexMongo.get_peers(ips)
+        hosts = []
+        for peer in peers:
+            shard = peer.capabilities.shards.get(model_id) if peer.capabilities else None
+            if shard is not None:
+                hosts.append((f"http://{peer.ip}:{peer.port}", shard.start, shard.end))
+        return hosts
+
+    @staticmethod
+    async def check_route(model_id: str, route: List[RouteHop]) -> None:
+        """
+        Checks that every hop of a route received from another peer is a known peer advertising a block of
+        the model that covers the hop's layers. The route comes from the caller, without this check any
+        client could make this node send requests to arbitrary hosts.
+
+        Raises:
+        - ValueError: If a hop isn't a known host of its layers.
+        """
+        if not route:
+            return
+        # Only the hops' peers are read, on the unique ip index, since this runs on every hop of every pass
+        ips = [urlsplit(hop.url).hostname or "" for hop in route]
+        hosts = await PipelineCoordinator.get_hosts(model_id, ips)
+        for hop in route:
+            if not any(
+                url == hop.url and start <= hop.start < hop.end <= end for url, start, end in hosts
+            ):
+                raise ValueError(
+                    f"Route hop {hop.url} layers {hop.start}-{hop.end} isn't a known host of '{model_id}'"
+                )
+
+    @staticmethod
+    async def run(
+        model_id: str,
+        inputs,
+        hosts: Optional[List[Tuple[str, int, int]]] = None,
+        timeout: float = 120.0,
+    ):
+        """
+        Runs a pipeline parallel model on the given input tensor, failing over to other hosts if a peer
+        in the route fails.
+
+        Parameters:
+        - model_id (str): The model to run, must be registered with PipelineParallel.register_model.
+        - inputs (torch.Tensor): Input of the first layer.
+        - hosts (List[Tuple[str, int, int]]): (peer url, start, end) of hosted blocks, looked up from the
+          peers' capability manifests if not given.
+
+        Returns:
+        - torch.Tensor: Output of the last layer.
+        """
+        definition = PipelineParallel.definitions.get(model_id)
+        if definition is None:
+            raise KeyError(f"Unknown pipeline parallel model '{model_id}'")
+        if hosts is None:
+            hosts = await PipelineCoordinator.get_hosts(model_id)
+
+        body, headers = PipelineParallel.serialize(inputs)
+        failed = set()
+        last_error = None
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            for _ in range(PipelineCoordinator.max_attempts):
+                route = PipelineCoordinator.build_route(definition.num_layers, hosts, exclude=failed)
+                first, rest = route[0], route[1:]
+                try:
+                    response = await client.post(
+                        f"{first.url}/shards/{quote(model_id, safe='')}/forward",
+                        params={"start": first.start, "end": first.end},
+                        content=body,
+                        headers={
+                            **headers,
+                            PipelineParallel.route_header: PipelineParallel.encode_route(rest),
+                        },
+                    )
+                    response.raise_for_status()
+                    return PipelineParallel.deserialize(response.content, response.headers)
+                except httpx.HTTPError as e:
+                    last_error = e
+                    # The peer that failed reports itself in the error response, otherwise blame the first hop
+                    failed_url = (
+                        e.response.headers.get("X-Failed-Peer", first.url)
+                        if isinstance(e, httpx.HTTPStatusError)
+                        else first.url
+                    )
+                    logger.warning("Pipeline route for '%s' failed at %s: %s", model_id, failed_url, e)
+                    failed.add(failed_url)
+        raise RuntimeError(f"Pipeline inference of '{model_id}' failed: {last_error}")
+
+
+def build_tiny_mlp_layers(start: int, end: int) -> List[Any]:
+    """
+    Small deterministic model used to test pipeline parallelism on the cpu, every layer's weights are
+    seeded by its index so peers building different blocks agree on the same model.
+    """
+    layers = []
+    for index in range(start, end):
+        generator = torch.Generator().manual_seed(index)
+        linear = torch.nn.Linear(64, 64)
+        with torch.no_grad():
+            linear.weight.copy_(torch.randn(64, 64, generator=generator) / 8)
+            linear.bias.copy_(torch.randn(64, generator=generator) / 8)
+        layers.append(torch.nn.Sequential(linear, torch.nn.Tanh()))
+    return layers
+
+
+PipelineParallel.register_model("tiny-mlp", num_layers=8, build_layers=build_tiny_mlp_layers)
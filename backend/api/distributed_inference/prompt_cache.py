@@ -0,0 +1,178 @@
+"""
+Prompt prefix cache for gpt4all chat models.
+
+Clients keep track of the chat session and resend the whole conversation every turn, so without a cache
+the model would prefill the entire history again for each reply and the time to the first token would
+grow with the length of the chat. gpt4all keeps the KV state of everything it has processed in the
+context of a GPT4All instance, so instead of copying that state around the cache keeps instances alive
+together with the text their context holds. A follow-up turn is given the instance whose context is the
+longest prefix of its prompt and only the new messages are prefilled.
+"""
+
+import os
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Any
+
+from ...utils.cache import LRUCache
+from ...utils.capabilities import Capabilities
+from ...utils.metrics import Tracing
+from . import InferenceMetrics
+from .model_manager import ModelLoader
+
+MiB = 1024 * 1024
+
+
+class PromptSession:
+    """
+    A GPT4All instance inside a raw chat session, prompts are passed to the model unformatted and every
+    generate call continues the context of the previous one instead of resetting it. text is everything
+    the instance's context holds, prompts and generated tokens.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.text = ""
+        self._chat = model.chat_session(system_prompt="", prompt_template="{0}")
+        self._chat.__enter__()
+
+    def generate(self, prompt: str, callback: Optional[Callable[[int, str], bool]] = None, **kwargs) -> str:
+        """
+        Continues the context with prompt and generates a reply. callback(token_id, text) is called for
+        every generated token, returning False stops the generation early. Not thread safe, a session is
+        only used by one generation at a time.
+        """
+        self.text += prompt
+        if callback is not None:
+            kwargs["callback"] = callback
+        response = self.model.generate(prompt=prompt, streaming=False, **kwargs)
+        self.text += response
+        return response
+
+    def close(self):
+        self._chat.__exit__(None, None, None)
+        self.model = None
+
+
+class PromptCache:
+    """
+    Per model LRU cache of PromptSessions keyed by a hash of the text in their context, bounded by a
+    memory budget. Each cached session costs about the size of a full model context (KV_CACHE_ENTRY_MB),
+    the weights themselves are memory mapped and shared between all instances.
+
+    Sessions are taken out of the cache while they generate and put back under the key of their new text
+    afterwards, at most MAX_CONCURRENCY generations run at once per model. The budget always fits at least
+    MAX_CONCURRENCY sessions so that the cache doubles as the pool of loaded instances.
+    """
+
+    entry_bytes = int(os.getenv("KV_CACHE_ENTRY_MB", 256)) * MiB
+    budget_bytes = int(os.getenv("KV_CACHE_MB", 1024)) * MiB
+
+    # gpt4all's default context length. Once a context is full gpt4all drops its oldest tokens, the
+    # session then no longer holds its whole text so it isn't cached. Tokens are estimated from the
+    # number of characters, erring on the side of too many tokens.
+    context_tokens = 2048
+    chars_per_token = 3
+
+    _caches: Dict[str, LRUCache] = {}
+    _semaphores: Dict[str, threading.BoundedSemaphore] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        return hashlib.sha256(f"{model_name}\0{text}".encode()).hexdigest()
+
+    @staticmethod
+    def get_cache(model_name: str):
+        with PromptCache._lock:
+            cache = PromptCache._caches.get(model_name)
+            if cache is None:
+                max_concurrency = max(Capabilities.get_manifest().max_concurrency, 1)
+                cache = PromptCache._caches[model_name] = LRUCache(
+                    max(PromptCache.budget_bytes, max_concurrency * PromptCache.entry_bytes),
+                    on_evict=lambda key, session: session.close(),
+                )
+                PromptCache._semaphores[model_name] = threading.BoundedSemaphore(max_concurrency)
+            return cache, PromptCache._semaphores[model_name]
+
+    @staticmethod
+    def warm(model_name: str) -> None:
+        """
+        Loads an instance of the model into the cache with an empty context before the first request, so
+        that the first chat doesn't wait for the model to load. Blocking, don't call from the event loop.
+        """
+        cache, _ = PromptCache.get_cache(model_name)
+        key = PromptCache.key(model_name, "")
+        if key in cache:
+            return
+        cache.put(key, PromptSession(ModelLoader.load_gpt4all(model_name)), PromptCache.entry_bytes)
+
+    @staticmethod
+    def cacheable(session: PromptSession) -> bool:
+        return len(session.text) < PromptCache.context_tokens * PromptCache.chars_per_token
+
+    @staticmethod
+    @contextmanager
+    def session(model_name: str, prompt: str, boundaries: List[int]) -> Iterator[Any]:
+        """
+        Borrows the session whose context is the longest cached prefix of the prompt. Blocks until a
+        generation slot is free, don't call from the event loop.
+
+        Parameters:
+        - model_name (str): The gpt4all model file.
+        - prompt (str): The full formatted prompt.
+        - boundaries (List[int]): Offsets in the prompt where a cached context may end, e.g. the end of
+          every message's content. Only these prefixes are looked up.
+
+        Yields:
+        - (PromptSession, str): The session and the part of the prompt its context doesn't hold yet, pass
+          that suffix to PromptSession.generate.
+        """
+        cache, semaphore = PromptCache.get_cache(model_name)
+        with Tracing.span("inference.queue_wait"), InferenceMetrics.queue_wait.time(model=model_name):
+            semaphore.acquire()
+        session = None
+        try:
+            # The empty prefix matches instances whose context was reset
+            for boundary in sorted(set(boundaries) | {0}, reverse=True):
+                prefix = prompt[:boundary]
+                cached = cache.pop(PromptCache.key(model_name, prefix))
+                if cached is not None:
+                    if cached.text == prefix:
+                        session = cached
+                        break
+                    cached.close()
+
+            if session is None:
+                # Reuse the least recently used instance rather than loading another one once the budget
+                # is used up, its context is reset when the new chat session starts.
+                lru = (
+                    cache.pop_lru()
+                    if cache.size + PromptCache.entry_bytes > cache.max_bytes
+                    else None
+                )
+                if lru is not None:
+                    model = lru[1].model
+                    lru[1].close()
+                else:
+                    model = ModelLoader.load_gpt4all(model_name)
+                session = PromptSession(model)
+
+            completed = False
+            try:
+                yield session, prompt[len(session.text) :]
+                completed = True
+            finally:
+                if completed and PromptCache.cacheable(session):
+                    key = PromptCache.key(model_name, session.text)
+                else:
+                    # A failed generation leaves the context in an unknown state and a full context no
+                    # longer holds its whole text, keep the instance but reset its context.
+                    model = session.model
+                    session.close()
+                    session = PromptSession(model)
+                    key = PromptCache.key(model_name, "")
+                cache.put(key, session, PromptCache.entry_bytes)
+        finally:
+            semaphore.release()
@@ -0,0 +1,208 @@
+"""
+Opt-in cache of inference results (RESPONSE_CACHE env var) so that repeated requests, e.g. popular prompts
+of demo traffic, cost a lookup instead of running the model again.
+
+Results are keyed by a hash of the canonical json of the endpoint, model, input and sampling parameters.
+Endpoints only cache requests whose result is reproducible, e.g. greedy sampling for text. Results are
+kept in an in-memory LRU and images are also written to a disk tier, both tiers are bounded by size and
+entries expire after RESPONSE_CACHE_TTL seconds.
+
+Callers control caching with the Cache-Control request header:
+- no-store: the cache is neither read nor written.
+- no-cache: the result is computed again and the cached entry replaced.
+- max-age=N: only cached results younger than N seconds are returned.
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from pydantic import BaseModel
+from typing import Any, Dict, Optional
+
+from fastapi import Response
+
+from ...utils.cache import LRUCache
+
+MiB = 1024 * 1024
+
+
+class CachedResponse(BaseModel):
+    body: bytes
+    media_type: str
+    created: float
+
+
+class CacheControl(BaseModel):
+    no_store: bool = False
+    no_cache: bool = False
+    max_age: Optional[int] = None
+
+    @staticmethod
+    def parse(header: Optional[str]) -> "CacheControl":
+        directives = CacheControl()
+        for directive in (header or "").lower().split(","):
+            name, _, value = directive.strip().partition("=")
+            if name == "no-store":
+                directives.no_store = True
+            elif name == "no-cache":
+                directives.no_cache = True
+            elif name == "max-age" and value.strip('"').isdigit():
+                directives.max_age = int(value.strip('"'))
+        return directives
+
+
+class ResponseCache:
+    enabled = os.getenv("RESPONSE_CACHE", "false").lower() in ("1", "true", "yes")
+    ttl = int(os.getenv("RESPONSE_CACHE_TTL", 3600))
+    memory = LRUCache(int(os.getenv("RESPONSE_CACHE_MB", 256)) * MiB)
+
+    disk_path = os.getenv("RESPONSE_CACHE_DIR", os.path.join(".cache", "responses"))
+    disk_bytes = int(os.getenv("RESPONSE_CACHE_DISK_MB", 2048)) * MiB
+    _disk_lock = threading.Lock()
+    _disk_usage: Optional[int] = None  # Computed on first disk write
+
+    @staticmethod
+    def key(endpoint: str, model: str, inputs: Dict[str, Any]) -> str:
+        canonical = json.dumps(
+            {"endpoint": endpoint, "model": model, "inputs": inputs},
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    @staticmethod
+    def use_for(cache_control: CacheControl) -> bool:
+        """Returns False if the cache is disabled on this node or the caller asked for no-store."""
+        return ResponseCache.enabled and not cache_control.no_store
+
+    @staticmethod
+    async def get(key: str, cache_control: CacheControl) -> Optional[Response]:
+        """
+        Returns the cached response of a key, or None if there is no fresh entry or the caller asked
+        for the result to be computed again.
+        """
+        if not ResponseCache.use_for(cache_control) or cache_control.no_cache:
+            return None
+
+        entry = ResponseCache.memory.get(key)
+        if entry is None:
+            entry = await asyncio.to_thread(ResponseCache.read_disk, key)
+            if entry is not None:
+                ResponseCache.memory.put(key, entry, len(entry.body))
+        if entry is None:
+            return None
+
+        age = time.time() - entry.created
+        max_age = ResponseCache.ttl
+        if cache_control.max_age is not None:
+            max_age = min(max_age, cache_control.max_age)
+        if age > max_age:
+            if age > ResponseCache.ttl:
+                ResponseCache.memory.pop(key)
+            return None
+
+        return Response(
+            content=entry.body,
+            media_type=entry.media_type,
+            headers={"X-Cache": "HIT", "Age": str(int(age))},
+        )
+
+    @staticmethod
+    async def put(key: str, response: Response, persist: bool = False) -> None:
+        """
+        Caches the body of a response in memory, and on disk too when persist is set. Only responses with
+        a complete body can be cached, not streaming responses.
+        """
+        entry = CachedResponse(body=response.body, media_type=response.media_type, created=time.time())
+        ResponseCache.memory.put(key, entry, len(entry.body))
+        response.headers["X-Cache"] = "MISS"
+        if persist:
+            await asyncio.to_thread(ResponseCache.write_disk, key, entry)
+
+    @staticmethod
+    def entry_paths(key: str):
+        base = os.path.join(ResponseCache.disk_path, key[:2], key)
+        return f"{base}.json", f"{base}.bin"
+
+    @staticmethod
+    def read_disk(key: str) -> Optional[CachedResponse]:
+        meta_path, body_path = ResponseCache.entry_paths(key)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            if time.time() - meta["created"] > ResponseCache.ttl:
+                return None  # Removed by the next eviction
+            with open(body_path, "rb") as f:
+                body = f.read()
+            os.utime(meta_path)  # Marks the entry as recently used for eviction
+        except (OSError, ValueError, KeyError):
+            return None
+        return CachedResponse(body=body, media_type=meta["media_type"], created=meta["created"])
+
+    @staticmethod
+    def write_disk(key: str, entry: CachedResponse) -> None:
+        meta_path, body_path = ResponseCache.entry_paths(key)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        with ResponseCache._disk_lock:
+            if ResponseCache._disk_usage is None:
+                ResponseCache._disk_usage = sum(
+                    size for _, _, size in ResponseCache.list_disk_entries()
+                )
+            ResponseCache._disk_usage -= ResponseCache.remove_disk(key)
+
+            # Body first, an entry only exists once its metadata is written
+            meta = {"media_type": entry.media_type, "created": entry.created}
+            for path, data in ((body_path, entry.body), (meta_path, json.dumps(meta).encode())):
+                temp_path = f"{path}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            ResponseCache._disk_usage += len(entry.body)
+
+            if ResponseCache._disk_usage > ResponseCache.disk_bytes:
+                ResponseCache.evict_disk(keep=key)
+
+    @staticmethod
+    def list_disk_entries():
+        """Yields (last used, key, size) of every entry in the disk tier."""
+        if not os.path.isdir(ResponseCache.disk_path):
+            return
+        for directory in os.scandir(ResponseCache.disk_path):
+            if not directory.is_dir():
+                continue
+            for item in os.scandir(directory.path):
+                if not item.name.endswith(".json"):
+                    continue
+                key = item.name[: -len(".json")]
+                try:
+                    size = os.path.getsize(ResponseCache.entry_paths(key)[1])
+                    yield item.stat().st_mtime, key, size
+                except OSError:
+                    continue
+
+    @staticmethod
+    def evict_disk(keep: str) -> None:
+        """Removes expired entries then the least recently used ones until the disk tier fits its budget."""
+        now = time.time()
+        for last_used, key, size in sorted(ResponseCache.list_disk_entries()):
+            expired = now - last_used > ResponseCache.ttl
+            if key == keep or (not expired and ResponseCache._disk_usage <= ResponseCache.disk_bytes):
+                continue
+            ResponseCache._disk_usage -= ResponseCache.remove_disk(key)
+
+    @staticmethod
+    def remove_disk(key: str) -> int:
+        """Removes an entry from the disk tier and returns the size of its body."""
+        size = 0
+        for path in ResponseCache.entry_paths(key):
+            try:
+                if path.endswith(".bin"):
+                    size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                pass
+        return size
@@ -0,0 +1,108 @@
+# Runs this peer's block of layers of a pipeline parallel model and streams the activations on to the next peer in the route.
+
+from typing import Dict, Any
+from urllib.parse import quote
+
+import httpx
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from ...utils.capabilities import Capabilities
+from ...utils.logger import Logger
+from .pipeline_parallel import PipelineParallel, PipelineCoordinator
+
+logger = Logger.get("inference")
+
+router = APIRouter()
+requirements = Capabilities.Requirements(inference=True, libraries=["torch"])
+
+# Headers of the downstream response relayed back along the route
+relayed_headers = [PipelineParallel.dtype_header, PipelineParallel.shape_header, "X-Failed-Peer"]
+
+
+@router.get(
+    "/shards",
+    tags=["Distributed Inference"],
+    summary="List hosted model shards",
+    description="Returns the blocks of layers of pipeline parallel models hosted by this peer.",
+)
+async def list_shards_endpoint() -> Dict[str, Any]:
+    shards = Capabilities.get_manifest().shards
+    return {
+        "content": {"shards": {model_id: shard.dict() for model_id, shard in shards.items()}},
+        "status_code": 200,
+    }
+
+
+@router.post(
+    "/shards/{model_id}/forward",
+    tags=["Distributed Inference"],
+    summary="Run a block of model layers",
+    description="Runs layers [start, end) of a pipeline parallel model on the activations in the request body and forwards the result to the rest of the route.",
+)
+async def shard_forward_endpoint(model_id: str, start: int, end: int, request: Request) -> Response:
+    """
+    Runs layers [start, end) of the model on the activations sent as the raw request body, their dtype
+    and shape are sent in the X-Tensor-Dtype and X-Tensor-Shape headers.
+
+    The X-Pipeline-Route header holds the remaining hops of the route, if there are any the output is
+    sent to the next hop and its response is streamed back, otherwise the output is returned. When a
+    downstream peer fails the error response names it in the X-Failed-Peer header so the coordinator
+    can route around it. Only hops that are known peers advertising a block of the model covering the
+    hop's layers are accepted.
+    """
+    try:
+        route = PipelineParallel.decode_route(request.headers.get(PipelineParallel.route_header, ""))
+        await PipelineCoordinator.check_route(model_id, route)
+        activations = PipelineParallel.deserialize(await request.body(), request.headers)
+        output = await run_in_threadpool(PipelineParallel.forward, model_id, start, end, activations)
+        body, headers = PipelineParallel.serialize(output)
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception("Shard forward of %s failed", model_id)
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if not route:
+        return Response(content=body, media_type="application/octet-stream", headers=headers)
+
+    next_hop, rest = route[0], route[1:]
+    client = httpx.AsyncClient(timeout=httpx.Timeout(120.0, connect=10.0))
+    try:
+        downstream = await client.send(
+            client.build_request(
+                "POST",
+                f"{next_hop.url}/shards/{quote(model_id, safe='')}/forward",
+                params={"start": next_hop.start, "end": next_hop.end},
+                content=body,
+                headers={**headers, PipelineParallel.route_header: PipelineParallel.encode_route(rest)},
+            ),
+            stream=True,
+        )
+    except httpx.HTTPError as e:
+        await client.aclose()
+        raise HTTPException(
+            status_code=502,
+            detail=f"Next peer in the route failed: {e}",
+            headers={"X-Failed-Peer": next_hop.url},
+        )
+
+    response_headers = {
+        name: downstream.headers[name] for name in relayed_headers if name in downstream.headers
+    }
+    if downstream.status_code >= 400 and "X-Failed-Peer" not in response_headers:
+        response_headers["X-Failed-Peer"] = next_hop.url
+
+    async def close():
+        await downstream.aclose()
+        await client.aclose()
+
+    return StreamingResponse(
+        downstream.aiter_raw(),
+        status_code=downstream.status_code,
+        media_type=downstream.headers.get("content-type", "application/octet-stream"),
+        headers=response_headers,
+        background=BackgroundTask(close),
+    )
@@ -0,0 +1,256 @@
+"""
+Speculative decoding: a small draft model hosted on the same node proposes a few tokens, the main model
+checks all of them in a single forward pass and keeps the longest prefix it agrees with plus one token
+of its own. With greedy sampling the output is the same as running the main model alone, but the main
+model runs once per accepted run of tokens instead of once per token, which cuts single stream latency
+on cpu only nodes where every pass of a 7B model is expensive.
+
+gpt4all doesn't expose the logits of a forward pass over several tokens, so speculative decoding runs
+transformers models from models/<model_id>. Model pairs are configured in .config.json:
+    "speculative_decoding": {
+        "mistral-7b-instruct-v0.2": {"draft": "tinyllama-1.1b-chat", "num_draft_tokens": 4}
+    }
+The draft must use the same tokenizer as the main model.
+"""
+
+import threading
+from pydantic import BaseModel, Field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ...utils import Utils
+from ...utils.metrics import metrics
+from .model_manager import ModelLoader
+
+torch = Utils.LazyImport("torch")
+transformers = Utils.LazyImport("transformers")
+
+
+class SpeculativeDecoding:
+    class Pair(BaseModel):
+        draft: str
+        num_draft_tokens: int = Field(4, ge=1, le=16)  # Tokens proposed by the draft per main model pass
+
+    class Metrics(BaseModel):
+        requests: int = 0
+        generated_tokens: int = 0
+        drafted_tokens: int = 0
+        accepted_tokens: int = 0
+        main_passes: int = 0
+
+        def summary(self) -> Dict[str, Any]:
+            return {
+                **self.dict(),
+                # Share of draft tokens the main model agreed with
+                "acceptance_rate": round(self.accepted_tokens / self.drafted_tokens, 4)
+                if self.drafted_tokens
+                else 0.0,
+                # Tokens generated per pass of the main model, 1 without speculative decoding
+                "tokens_per_main_pass": round(self.generated_tokens / self.main_passes, 4)
+                if self.main_passes
+                else 0.0,
+            }
+
+    drafted_tokens = metrics.counter(
+        "bitorch_speculative_drafted_tokens_total", "Tokens proposed by draft models.", labels=["model"]
+    )
+    accepted_tokens = metrics.counter(
+        "bitorch_speculative_accepted_tokens_total",
+        "Draft tokens accepted by the main model.",
+        labels=["model"],
+    )
+
+    _pairs: Optional[Dict[str, "SpeculativeDecoding.Pair"]] = None
+    _metrics: Dict[str, "SpeculativeDecoding.Metrics"] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_pairs() -> Dict[str, "SpeculativeDecoding.Pair"]:
+        if SpeculativeDecoding._pairs is None:
+            SpeculativeDecoding._pairs = {
+                model_id: SpeculativeDecoding.Pair(**pair)
+                for model_id, pair in Utils.config.get("speculative_decoding", {}).items()
+            }
+        return SpeculativeDecoding._pairs
+
+    @staticmethod
+    def get_pair(model_id: str) -> Optional["SpeculativeDecoding.Pair"]:
+        return SpeculativeDecoding.get_pairs().get(model_id)
+
+    @staticmethod
+    def get_metrics() -> Dict[str, Dict[str, Any]]:
+        with SpeculativeDecoding._lock:
+            return {
+                f"{model_id}+{SpeculativeDecoding.get_pair(model_id).draft}": totals.summary()
+                for model_id, totals in SpeculativeDecoding._metrics.items()
+            }
+
+    @staticmethod
+    def record(model_id: str, stats: Dict[str, int]) -> None:
+        with SpeculativeDecoding._lock:
+            totals = SpeculativeDecoding._metrics.setdefault(model_id, SpeculativeDecoding.Metrics())
+            totals.requests += 1
+            for name, value in stats.items():
+                setattr(totals, name, getattr(totals, name) + value)
+        SpeculativeDecoding.drafted_tokens.inc(stats["drafted_tokens"], model=model_id)
+        SpeculativeDecoding.accepted_tokens.inc(stats["accepted_tokens"], model=model_id)
+
+    @staticmethod
+    def load(model_id: str) -> Tuple[Tuple[Any, Any], Tuple[Any, Any]]:
+        """Loads the main and draft models of a pair, returns ((main, tokenizer), (draft, tokenizer))."""
+        pair = SpeculativeDecoding.get_pair(model_id)
+        return ModelLoader.get_transformers_model(model_id), ModelLoader.get_transformers_model(pair.draft)
+
+    @staticmethod
+    def generate(
+        model_id: str,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        temp: float,
+        callback: Optional[Callable[[int, str], bool]] = None,
+    ) -> str:
+        """
+        Generates the assistant's reply to a conversation with a configured model pair. Only greedy
+        sampling (temp 0) is speculative, other temperatures sample from the main model alone. Blocking,
+        don't call from the event loop.
+
+        Parameters:
+        - callback: Called with (token_id, text) for every generated token, returning False stops the
+          generation.
+        """
+        pair = SpeculativeDecoding.get_pair(model_id)
+        (main_model, tokenizer), (draft_model, _) = SpeculativeDecoding.load(model_id)
+
+        if tokenizer.chat_template:
+            input_ids = tokenizer.apply_chat_template(
+                messages, add_generation_prompt=True, return_tensors="pt"
+            )
+            if not isinstance(input_ids, torch.Tensor):
+                input_ids = input_ids["input_ids"]
+        else:
+            from .test_inference_request_endpoint import format_prompt_for_llm
+
+            input_ids = tokenizer(format_prompt_for_llm(messages), return_tensors="pt").input_ids
+
+        generated: List[int] = []
+        text = ""
+
+        def on_token(token_id: int) -> bool:
+            # Decoding every token on its own drops the spaces of sentencepiece tokenizers
+            nonlocal text
+            generated.append(token_id)
+            new_text = tokenizer.decode(generated, skip_special_tokens=True)
+            delta, text = new_text[len(text) :], new_text
+            return callback(token_id, delta) if callback is not None else True
+
+        stats = SpeculativeDecoding.decode(
+            main_model,
+            draft_model if temp == 0 else None,
+            input_ids,
+            max_tokens=max_tokens,
+            num_draft_tokens=pair.num_draft_tokens,
+            temp=temp,
+            eos_token_ids=SpeculativeDecoding.eos_token_ids(main_model, tokenizer),
+            on_token=on_token,
+        )
+        SpeculativeDecoding.record(model_id, stats)
+        return text
+
+    @staticmethod
+    def eos_token_ids(model, tokenizer) -> set:
+        eos = model.generation_config.eos_token_id if model.generation_config else None
+        eos = eos if eos is not None else tokenizer.eos_token_id
+        if eos is None:
+            return set()
+        return set(eos) if isinstance(eos, (list, tuple)) else {eos}
+
+    @staticmethod
+    def decode(
+        main_model,
+        draft_model,
+        input_ids,
+        max_tokens: int,
+        num_draft_tokens: int,
+        temp: float = 0.0,
+        eos_token_ids: Optional[set] = None,
+        on_token: Optional[Callable[[int], bool]] = None,
+    ) -> Dict[str, int]:
+        """
+        Runs the draft/verify loop on a single sequence. Without a draft model every main model pass
+        generates one token, i.e. plain decoding.
+
+        Both models keep a KV cache of the accepted sequence. The main model's cache holds every token
+        but the last one, each pass feeds that last token followed by the draft tokens and yields the
+        main model's prediction after each of them. Cached entries of rejected draft tokens are cropped.
+
+        Returns:
+        - Dict[str, int]: Counts for the acceptance metrics.
+        """
+        eos_token_ids = eos_token_ids or set()
+        stats = {"generated_tokens": 0, "drafted_tokens": 0, "accepted_tokens": 0, "main_passes": 0}
+        sequence = input_ids[0].tolist()
+
+        def pick(logits) -> int:
+            if temp == 0:
+                return int(logits.argmax(-1))
+            probabilities = torch.softmax(logits.float() / temp, dim=-1)
+            return int(torch.multinomial(probabilities, 1))
+
+        def forward(model, tokens: List[int], cache):
+            output = model(
+                input_ids=torch.tensor([tokens], dtype=torch.long),
+                past_key_values=cache,
+                use_cache=True,
+            )
+            return output.logits[0]
+
+        def crop(cache, length: int) -> None:
+            # A negative count removes tokens from the end in every transformers version
+            surplus = cache.get_seq_length() - length
+            if surplus > 0:
+                cache.crop(-surplus)
+
+        with torch.inference_mode():
+            main_cache = transformers.DynamicCache()
+            if len(sequence) > 1:
+                forward(main_model, sequence[:-1], main_cache)
+            draft_cache = transformers.DynamicCache() if draft_model is not None else None
+            draft_length = 0  # Tokens of the sequence in the draft's cache
+
+            while stats["generated_tokens"] < max_tokens:
+                # Draft proposes tokens greedily, starting from the part of the sequence it hasn't seen
+                draft_tokens: List[int] = []
+                if draft_model is not None:
+                    pending = sequence[draft_length:]
+                    budget = min(num_draft_tokens, max_tokens - stats["generated_tokens"] - 1)
+                    for _ in range(budget):
+                        draft_tokens.append(pick(forward(draft_model, pending, draft_cache)[-1]))
+                        if draft_tokens[-1] in eos_token_ids:
+                            break
+                        pending = [draft_tokens[-1]]
+
+                # Main model checks every draft token in one pass
+                logits = forward(main_model, [sequence[-1]] + draft_tokens, main_cache)
+                stats["main_passes"] += 1
+                stats["drafted_tokens"] += len(draft_tokens)
+
+                accepted = 0
+                while accepted < len(draft_tokens) and pick(logits[accepted]) == draft_tokens[accepted]:
+                    accepted += 1
+                new_tokens = draft_tokens[:accepted] + [pick(logits[accepted])]
+                stats["accepted_tokens"] += accepted
+
+                crop(main_cache, len(sequence) + accepted)
+                if draft_cache is not None:
+                    draft_length = min(draft_cache.get_seq_length(), len(sequence) + accepted)
+                    crop(draft_cache, draft_length)
+
+                for token in new_tokens:
+                    sequence.append(token)
+                    stats["generated_tokens"] += 1
+                    if token in eos_token_ids:
+                        return stats
+                    if on_token is not None and not on_token(token):
+                        return stats
+                    if stats["generated_tokens"] >= max_tokens:
+                        return stats
+        return stats
@@ -0,0 +1,38 @@
+from typing import Dict, Any
+
+from fastapi import APIRouter
+
+from .speculative_decoding import SpeculativeDecoding
+
+router = APIRouter()
+
+
+@router.get(
+    "/inference/speculative",
+    tags=["Distributed Inference"],
+    summary="Get speculative decoding metrics",
+    description="Returns the configured draft model of each model and how many draft tokens were accepted since the node started.",
+)
+async def speculative_metrics_endpoint() -> Dict[str, Any]:
+    """
+    Example response:
+        {
+            "content": {
+                "pairs": {"mistral-7b-instruct-v0.2": {"draft": "tinyllama-1.1b-chat", "num_draft_tokens": 4}},
+                "metrics": {
+                    "mistral-7b-instruct-v0.2+tinyllama-1.1b-chat": {
+                        "requests": 12, "generated_tokens": 2048, "drafted_tokens": 2400, "accepted_tokens": 1560,
+                        "main_passes": 640, "acceptance_rate": 0.65, "tokens_per_main_pass": 3.2
+                    }
+                }
+            },
+            "status_code": 200
+        }
+    """
+    return {
+        "content": {
+            "pairs": {model_id: pair.dict() for model_id, pair in SpeculativeDecoding.get_pairs().items()},
+            "metrics": SpeculativeDecoding.get_metrics(),
+        },
+        "status_code": 200,
+    }
@@ -1,27 +1,51 @@
-import os
 import io
-from pydantic import BaseModel
+import time
+import asyncio
+from pydantic import BaseModel, Field
+from typing import Optional
 
-import torch
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
-from diffusers import AutoPipelineForText2Image
 
+from ...utils import Utils
+from ...utils.capabilities import Capabilities
+from ...utils.metrics import Tracing
+from . import ModelDispatcher, InferenceMetrics
+from .model_manager import ModelLoader
+from .response_cache import ResponseCache, CacheControl
+
+torch = Utils.LazyImport("torch")
+
+# Mounted on every node, nodes that can't run the model themselves forward requests to capable peers.
 router = APIRouter()
+model_requirements = Capabilities.Requirements(
+    inference=True, gpu=True, libraries=["torch", "diffusers"], models=["sdxl-turbo"]
+)
+
+pipeline_lock = asyncio.Lock()  # Held while the pipeline generates an image
 
 # TODO: Handle logic and user specifications about which models are loaded and hosted in memory vs booted per request.
-model_path = os.path.join("models")
 
 
 class InferenceInput(BaseModel):
     prompt: str
+    steps: int = Field(2, ge=1, le=8)  # sdxl-turbo generates good images in 1 to 4 steps
+    seed: Optional[int] = Field(None, ge=0)  # Makes the image reproducible
+
+
+def get_pipeline():
+    """
+    Loads the sdxl-turbo pipeline on first use and returns the cached instance afterwards, so that
+    mounting this endpoint doesn't import torch/diffusers or load the model into memory.
+    """
+    return ModelLoader.get_diffusers_pipeline(
+        "sdxl-turbo",
+        device="cuda",
+        torch_dtype=torch.float16,
+        variant="fp16",
+    )
 
-pipe = AutoPipelineForText2Image.from_pretrained(
-    pretrained_model_or_path=os.path.join(model_path, "sdxl-turbo"),
-    torch_dtype=torch.float16,
-    variant="fp16",
-)
-pipe.to("cuda")
 
 @router.post(
     "/image-inference-request",
@@ -30,25 +54,65 @@ pipe.to("cuda")
     description="This endpoint takes in a textual description (prompt) and returns a generated image that corresponds to that description.",
     response_class=StreamingResponse,  # Specify that the endpoint will return a streaming response
 )
-async def image_inference_request_endpoint(inference_input: InferenceInput):
+async def image_inference_request_endpoint(inference_input: InferenceInput, request: Request):
     """
-    Receive a prompt and return an AI-generated image based on the input.
+    Receive a prompt and return an AI-generated image based on the input, run on the least loaded peer
+    hosting sdxl-turbo which may be this node.
+
+    Images are served from the response cache when it's enabled, requests without a seed then get the
+    image generated for the first request with the same prompt and steps.
     """
+    cache_key = None
+    cache_control = CacheControl.parse(request.headers.get("Cache-Control"))
+    if ResponseCache.use_for(cache_control):
+        cache_key = ResponseCache.key("image-inference-request", "sdxl-turbo", inference_input.dict())
+        cached = await ResponseCache.get(cache_key, cache_control)
+        if cached is not None:
+            return cached
+
+    return await ModelDispatcher.dispatch(
+        request,
+        inference_input.dict(),
+        model_requirements,
+        lambda: run_inference(inference_input, cache_key),
+    )
 
+
+async def run_inference(inference_input: InferenceInput, cache_key: Optional[str] = None):
     try:
+        pipe = await run_in_threadpool(get_pipeline)
+
+        generator = None
+        if inference_input.seed is not None:
+            generator = torch.Generator(device="cuda").manual_seed(inference_input.seed)
+
+        def generate() -> bytes:
+            image = pipe(
+                inference_input.prompt,
+                num_inference_steps=inference_input.steps,
+                guidance_scale=0.0,
+                generator=generator,
+            ).images[0]
 
-        image = pipe(
-            inference_input.prompt,
-            num_inference_steps=2,
-            guidance_scale=0.0,
-        ).images[0]
+            # Convert PIL Image to bytes
+            img_byte_arr = io.BytesIO()
+            image.save(img_byte_arr, format="JPEG")  # Change 'JPEG' to your desired format
+            return img_byte_arr.getvalue()
 
-        # Convert PIL Image to bytes
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format="JPEG")  # Change 'JPEG' to your desired format
-        img_byte_arr.seek(0)
+        # The pipeline runs in a worker thread so the node keeps answering load polls, health probes and
+        # forwarded requests meanwhile. One generation at a time, a pipeline isn't safe to call concurrently.
+        async with pipeline_lock:
+            start = time.perf_counter()
+            with Tracing.span("inference.image", model="sdxl-turbo", steps=inference_input.steps):
+                content = await run_in_threadpool(generate)
+            InferenceMetrics.image_steps_per_second.observe(
+                inference_input.steps / (time.perf_counter() - start), model="sdxl-turbo"
+            )
 
-        return StreamingResponse(img_byte_arr, media_type="image/jpeg")
+        response = Response(content=content, media_type="image/jpeg")
+        if cache_key is not None:
+            await ResponseCache.put(cache_key, response, persist=True)
+        return response
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -61,29 +61,42 @@ NOTE: Need to purge all none essential env libraries so that the docker images a
 """
 
 import os
-import queue
-import threading
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Iterator
-
-from gpt4all import GPT4All
-from fastapi import APIRouter
-from fastapi.responses import StreamingResponse
-
-
+from pydantic import BaseModel, Field, validator
+from typing import Callable, List, Optional, Dict
+
+from fastapi import APIRouter, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+
+from ...utils.capabilities import Capabilities
+from ...utils.metrics import Tracing
+from . import ModelDispatcher, InferenceMetrics
+from .prompt_cache import PromptCache
+from .response_cache import ResponseCache, CacheControl
+from .speculative_decoding import SpeculativeDecoding
+from .token_stream import TokenStream
+
+# Mounted on every node, nodes that can't run the model themselves forward requests to capable peers.
 router = APIRouter()
 
 
 # TODO: Handle logic and user specifications about which models are loaded and hosted in memory vs booted per request.
-model_path = os.path.join("models")
-os.makedirs(model_path, exist_ok=True)
-
-# Use the absolute path of the directory where your model should be located
-abs_model_path = os.path.abspath(model_path)
+model_name = "mistral-7b-openorca.gguf2.Q4_0.gguf"  # compatible models: https://raw.githubusercontent.com/nomic-ai/gpt4all/main/gpt4all-chat/metadata/models2.json
 
 class InferenceInput(BaseModel):
     messages: Optional[List[Dict[str, str]]]
     stream: bool = False # Weather or not to stream back the request as it's generated
+    # Framing of the stream: text, ndjson or sse, picked from the Accept header if not set, see TokenStream
+    stream_format: Optional[str] = Field(None, regex="^(text|ndjson|sse)$")
+    model: Optional[str] = None  # Model file to run, defaults to model_name
+    temp: float = Field(0.7, ge=0, le=2)  # Sampling temperature, 0 samples greedily and is deterministic
+    max_tokens: int = Field(1000, gt=0, le=4096)
+
+    @validator("model")
+    def validate_model(cls, v: Optional[str]) -> Optional[str]:
+        if v is not None and (os.path.basename(v) != v or v.startswith(".")):
+            raise ValueError("Model must be the file name of a model")
+        return v
 
     class Config:
         schema_extra = {
@@ -113,11 +126,13 @@ class InferenceInput(BaseModel):
         }
 
 
-def format_prompt_for_llm(prompt_list):
+def format_prompt_for_llm(prompt_list, boundaries: Optional[List[int]] = None):
     """
     Takes a list of conversation entries and formats them as a single string prompt.
 
     :param prompt_list: A list of dictionaries with 'role' and 'content' keys.
+    :param boundaries: Optional list filled with the offset in the prompt where each entry's content ends,
+        the prefixes the prompt cache looks up.
     :return: A formatted string prompt.
     """
     formatted_prompt = ""
@@ -132,7 +147,10 @@ def format_prompt_for_llm(prompt_list):
     for entry in prompt_list:
         role_label = role_to_label.get(entry["role"], "")
         if role_label:
-            formatted_prompt += f"{role_label}\n{entry['content']}\n\n"
+            formatted_prompt += f"{role_label}\n{entry['content']}"
+            if boundaries is not None:
+                boundaries.append(len(formatted_prompt))
+            formatted_prompt += "\n\n"
 
     # We always expect the assistant's reply at the end, hence the final "### Assistant:"
     formatted_prompt += "### Assistant:\n"
@@ -146,7 +164,7 @@ def format_prompt_for_llm(prompt_list):
     summary="Generates text based on the input prompt or chat_session.",
     description="This endpoint receives a text input and returns a generated text response.",
 )
-async def inference_request_endpoint(inference_input: InferenceInput):
+async def inference_request_endpoint(inference_input: InferenceInput, request: Request):
     """
     TODO: Docstring
     TODO: Compatibility with openai api
@@ -156,46 +174,102 @@ async def inference_request_endpoint(inference_input: InferenceInput):
     
     NOTE: Core aspect of this design is that the client, whatever it is, is expected to keep track of the chat_session, not the server. the server will only responde
     with the response of the model, whether that be strings, images, audio, whatever.
+
+    The request is run on the least loaded peer hosting the model, which may be this node, see ModelDispatcher.
     """
-    model = GPT4All(
-        model_name="mistral-7b-openorca.gguf2.Q4_0.gguf",  # compatible models: https://raw.githubusercontent.com/nomic-ai/gpt4all/main/gpt4all-chat/metadata/models2.json
-        allow_download=True,
-        model_path=abs_model_path,
-        verbose=True,
+    model = inference_input.model or model_name
+    if inference_input.stream and inference_input.stream_format is None:
+        inference_input.stream_format = TokenStream.format_from_accept(request.headers.get("Accept"))
+
+    # Greedy non streaming responses are deterministic and can be served from the response cache
+    cache_key = None
+    cache_control = CacheControl.parse(request.headers.get("Cache-Control"))
+    if ResponseCache.use_for(cache_control) and not inference_input.stream and inference_input.temp == 0:
+        cache_key = ResponseCache.key(
+            "inference-request",
+            model,
+            inference_input.dict(include={"messages", "temp", "max_tokens"}),
+        )
+        cached = await ResponseCache.get(cache_key, cache_control)
+        if cached is not None:
+            return cached
+
+    pair = SpeculativeDecoding.get_pair(model)
+    if pair is not None:
+        # Model pairs run with transformers and both models have to be installed on the node
+        requirements = Capabilities.Requirements(
+            inference=True, libraries=["torch", "transformers"], models=[model, pair.draft]
+        )
+        local_requirements = requirements
+    else:
+        requirements = Capabilities.Requirements(inference=True, libraries=["gpt4all"], models=[model])
+        # The default model is downloaded by gpt4all on first use, other models have to be installed on the node
+        local_requirements = Capabilities.Requirements(
+            inference=True, libraries=["gpt4all"], models=[] if model == model_name else [model]
+        )
+
+    return await ModelDispatcher.dispatch(
+        request,
+        inference_input.dict(),
+        requirements,
+        lambda: run_inference(inference_input, model, cache_key),
+        local_requirements=local_requirements,
     )
 
-    prompt = format_prompt_for_llm(prompt_list=inference_input.messages)
+
+def generate_text(
+    model: str,
+    messages: List[Dict[str, str]],
+    max_tokens: int,
+    temp: float,
+    callback: Optional[Callable[[int, str], bool]] = None,
+) -> str:
+    """
+    Generates the assistant's reply to a conversation with a gpt4all model, or with speculative decoding
+    if the model has a draft model configured. Blocking, don't call from the event loop.
+
+    :param callback: Called with (token_id, text) for every generated token, returning False stops the generation.
+    :return: The generated reply.
+    """
+    generation = InferenceMetrics.Generation(model, callback)
+    with Tracing.span("inference.generate", model=model):
+        if SpeculativeDecoding.get_pair(model) is not None:
+            SpeculativeDecoding.load(model)
+            generation.started()
+            response = SpeculativeDecoding.generate(
+                model, messages, max_tokens, temp, callback=generation.callback
+            )
+        else:
+            boundaries = []
+            prompt = format_prompt_for_llm(prompt_list=messages, boundaries=boundaries)
+
+            # Only the part of the prompt that isn't already in a cached model context is prefilled
+            with PromptCache.session(model, prompt, boundaries) as (session, new_prompt):
+                generation.started()
+                response = session.generate(
+                    new_prompt, max_tokens=max_tokens, temp=temp, callback=generation.callback
+                )
+        generation.finish()
+    return response
+
+
+async def run_inference(inference_input: InferenceInput, model: str, cache_key: Optional[str] = None):
+    def generate(callback=None) -> str:
+        return generate_text(
+            model,
+            inference_input.messages,
+            max_tokens=inference_input.max_tokens,
+            temp=inference_input.temp,
+            callback=callback,
+        )
 
     if inference_input.stream:
-        # Queue to hold generated tokens
-        token_queue = queue.Queue()
-
-        def worker():
-            try:
-                for token in model.generate(
-                    prompt=prompt, max_tokens=1000, streaming=True
-                ):
-                    # print(token, end='', flush=True)  # Append to the same line and flush the output
-                    token_queue.put(token)  # Put the token in the queue
-            finally:
-                # print()  # Ensure the next console output appears on a new line
-                token_queue.put(None)  # Put sentinel value to indicate end
-
-        # Start the worker in a separate thread
-        threading.Thread(target=worker, daemon=True).start()
-
-        # Generator function for StreamingResponse
-        def token_streamer() -> Iterator[str]:
-            # Fetch tokens from the queue
-            while True:
-                token = (
-                    token_queue.get()
-                )  # will block until a new item is available
-                if token is None:
-                    break  # If we get sentinel value, exit
-                yield token + "\n"  # Yield token to the client
-
-        # Return the streaming response
-        return StreamingResponse(token_streamer(), media_type="text/plain")
+        # Tokens are generated on a worker thread and streamed from the event loop
+        stream = TokenStream(max_tokens=inference_input.max_tokens)
+        stream.run(generate)
+        return stream.response(inference_input.stream_format or "text")
     else:
-        return model.generate(prompt=prompt, max_tokens=1000, streaming=False)
+        response = JSONResponse(await run_in_threadpool(generate))
+        if cache_key is not None:
+            await ResponseCache.put(cache_key, response)
+        return response
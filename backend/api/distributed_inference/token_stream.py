@@ -0,0 +1,154 @@
+"""
+Streams tokens generated on a worker thread to the client without holding a threadpool thread per stream.
+
+The model's token callback hands every token to the event loop with call_soon_threadsafe and an async
+generator sends them to the client. Tokens that arrive while the previous frame is still being sent are
+coalesced into a single frame, so a client slower than the model gets fewer, larger frames instead of a
+growing backlog. When the client disconnects the callback tells the model to stop generating.
+
+Framings:
+- text: every token followed by a newline, the original text/plain format and the default.
+- ndjson: one json object per line, {"tokens": [{"id": 1, "text": "Hi"}], "text": "Hi", "time": 0.12},
+  then a final {"finish_reason": ..., "usage": {...}} line.
+- sse: server sent events, "tokens" events with the same data as ndjson then a final "done" event.
+"""
+
+import json
+import time
+import asyncio
+import threading
+import contextvars
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from fastapi.responses import StreamingResponse
+
+from ...utils.logger import Logger
+
+logger = Logger.get("inference")
+
+
+class TokenStream:
+    formats = {
+        "text": "text/plain",
+        "ndjson": "application/x-ndjson",
+        "sse": "text/event-stream",
+    }
+    max_frame_tokens = 64
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self.loop = asyncio.get_running_loop()
+        self.queue: "asyncio.Queue[Optional[Tuple[int, str]]]" = asyncio.Queue()
+        self.cancelled = threading.Event()
+        self.start = time.perf_counter()
+        self.first_token: Optional[float] = None
+        self.token_count = 0  # Tokens sent to the client
+        self.generated = 0  # Tokens generated, counted on the worker thread
+        self.finish_reason: Optional[str] = None
+
+    @staticmethod
+    def format_from_accept(accept: Optional[str]) -> str:
+        """Picks the framing from the Accept header when the request doesn't ask for one."""
+        accept = (accept or "").lower()
+        for stream_format, media_type in TokenStream.formats.items():
+            if stream_format != "text" and media_type in accept:
+                return stream_format
+        return "text"
+
+    def callback(self, token_id: int, text: str) -> bool:
+        """
+        Token callback of the model, called on the worker thread. Returning False stops the generation.
+        """
+        self.generated += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (token_id, text))
+        return not self.cancelled.is_set()
+
+    def run(self, generate: Callable[[Callable[[int, str], bool]], Any]) -> None:
+        """
+        Runs generate(callback) on a new thread, the end of the stream is signalled once it returns.
+        """
+
+        # The worker runs in a copy of the request's context so that its spans are added to the trace
+        context = contextvars.copy_context()
+
+        def worker():
+            try:
+                context.run(generate, self.callback)
+                if self.cancelled.is_set():
+                    self.finish_reason = "cancelled"
+                elif self.generated >= self.max_tokens:
+                    self.finish_reason = "length"
+                else:
+                    self.finish_reason = "stop"
+            except Exception as e:
+                logger.exception("Token stream generation failed: %s", e)
+                self.finish_reason = "error"
+            finally:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    async def frames(self) -> AsyncIterator[List[Tuple[int, str]]]:
+        """Yields lists of tokens, every token that is ready is sent in the same frame."""
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None:
+                    return
+                frame = [item]
+                done = False
+                while len(frame) < TokenStream.max_frame_tokens and not self.queue.empty():
+                    item = self.queue.get_nowait()
+                    if item is None:
+                        done = True
+                        break
+                    frame.append(item)
+
+                if self.first_token is None:
+                    self.first_token = time.perf_counter() - self.start
+                self.token_count += len(frame)
+                yield frame
+                if done:
+                    return
+        finally:
+            # Also reached when the client disconnects and the response is cancelled
+            self.cancelled.set()
+
+    def summary(self) -> Dict[str, Any]:
+        duration = time.perf_counter() - self.start
+        return {
+            "finish_reason": self.finish_reason or "cancelled",
+            "usage": {
+                "completion_tokens": self.token_count,
+                "time_to_first_token": round(self.first_token or 0.0, 4),
+                "duration": round(duration, 4),
+                "tokens_per_second": round(self.token_count / duration, 2) if duration else 0.0,
+            },
+        }
+
+    async def encode(self, stream_format: str) -> AsyncIterator[str]:
+        async for frame in self.frames():
+            if stream_format == "text":
+                yield "".join(text + "\n" for _, text in frame)
+                continue
+
+            data = json.dumps(
+                {
+                    "tokens": [{"id": token_id, "text": text} for token_id, text in frame],
+                    "text": "".join(text for _, text in frame),
+                    "time": round(time.perf_counter() - self.start, 4),
+                }
+            )
+            yield f"event: tokens\ndata: {data}\n\n" if stream_format == "sse" else f"{data}\n"
+
+        if stream_format != "text":
+            data = json.dumps(self.summary())
+            yield f"event: done\ndata: {data}\n\n" if stream_format == "sse" else f"{data}\n"
+
+    def response(self, stream_format: str) -> StreamingResponse:
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        return StreamingResponse(
+            self.encode(stream_format),
+            media_type=TokenStream.formats[stream_format],
+            headers=headers if stream_format == "sse" else None,
+        )
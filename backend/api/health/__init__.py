@@ -0,0 +1,79 @@
+"""
+Liveness and readiness of the worker process answering the request, for load balancers and orchestrators.
+
+/health is the liveness probe: it passes as long as the worker runs its event loop and scheduler, a
+failing dependency like the database doesn't make it fail since restarting the worker wouldn't help.
+/ready is the readiness probe: it only passes once the database answers and every model of WARM_MODELS
+is loaded, so traffic is only routed to nodes that can serve inference without loading a model first.
+Nodes that don't run inference don't warm up models, and only the first WARM_GPU_WORKERS workers warm
+up models loaded onto a gpu. /ready only waits for the models the worker warms up.
+Both report the same details, and are excluded from the request history of peers.
+"""
+
+import os
+import time
+import asyncio
+from typing import Any, Dict, Tuple
+
+from ...utils.mongo import MongoDBManager
+from ...utils.scheduler import scheduler
+from ..distributed_inference import ModelDispatcher
+from ..distributed_inference.model_manager import ModelTasks, model_registry
+
+started_at = time.time()
+
+
+class Health:
+    db_timeout = 2.0  # Seconds before the database is reported unreachable
+
+    @staticmethod
+    async def check_database() -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            ok = await asyncio.wait_for(MongoDBManager().ping(), Health.db_timeout)
+        except asyncio.TimeoutError:
+            ok = False
+        return {"ok": ok, "latency_ms": round((time.perf_counter() - start) * 1000, 3)}
+
+    @staticmethod
+    def check_scheduler() -> Dict[str, Any]:
+        return {"running": scheduler.sched.running, "jobs": len(scheduler.sched.get_jobs())}
+
+    @staticmethod
+    def check_models() -> Dict[str, Any]:
+        """Loaded models of this worker and the load state of the models it warms up on startup."""
+        models = model_registry.get_models()
+        states = {model.id: model.load_state for model in models}
+        warm = ModelTasks.get_warm_models()
+        return {
+            "loaded": sorted(model.id for model in models if model.load_state == "loaded"),
+            "warm": {model_id: states.get(model_id, "missing") for model_id in warm},
+        }
+
+    @staticmethod
+    async def report() -> Tuple[bool, bool, Dict[str, Any]]:
+        """
+        Returns:
+        - (live, ready, report): whether the worker is alive, whether it is ready to serve traffic and the
+          details of every check.
+        """
+        database = await Health.check_database()
+        scheduler_status = Health.check_scheduler()
+        models = Health.check_models()
+        live = scheduler_status["running"]
+        ready = (
+            live
+            and database["ok"]
+            and all(state == "loaded" for state in models["warm"].values())
+        )
+        return live, ready, {
+            "live": live,
+            "ready": ready,
+            "pid": os.getpid(),
+            "worker": os.getenv("WORKER_INDEX"),
+            "uptime_seconds": round(time.time() - started_at, 3),
+            "database": database,
+            "scheduler": scheduler_status,
+            "models": models,
+            "load": ModelDispatcher.get_load(),
+        }
@@ -0,0 +1,35 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from . import Health
+
+router = APIRouter()
+
+
+@router.get(
+    "/health",
+    tags=["Health"],
+    summary="Liveness probe",
+    description="Returns 200 while the worker process handling the request runs its event loop and scheduler, 503 otherwise. Reports database connectivity, scheduler status, loaded models and inference queue depth without failing on them.",
+)
+async def health_endpoint() -> JSONResponse:
+    """
+    Example response:
+        {
+            "content": {
+                "live": true,
+                "ready": false,
+                "pid": 4242,
+                "worker": "0",
+                "uptime_seconds": 12.5,
+                "database": {"ok": true, "latency_ms": 0.812},
+                "scheduler": {"running": true, "jobs": 6},
+                "models": {"loaded": [], "warm": {"mistral-7b-openorca.gguf2.Q4_0.gguf": "loading"}},
+                "load": {"queue_depth": 0, "max_concurrency": 1, "inference": true}
+            },
+            "status_code": 200
+        }
+    """
+    live, _, report = await Health.report()
+    status_code = 200 if live else 503
+    return JSONResponse({"content": report, "status_code": status_code}, status_code=status_code)
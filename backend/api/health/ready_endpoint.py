@@ -0,0 +1,31 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from . import Health
+
+router = APIRouter()
+
+
+@router.get(
+    "/ready",
+    tags=["Health"],
+    summary="Readiness probe",
+    description="Returns 200 once the worker process handling the request can serve traffic: the database answers, the scheduler runs and every model of WARM_MODELS is loaded. Returns 503 with the failing checks otherwise.",
+)
+async def ready_endpoint() -> JSONResponse:
+    """
+    Example response while a warm model failed to load:
+        {
+            "content": {
+                "live": true,
+                "ready": false,
+                ...
+                "models": {"loaded": [], "warm": {"sdxl-turbo": "failed"}},
+                ...
+            },
+            "status_code": 503
+        }
+    """
+    _, ready, report = await Health.report()
+    status_code = 200 if ready else 503
+    return JSONResponse({"content": report, "status_code": status_code}, status_code=status_code)
@@ -1,19 +1,23 @@
 import os
-import random
-import traceback
 from bson import ObjectId
 from datetime import datetime, timedelta
-from typing import List, Tuple, Optional, Set
+from typing import List, Tuple, Optional, Set, Union
 
 import httpx
+from pymongo.errors import OperationFailure
 
 from ...utils import Utils, Peer
+from ...utils.capabilities import Capabilities
+from ...utils.leases import Lease
+from ...utils.logger import Logger
 from ...utils.scheduler import scheduler
 from ...utils.mongo import MongoDBManager
 
 
 peers_collection = "peers"
 
+logger = Logger.get("pex")
+
 
 # TODO: Add better error handling
 class PexTasks:
@@ -26,6 +30,11 @@ class PexTasks:
         It checks if the current peer list is empty and, if so, searches for
         additional peers to connect to for starting network activities.
         """
+        from .request_history import RequestHistory
+
+        await PexMongo.create_indexes()
+        await RequestHistory.create_indexes()
+
         # Add self to peer list:
         my_peer = await Utils.get_my_peer()
         await PexMongo.add_peer(peer=my_peer)
@@ -52,9 +61,9 @@ class PexTasks:
         peers = Utils.get_source_peers()
         await PexMethods.register(peers=peers)
 
-    # @scheduler.schedule_task(trigger="interval", seconds=10, id="peer_list_monitor")
+    # @scheduler.schedule_task(trigger="delay", seconds=10, shard=True, id="peer_list_monitor")
     @staticmethod
-    async def peer_list_monitor():
+    async def peer_list_monitor(shard: Optional[Lease.Shard] = None):
         """
         Periodically monitors and updates the status of peers in the P2P network.
 
@@ -76,31 +85,28 @@ class PexTasks:
         TODO: Change the timing of the task and the period for health checks to be a
         .env var instead of hard coded.
 
-        TODO: Ensure that this thing runs every 10 seconds/## interval whenever this
-        function actually finished so that peers don't double check eachother in a short
-        time period.
-        
-        TODO: Introduce some data clean up to keep mongodb size small, remove request body
-        and other large chunks of data from the request history if the request is older 
-        than a certain time. but keep the bare bones logs so that we still have a record.
-        This will preserve space in the db, might not be necissary if the size is minimal,
-        but it might add up with multiple peers and lots of requests coming in so idk.
-        """
-        my_peer_list = await PexMongo.get_all_peers()
+        NOTE: Scheduled with trigger="delay", the next run starts 10 seconds (plus jitter)
+        after the previous one finished so that peers don't double check eachother in a
+        short time period. With several workers each one checks the peers of its shard.
+
+        NOTE: Old request history is rolled up and removed by RequestHistory.compact
+        (backend/api/pex/request_history.py).
+        """
         current_time = datetime.now()
         five_minutes_ago = current_time - timedelta(minutes=5)
         ten_minutes_ago = current_time - timedelta(minutes=10)
-        for peer in my_peer_list:
-            peer_last_seen = datetime.fromisoformat(peer.last_seen)
-            if ten_minutes_ago > peer_last_seen:
-                # # Perform health check
-                # alive = await PexMethods.health_check(peer)
-                # if not alive:
-                #     # Handle marking the peer as inactive in the database
-                pass
-
-            elif five_minutes_ago < peer_last_seen < ten_minutes_ago:
-                # Attempt to re-register peer to verify if it is still active
+
+        # # Perform health check of the peers not seen for over 10 minutes
+        # for peer in await PexMongo.get_peers_last_seen(before=ten_minutes_ago):
+        #     if shard is not None and not shard.owns(peer.ip):
+        #         continue
+        #     alive = await PexMethods.health_check(peer)
+        #     if not alive:
+        #         # Handle marking the peer as inactive in the database
+
+        # Attempt to re-register peers not seen for 5 to 10 minutes to verify if they are still active
+        for peer in await PexMongo.get_peers_last_seen(after=ten_minutes_ago, before=five_minutes_ago):
+            if shard is None or shard.owns(peer.ip):
                 await PexMethods.register([peer])
 
 
@@ -118,7 +124,7 @@ class PexMethods:
     """
 
     @staticmethod
-    async def register(peers: List[Peer.Internal]):
+    async def register(peers: List[Union[Peer.Internal, Peer.Record]]):
         """
         Request registration from a list of peers within the network.
 
@@ -128,8 +134,8 @@ class PexMethods:
         is shared, and a truncated peer list from the contacted peer is received and processed.
 
         Parameters:
-        - peers (List[Peer.Internal]): A list of Peer.Internal instances representing the target peers
-          for registration.
+        - peers (List[Union[Peer.Internal, Peer.Record]]): The target peers for registration, peers
+          received from other peers are validated as Peer.Internal before being stored.
 
         Returns:
         - None: Registration does not return a value but instead updates internal state.
@@ -141,9 +147,8 @@ class PexMethods:
         depth, limit_reached = await PexUtils.get_depth()
 
         if limit_reached:
-            # TODO: proper logging/console info, fastapi logging style maybe?
-            print(
-                f"Recursion depth limit reached, currently at depth {depth}. Stopping further registrations."
+            logger.info(
+                "Recursion depth limit reached, currently at depth %d. Stopping further registrations.", depth
             )
             return
 
@@ -153,12 +158,12 @@ class PexMethods:
                     peer_url = f"http://{peer.ip}:{peer.port}/register"
                     my_peer = await Utils.get_my_peer()
 
-                    print(f"Attempting to register with peer at {peer_url}")
+                    logger.debug("Attempting to register with peer at %s", peer_url)
                     response = await client.post(peer_url, json=my_peer.dict())
                     response.raise_for_status()  # Raises an exception for HTTP error responses
 
                     response_data = response.json()
-                    print(f"Registered with {peer.ip} successfully.")
+                    logger.info("Registered with %s successfully.", peer.ip)
 
                     # Obtain the peer list provided by the peer we've just registered with
                     new_peer_list = [
@@ -179,8 +184,7 @@ class PexMethods:
                         await PexMethods.register(filtered_new_peers)
 
                 except Exception as e:
-                    print(f"Failed to register with {peer.ip}: {str(e)}")
-                    traceback.print_exc()
+                    logger.warning("Failed to register with %s: %s", peer.ip, e, exc_info=True)
 
     # TODO:
     @staticmethod
@@ -249,18 +253,16 @@ class PexUtils:
         NOTE:
         - This function assumes that each peer has a unique IP address for identification purposes.
         """
-        my_peer_list = await PexMongo.get_all_peers()
-
-        # Create a set of IPs from my_peer_list for quick lookup
-        known_ips = {peer.ip for peer in my_peer_list}
+        # Look up only the ips of the given peers
+        known_ips = await PexMongo.get_known_ips([peer.ip for peer in peer_list])
 
         # Filter out any peers that are already in my_peer_list
         return [peer for peer in peer_list if peer.ip not in known_ips]
 
     @staticmethod
     async def filter_bad_peers(
-        peer_list: List[Peer.Internal],
-    ) -> List[Peer.Internal]:
+        peer_list: List[Peer.Record],
+    ) -> List[Peer.Record]:
         """
         This function should filter out blacklisted and poor quality or not trusted peers to help provide good quality peers for connection for new users.
 
@@ -268,6 +270,30 @@ class PexUtils:
         """
         return peer_list
 
+    @staticmethod
+    def filter_capable_peers(
+        peer_list: List[Peer.Record], requirements: Capabilities.Requirements
+    ) -> List[Peer.Record]:
+        """
+        Filters a given list of peers down to the peers whose advertised capability manifest satisfies
+        the given requirements, so that requests are only sent to peers that can serve them.
+
+        Peers that haven't advertised a manifest during /register are excluded because we can't know
+        what they are able to serve.
+
+        Parameters:
+        - peer_list (List[Peer.Record]): A list of peers to be filtered.
+        - requirements (Capabilities.Requirements): What the peer must be able to serve.
+
+        Returns:
+        - List[Peer.Record]: The peers able to serve the requirements.
+        """
+        return [
+            peer
+            for peer in peer_list
+            if peer.capabilities is not None and peer.capabilities.satisfies(requirements)
+        ]
+
     @staticmethod
     async def get_depth() -> Tuple[int, bool]:
         """
@@ -288,11 +314,8 @@ class PexUtils:
         except ValueError:
             max_depth = default_max_depth  # Fallback to default if conversion fails
 
-        # Get the current list of peers from the database
-        peer_list = await PexMongo.get_all_peers()
-
         # Calculate the current depth based on the size of the peer list
-        current_depth = len(peer_list)
+        current_depth = await PexMongo.count_peers()
 
         # Determine if the recursion depth limit has been reached
         limit_reached = current_depth >= max_depth
@@ -335,22 +358,93 @@ class PexMongo:
                     data[key] = str(value)
         return data
 
+    @staticmethod
+    async def create_indexes():
+        """
+        Creates the indexes of the peers collection at startup, every peer query filters on one of them.
+
+        Peers are identified by their ip. Duplicate peer documents created by older versions are merged
+        before the unique ip index is built, if that still fails the ip index is created without the
+        unique constraint so that lookups stay indexed.
+        """
+        for attempt in range(3):
+            try:
+                await MongoDBManager().create_index(peers_collection, [("ip", 1)], unique=True)
+                break
+            except OperationFailure as e:
+                if e.code in (85, 86) and attempt < 2:
+                    # A non unique ip index from a previous start, replaced once the duplicates are gone
+                    await MongoDBManager().drop_index(peers_collection, "ip_1")
+                    continue
+                if e.code == 11000 and attempt < 2:
+                    removed = await PexMongo.deduplicate_peers()
+                    logger.info("Merged %d duplicate peer documents.", removed)
+                    continue
+                logger.warning("Peers with duplicate ips exist, creating a non unique ip index: %s", e)
+                await MongoDBManager().create_index(peers_collection, [("ip", 1)])
+                break
+        await MongoDBManager().create_index(peers_collection, [("last_seen", 1)])
+        await MongoDBManager().create_index(peers_collection, [("black_listed", 1)])
+        await MongoDBManager().create_index(peers_collection, [("activated", 1)])
+        # Peers able to serve an inference request or hosting a model, see get_capable_peers
+        await MongoDBManager().create_index(
+            peers_collection, [("capabilities.inference", 1), ("black_listed", 1)]
+        )
+        await MongoDBManager().create_index(peers_collection, [("capabilities.models", 1)])
+
+    @staticmethod
+    async def deduplicate_peers() -> int:
+        """
+        Migration merging the documents of peers stored more than once, which concurrent requests from a
+        new ip could create before update_peer_request_history was atomic. The most recently seen document
+        of each ip is kept, the request histories of the others are merged into it in timestamp order and
+        their activated, registered and black_listed flags carried over.
+
+        Returns:
+        - int: The number of removed documents.
+        """
+        duplicates = await MongoDBManager().aggregate(
+            peers_collection,
+            [
+                {"$group": {"_id": "$ip", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+                {"$match": {"count": {"$gt": 1}}},
+            ],
+        )
+        removed = 0
+        for group in duplicates:
+            documents = await MongoDBManager().find_documents(
+                peers_collection, {"_id": {"$in": group["ids"]}}, sort=[("last_seen", -1)]
+            )
+            if len(documents) < 2:
+                continue
+            keep, others = documents[0], documents[1:]
+            update = {
+                "request_history": sorted(
+                    (info for doc in documents for info in doc.get("request_history", [])),
+                    key=lambda info: info.get("timestamp", ""),
+                )
+            }
+            for flag in ("activated", "registered", "black_listed"):
+                update[flag] = any(doc.get(flag, False) for doc in documents)
+            await MongoDBManager().update_document(peers_collection, {"_id": keep["_id"]}, update)
+            removed += await MongoDBManager().delete_documents(
+                peers_collection, {"_id": {"$in": [doc["_id"] for doc in others]}}
+            )
+        return removed
+
     @staticmethod
     async def add_peers(peer_list: List[Peer.Internal]) -> bool:
         """
-        Serialize MongoDB data by converting ObjectId to string.
+        Add the given peers that aren't in the database yet, returns False if any of them already existed.
         """
-        success = True
+        known_ips = await PexMongo.get_known_ips([peer.ip for peer in peer_list])
+        new_peers = {}
         for peer_model in peer_list:
-            peer_dict = peer_model.dict()
-            peer_exists = await MongoDBManager().find_documents(
-                peers_collection, peer_dict
-            )
-            if not peer_exists:
-                await MongoDBManager().insert_document(peers_collection, peer_dict)
-            else:
-                success = False
-        return success
+            if peer_model.ip not in known_ips:
+                new_peers.setdefault(peer_model.ip, peer_model.dict())
+        if new_peers:
+            await MongoDBManager().insert_documents(peers_collection, list(new_peers.values()))
+        return len(new_peers) == len(peer_list)
 
     @staticmethod
     async def add_peer(peer: Peer.Internal) -> str:
@@ -360,7 +454,7 @@ class PexMongo:
         """
         peer_dict = peer.dict()
         existing_peer = await MongoDBManager().find_documents(
-            peers_collection, {"ip": peer_dict["ip"]}
+            peers_collection, {"ip": peer_dict["ip"]}, limit=1, projection={"_id": 1}
         )
         if existing_peer:
             await MongoDBManager().update_document(
@@ -372,45 +466,107 @@ class PexMongo:
             return "New peer added"
 
     @staticmethod
-    async def get_all_peers() -> List[Peer.Internal]:
+    async def get_all_peers() -> List[Peer.Record]:
         """
-        Retrieve all peers from the database and remove the '_id' field. Results are unfiltered and contain blacklisted peers.
+        Retrieve all peers from the database as compact records, without their '_id' and request history.
+        Results are unfiltered and contain blacklisted peers.
+
+        NOTE: Reads the whole collection, prefer the queries below when only some peers are needed.
         """
-        peers = await MongoDBManager().find_documents(peers_collection, {})
-        result = []
-        for peer_dict in peers:
-            peer_dict.pop("_id", None)
-            result.append(Peer.Internal(**peer_dict))
-        return result
+        peers = await MongoDBManager().find_documents(
+            peers_collection, {}, projection=Peer.Record.projection
+        )
+        return [Peer.Record.from_document(peer_dict) for peer_dict in peers]
+
+    @staticmethod
+    async def get_capable_peers(requirements: Capabilities.Requirements) -> List[Peer.Record]:
+        """
+        Retrieve the peers that aren't blacklisted and whose capability manifest satisfies the given
+        requirements. The inference and model requirements are filtered by the database on their indexes,
+        the others are checked on the returned peers.
+        """
+        query = {"black_listed": False}
+        if requirements.inference:
+            query["capabilities.inference"] = True
+        if requirements.models:
+            query["capabilities.models"] = {"$all": requirements.models}
+        if requirements.libraries:
+            query["capabilities.libraries"] = {"$all": requirements.libraries}
+        peers = await MongoDBManager().find_documents(
+            peers_collection, query, projection=Peer.Record.projection
+        )
+        return PexUtils.filter_capable_peers(
+            [Peer.Record.from_document(peer_dict) for peer_dict in peers], requirements
+        )
+
+    @staticmethod
+    async def count_peers() -> int:
+        """Number of known peers, read from the collection's metadata."""
+        return await MongoDBManager().estimated_document_count(peers_collection)
+
+    @staticmethod
+    async def get_known_ips(ips: List[str]) -> Set[str]:
+        """Returns the given ips that belong to a known peer."""
+        if not ips:
+            return set()
+        peers = await MongoDBManager().find_documents(
+            peers_collection, {"ip": {"$in": list(set(ips))}}, projection={"_id": 0, "ip": 1}
+        )
+        return {peer_dict["ip"] for peer_dict in peers}
+
+    @staticmethod
+    async def get_peers(ips: List[str]) -> List[Peer.Record]:
+        """Retrieve the known peers among the given ips."""
+        if not ips:
+            return []
+        peers = await MongoDBManager().find_documents(
+            peers_collection, {"ip": {"$in": list(set(ips))}}, projection=Peer.Record.projection
+        )
+        return [Peer.Record.from_document(peer_dict) for peer_dict in peers]
+
+    @staticmethod
+    async def get_peers_last_seen(
+        after: Optional[datetime] = None, before: Optional[datetime] = None
+    ) -> List[Peer.Record]:
+        """
+        Retrieve the peers last seen within the given time range, e.g. the peers that haven't been seen
+        for a while.
+        """
+        last_seen = {}
+        if after is not None:
+            last_seen["$gt"] = after.isoformat()
+        if before is not None:
+            last_seen["$lt"] = before.isoformat()
+        peers = await MongoDBManager().find_documents(
+            peers_collection,
+            {"last_seen": last_seen} if last_seen else {},
+            projection=Peer.Record.projection,
+        )
+        return [Peer.Record.from_document(peer_dict) for peer_dict in peers]
 
     @staticmethod
     async def get_random_peers(
         exclude_peers: Set[Peer.Internal] = None, filter_bad_peers: bool = True
-    ) -> List[Peer.Internal]:
+    ) -> List[Peer.Record]:
         """
         Retrieve a configurable random sample of peers from the database,
         excluding those in the exclude_peers set.
 
+        The sample is drawn by the database, only the sampled peers are read.
+
         Args:
             exclude_peers (Set[Peer.Internal]): A set of Peer.Internal objects to exclude from the results.
             filter_bad_peers (bool): Flag to filter out bad peers or not.
 
         Returns:
-            List[Peer.Internal]: A list containing the requested number of peers.
+            List[Peer.Record]: A list containing the requested number of peers.
         """
-        all_peers = await PexMongo.get_all_peers()
-        # Assuming PexUtils.filter_bad_peers is a method that filters out peers based on certain criteria.
-        all_peers = (
-            await PexUtils.filter_bad_peers(all_peers)
-            if filter_bad_peers
-            else all_peers
-        )
-
-        # Create a set of IP addresses for the peers to be excluded.
-        exclude_ips = {peer.ip for peer in exclude_peers} if exclude_peers else set()
-
-        # Filter out the excluded peers based on their IP addresses.
-        filtered_peers = [peer for peer in all_peers if peer.ip not in exclude_ips]
+        query = {}
+        if exclude_peers:
+            # Exclude the peers based on their IP addresses.
+            query["ip"] = {"$nin": list({peer.ip for peer in exclude_peers})}
+        if filter_bad_peers:
+            query["black_listed"] = False
 
         raw_share_peers = os.getenv("SHARE_PEERS", "50")  # Default set to 50.
 
@@ -418,7 +574,7 @@ class PexMongo:
             case "0":
                 return []
             case "-1":
-                return filtered_peers
+                pipeline = [{"$match": query}]
             case _:
                 try:
                     share_count = int(raw_share_peers)
@@ -430,21 +586,23 @@ class PexMongo:
                     raise ValueError(
                         "'SHARE_PEERS' must be a non-negative integer or -1"
                     )
+                if share_count == 0:
+                    return []
+                pipeline = [{"$match": query}, {"$sample": {"size": share_count}}]
 
-                available_peer_count = min(share_count, len(filtered_peers))
-                return (
-                    random.sample(filtered_peers, available_peer_count)
-                    if available_peer_count > 0
-                    else []
-                )
+        peers = await MongoDBManager().aggregate(
+            peers_collection, pipeline + [{"$project": Peer.Record.projection}]
+        )
+        peers = [Peer.Record.from_document(peer_dict) for peer_dict in peers]
+        # Assuming PexUtils.filter_bad_peers is a method that filters out peers based on certain criteria.
+        return await PexUtils.filter_bad_peers(peers) if filter_bad_peers else peers
 
     @staticmethod
     async def remove_peer(peer: Peer.Internal) -> bool:
         """
         Remove a peer from the database.
         """
-        peer_dict = peer.dict()
-        return await MongoDBManager().delete_document(peers_collection, peer_dict)
+        return await MongoDBManager().delete_document(peers_collection, {"ip": peer.ip})
 
     @staticmethod
     async def update_peer(
@@ -455,7 +613,7 @@ class PexMongo:
         """
         result = await MongoDBManager().update_document(
             collection_name=peers_collection,
-            query=old_peer.dict(),
+            query={"ip": old_peer.ip},
             update=new_peer.dict(),
         )
         return new_peer if result else None
@@ -465,7 +623,9 @@ class PexMongo:
         """
         Get an individual peer by their IP address.
         """
-        peer_dict = await MongoDBManager().find_documents(peers_collection, {"ip": ip})
+        peer_dict = await MongoDBManager().find_documents(
+            peers_collection, {"ip": ip}, limit=1, projection={"_id": 0}
+        )
         if peer_dict:
             return Peer.Internal(**peer_dict[0])
         return None
@@ -477,29 +637,23 @@ class PexMongo:
         """
         Append a new request record to the peer's request history and update the 'last seen' timestamp.
         If the peer doesn't exist, create a new peer and add the request history.
+
+        Done in a single atomic upsert, concurrent requests from a new ip can't create the peer twice.
         """
         current_time = datetime.utcnow().isoformat()
-        update_result = False
-
-        peer_dict = {"ip": client_ip}
-        peer_exists = await MongoDBManager().find_documents(peers_collection, peer_dict)
 
-        if not peer_exists:
-            # If the peer doesn't exist, create a new peer and add the request history
-            new_peer = Peer.Internal(
-                ip=client_ip, request_history=[request_info], last_seen=current_time
-            )
-            await MongoDBManager().insert_document(peers_collection, new_peer.dict())
-            update_result = True
-        else:
-            # If the peer exists, update the request history and 'last seen' timestamp
-            update_result = await MongoDBManager().update_document(
-                peers_collection,
-                {"ip": client_ip},
-                {
-                    "$push": {"request_history": request_info.dict()},
-                    "$set": {"last_seen": current_time},
-                },
-            )
+        # Fields of a new peer, request_history and last_seen are set by the update itself
+        new_peer = Peer.Internal(ip=client_ip).dict(exclude={"ip", "request_history", "last_seen"})
+
+        update_result = await MongoDBManager().update_document(
+            peers_collection,
+            {"ip": client_ip},
+            {
+                "$push": {"request_history": request_info.dict()},
+                "$set": {"last_seen": current_time},
+                "$setOnInsert": new_peer,
+            },
+            upsert=True,
+        )
 
         return bool(update_result)
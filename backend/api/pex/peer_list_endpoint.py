@@ -1,15 +1,16 @@
 # Return peer_list when requested by other peers
 # TODO: Review and delete this? Might not be necissary now that /register sort of acts like an all in one endpoint for pex.
 
-import traceback
 from typing import Dict, Any
 
 from fastapi import APIRouter, HTTPException
 
 from ...api.pex import PexMongo
 from ...utils import Peer
+from ...utils.logger import Logger
 
 router = APIRouter()
+logger = Logger.get("pex")
 
 
 @router.get(
@@ -28,5 +29,5 @@ async def peer_list_endpoint() -> Dict[str, Any]:
             "status_code": 200,
         }
     except Exception as e:
-        print(traceback.format_exc())
+        logger.exception("Failed to get the peer list")
         raise HTTPException(status_code=500, detail=str(e))
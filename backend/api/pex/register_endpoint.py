@@ -1,16 +1,17 @@
 # Accepts peer registration requests
 
 import copy
-import traceback
 from typing import Dict, Any
 
 from fastapi import HTTPException
 
 from ...api.pex import PexMongo
 from ...utils import Utils, Peer
+from ...utils.logger import Logger
 
 
 router = Utils.router
+logger = Logger.get("pex")
 
 
 @router.post(
@@ -79,5 +80,5 @@ async def register_endpoint(peer: Peer.Public) -> Dict[str, Any]:
             "status_code": 200,
         }
     except Exception as e:
-        print(traceback.format_exc())
+        logger.exception("Failed to register peer %s", peer.ip)
         raise HTTPException(status_code=500, detail=str(e))
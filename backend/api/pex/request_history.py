@@ -0,0 +1,192 @@
+"""
+Retention of the request history kept on every peer document by the request logger middleware.
+
+Raw request records (including request and response bodies) are only kept for HISTORY_RETENTION_HOURS.
+Older records are rolled into per peer, per endpoint, per hour aggregates in the request_rollups
+collection: request count, status code distribution and a latency histogram from which percentiles are
+estimated. Rollups themselves expire after ROLLUP_RETENTION_DAYS, so storage and the cost of reading a
+peer stay bounded however long a node runs.
+
+Compaction runs incrementally as a scheduled task in one worker of the node, every run handles at most
+HISTORY_COMPACTION_BATCH peers and HISTORY_COMPACTION_RECORDS records per peer so that a backlog never
+stalls the node.
+"""
+
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from . import peers_collection
+from ...utils.metrics import metrics
+from ...utils.mongo import MongoDBManager
+from ...utils.scheduler import scheduler
+
+rollups_collection = "request_rollups"
+
+retention_hours = float(os.getenv("HISTORY_RETENTION_HOURS", 24))
+rollup_retention_days = float(os.getenv("ROLLUP_RETENTION_DAYS", 90))
+compaction_batch = int(os.getenv("HISTORY_COMPACTION_BATCH", 200))
+compaction_records = int(os.getenv("HISTORY_COMPACTION_RECORDS", 1000))
+
+# Upper bounds of the latency histogram buckets in milliseconds, stored as field names of the rollups
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+compacted_records = metrics.counter(
+    "bitorch_request_history_compacted_total", "Raw request records rolled up and removed."
+)
+
+
+class RequestHistory:
+    @staticmethod
+    async def create_indexes():
+        # Peers with records older than the retention, kept small by the compaction itself
+        await MongoDBManager().create_index(peers_collection, [("request_history.timestamp", 1)])
+        await MongoDBManager().create_index(
+            rollups_collection, [("ip", 1), ("endpoint", 1), ("hour", 1)], unique=True
+        )
+        await MongoDBManager().create_index(
+            rollups_collection,
+            [("hour", 1)],
+            expireAfterSeconds=int(rollup_retention_days * 86400),
+        )
+
+    @scheduler.schedule_task(
+        trigger="delay",
+        seconds=int(os.getenv("HISTORY_COMPACTION_INTERVAL", 300)),
+        timeout=120,
+        lease=True,
+        id="request_history_compaction",
+    )
+    @staticmethod
+    async def compact() -> int:
+        """
+        Rolls up and removes the request records older than the retention of up to
+        HISTORY_COMPACTION_BATCH peers. Returns the number of removed records.
+
+        Rollups are incremented before the records are removed, a run interrupted in between counts
+        those records again on the next run rather than losing them.
+        """
+        cutoff = (datetime.utcnow() - timedelta(hours=retention_hours)).isoformat()
+        peers = await MongoDBManager().aggregate(
+            peers_collection,
+            [
+                {"$match": {"request_history.timestamp": {"$lt": cutoff}}},
+                {"$limit": compaction_batch},
+                {
+                    "$project": {
+                        "_id": 0,
+                        "ip": 1,
+                        "request_history": {
+                            "$slice": [
+                                {
+                                    "$filter": {
+                                        "input": "$request_history",
+                                        "as": "request",
+                                        "cond": {"$lt": ["$$request.timestamp", cutoff]},
+                                    }
+                                },
+                                compaction_records,
+                            ]
+                        },
+                    }
+                },
+            ],
+        )
+
+        rollups: Dict[Tuple[str, str, datetime], Dict[str, Any]] = {}
+        removals = []
+        removed = 0
+        for peer in peers:
+            records = sorted(peer["request_history"], key=lambda record: record["timestamp"])
+            peer_cutoff = cutoff
+            if len(records) == compaction_records:
+                # More old records are left, only the ones older than the last record read are
+                # removed so that records with the same timestamp aren't dropped without a rollup
+                peer_cutoff = records[-1]["timestamp"]
+                records = [record for record in records if record["timestamp"] < peer_cutoff]
+            for record in records:
+                RequestHistory.add_to_rollup(rollups, peer["ip"], record)
+            removals.append(
+                UpdateOne(
+                    {"ip": peer["ip"]},
+                    {"$pull": {"request_history": {"timestamp": {"$lt": peer_cutoff}}}},
+                )
+            )
+            removed += len(records)
+
+        await MongoDBManager().bulk_write(
+            rollups_collection,
+            [
+                UpdateOne(
+                    {"ip": ip, "endpoint": endpoint, "hour": hour},
+                    {"$inc": increments},
+                    upsert=True,
+                )
+                for (ip, endpoint, hour), increments in rollups.items()
+            ],
+        )
+        await MongoDBManager().bulk_write(peers_collection, removals)
+        compacted_records.inc(removed)
+        return removed
+
+    @staticmethod
+    def add_to_rollup(
+        rollups: Dict[Tuple[str, str, datetime], Dict[str, Any]], ip: str, record: Dict[str, Any]
+    ) -> None:
+        """Adds a raw request record to the $inc update of its peer, endpoint and hour."""
+        try:
+            hour = datetime.fromisoformat(record["timestamp"]).replace(minute=0, second=0, microsecond=0)
+        except (KeyError, TypeError, ValueError):
+            return
+        increments = rollups.setdefault((ip, record.get("endpoint", ""), hour), {})
+
+        def inc(field: str, amount: float = 1) -> None:
+            increments[field] = increments.get(field, 0) + amount
+
+        inc("count")
+        inc(f"status.{record.get('response_code', 'unknown')}")
+        duration_ms = record.get("duration_ms")
+        if duration_ms is not None:
+            inc("duration_ms_sum", duration_ms)
+            bucket = next((bound for bound in LATENCY_BUCKETS_MS if duration_ms <= bound), "inf")
+            inc(f"latency_ms.{bucket}")
+
+    @staticmethod
+    def percentile(latency_ms: Dict[str, int], q: float) -> Optional[float]:
+        """
+        Estimates a latency percentile (q between 0 and 1) from the histogram of a rollup, interpolating
+        linearly within the bucket it falls in.
+        """
+        total = sum(latency_ms.values())
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        lower = 0
+        for bound in LATENCY_BUCKETS_MS:
+            count = latency_ms.get(str(bound), 0)
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return float(LATENCY_BUCKETS_MS[-1])  # In the unbounded bucket
+
+    @staticmethod
+    async def get_rollups(ip: str, since: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """
+        Returns the hourly request rollups of a peer, oldest first, with their p50, p90 and p99 latency
+        estimates in milliseconds.
+        """
+        query: Dict[str, Any] = {"ip": ip}
+        if since is not None:
+            query["hour"] = {"$gte": since}
+        rollups = await MongoDBManager().find_documents(
+            rollups_collection, query, sort=[("hour", 1)], projection={"_id": 0}
+        )
+        for rollup in rollups:
+            latency_ms = rollup.get("latency_ms", {})
+            for name, q in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99)):
+                rollup[name] = RequestHistory.percentile(latency_ms, q)
+        return rollups
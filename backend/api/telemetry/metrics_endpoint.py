@@ -0,0 +1,24 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from ...utils.metrics import metrics
+
+router = APIRouter()
+
+
+@router.get(
+    "/metrics",
+    tags=["Telemetry"],
+    summary="Prometheus metrics",
+    description="Returns the metrics of the worker process handling the request in the Prometheus text exposition format: request latency per route, inference latency breakdown and throughput per model, database operation latency and trace span durations.",
+    response_class=PlainTextResponse,
+)
+async def metrics_endpoint() -> PlainTextResponse:
+    """
+    Example response:
+        # HELP bitorch_inference_time_to_first_token_seconds Time from receiving a request to generating its first token, including queueing and model loading.
+        # TYPE bitorch_inference_time_to_first_token_seconds histogram
+        bitorch_inference_time_to_first_token_seconds_bucket{model="mistral-7b-openorca.gguf2.Q4_0.gguf",le="0.5"} 3
+        ...
+    """
+    return PlainTextResponse(metrics.render(), media_type=metrics.content_type)
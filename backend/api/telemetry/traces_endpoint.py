@@ -0,0 +1,44 @@
+from typing import Dict, Any
+
+from fastapi import APIRouter, Query
+
+from ...utils.metrics import Tracing
+
+router = APIRouter()
+
+
+@router.get(
+    "/telemetry/traces",
+    tags=["Telemetry"],
+    summary="Get recent request traces",
+    description="Returns the spans of the most recent requests handled by this worker process, e.g. middleware, database calls and model execution, to see where the time of slow requests goes.",
+)
+async def traces_endpoint(
+    limit: int = Query(20, ge=1, le=1000),
+    min_duration: float = Query(0.0, ge=0, description="Only return traces slower than this many seconds"),
+) -> Dict[str, Any]:
+    """
+    Example response:
+        {
+            "content": [
+                {
+                    "trace_id": "5f1c...",
+                    "name": "POST /inference-request",
+                    "started": 1718000000.12,
+                    "duration": 3.41,
+                    "attributes": {"method": "POST", "route": "/inference-request", "status": 200},
+                    "spans": [
+                        {"name": "request_logger.read_body", "start": 0.0001, "duration": 0.0002, "parent": null, "attributes": {}},
+                        {"name": "inference.generate", "start": 0.004, "duration": 3.39, "parent": null, "attributes": {"model": "..."}},
+                        {"name": "inference.queue_wait", "start": 0.005, "duration": 0.8, "parent": 1, "attributes": {}},
+                        ...
+                    ]
+                }
+            ],
+            "status_code": 200
+        }
+    """
+    return {
+        "content": [trace.dict() for trace in Tracing.get_traces(limit, min_duration)],
+        "status_code": 200,
+    }
@@ -1,4 +1,3 @@
-import logging
 from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
@@ -6,6 +5,7 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from .utils import Utils
+from .utils.logger import Logger
 from .utils.tasks import StartupTasks
 from .utils.scheduler import scheduler
 from .middleware import setup_middlewares
@@ -20,7 +20,7 @@ async def app_lifespan(app: FastAPI):
 
     if Utils.env == "development":
         result = await MongoDBManager().test()
-        print("INFO: Mongo test", "passed" if result else "failed")
+        Logger.get("mongo").info("Mongo test %s", "passed" if result else "failed")
 
     await StartupTasks.run()
     scheduler.run()
@@ -55,8 +55,5 @@ app.add_middleware(
 
 app.include_router(api_router)
 
-# Configure the logging format and level
-logging.basicConfig(
-    format="%(levelname)s: %(message)s",
-    level=logging.INFO,  # TODO: Set based on the env: development/deployment or whatever, maybe even a logging env var to set the logging level.
-)
+# Structured logging through a background thread, levels and format are set with LOG_* env vars
+Logger.setup()
@@ -4,8 +4,10 @@ from starlette.middleware.base import BaseHTTPMiddleware
 
 
 def setup_middlewares(app):
+    # Middlewares added last run first, files are added in alphabetical order so that e.g. telemetry
+    # wraps the request logger.
     middleware_dir = os.path.dirname(__file__)
-    for filename in os.listdir(middleware_dir):
+    for filename in sorted(os.listdir(middleware_dir)):
         if filename.endswith(".py") and filename != "__init__.py":
             module_name = filename[:-3]  # Remove the ".py" extension
             spec = importlib.util.spec_from_file_location(
@@ -1,4 +1,5 @@
 import json
+import time
 from datetime import datetime
 
 from fastapi import Request
@@ -6,20 +7,28 @@ from starlette.types import ASGIApp
 from starlette.middleware.base import BaseHTTPMiddleware
 
 from backend.utils import Peer
+from backend.utils.metrics import Tracing
 from backend.api.pex import PexMongo
 
 # TODO: Sanatize request info before logging to db
 
 
 class ResponseBodyLogger:
-    def __init__(self, body_iterator, callback):
+    """
+    Passes the chunks of a response body through and calls back with the whole body once it was sent.
+    Bodies that aren't logged (capture=False, e.g. binary content) aren't kept in memory.
+    """
+
+    def __init__(self, body_iterator, callback, capture: bool = True):
         self._body_iterator = body_iterator
         self._callback = callback
+        self._capture = capture
         self._response_body_chunks = []
 
     async def __aiter__(self):
         async for chunk in self._body_iterator:
-            self._response_body_chunks.append(chunk)
+            if self._capture:
+                self._response_body_chunks.append(chunk)
             yield chunk
         await self._callback(b"".join(self._response_body_chunks))
 
@@ -27,13 +36,20 @@ class ResponseBodyLogger:
 class RequestLoggerMiddleware(BaseHTTPMiddleware):
     """
     Middleware for logging request and response information using PexMongo for analytics and monitoring of peers
-    on the network making requests.
+    on the network making requests. Health probes are polled every few seconds and aren't logged.
     """
 
-    async def log_response_body(self, request, response, req_body):
+    excluded_paths = ("/health", "/ready")
+
+    @staticmethod
+    def is_text(response) -> bool:
+        content_type = response.headers.get("content-type", "")
+        return content_type.startswith("text") or content_type == "application/json"
+
+    async def log_response_body(self, request, response, req_body, start):
         async def callback(res_body):
-            content_type = response.headers.get("content-type", "")
-            if content_type.startswith("text") or content_type == "application/json":
+            duration_ms = (time.perf_counter() - start) * 1000
+            if self.is_text(response):
                 try:
                     decoded_body = res_body.decode("utf-8")
                 except UnicodeDecodeError as e:
@@ -42,7 +58,8 @@ class RequestLoggerMiddleware(BaseHTTPMiddleware):
                 # For binary content types, just show a place holder value as we don't want to store that in the db.
                 decoded_body = "<Binary content not shown>"
 
-            await self.update_peer_history(request, response, req_body, decoded_body)
+            with Tracing.span("request_logger.update_peer_history"):
+                await self.update_peer_history(request, response, req_body, decoded_body, duration_ms)
 
         return callback
 
@@ -57,8 +74,14 @@ class RequestLoggerMiddleware(BaseHTTPMiddleware):
         Returns:
         - ASGIApp: The ASGI application response.
         """
+        if request.url.path in self.excluded_paths:
+            return await call_next(request)
+
+        start = time.perf_counter()
+
         # Read request body:
-        body_bytes = await request.body()
+        with Tracing.span("request_logger.read_body"):
+            body_bytes = await request.body()
 
         # Attempt to decode as utf-8, but fallback to raw bytes if decoding fails
         try:
@@ -79,18 +102,20 @@ class RequestLoggerMiddleware(BaseHTTPMiddleware):
         # Wrap the body_iterator of the response for streaming responses
         response.body_iterator = ResponseBodyLogger(
             response.body_iterator,
-            await self.log_response_body(request, response, req_body),
+            await self.log_response_body(request, response, req_body, start),
+            capture=self.is_text(response),
         )
         return response
 
     @staticmethod
-    async def update_peer_history(request, response, req_body, res_body):
+    async def update_peer_history(request, response, req_body, res_body, duration_ms=None):
         """
         Update peer history and _last_seen with request and response information in PexMongo.
 
         Args:
         - request (Request): The incoming request.
         - response (Response): The outgoing response.
+        - duration_ms (float): Time from receiving the request to sending the last byte of the response.
         """
         # TODO: Ensure this is logging the incoming request regardless of a response. if the request is rejected then it should be logged as such and for what reason.
 
@@ -122,6 +147,7 @@ class RequestLoggerMiddleware(BaseHTTPMiddleware):
             res_body=res_body,
             headers=sanitized_headers,
             response_code=str(response.status_code),
+            duration_ms=round(duration_ms, 3) if duration_ms is not None else None,
         )
 
         # Log the request info with PexMongo
@@ -0,0 +1,83 @@
+import time
+
+from fastapi import Request
+from starlette.types import ASGIApp
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from backend.utils.metrics import metrics, Tracing
+from backend.utils.profiler import Profiler
+
+http_requests = metrics.counter(
+    "bitorch_http_requests_total",
+    "HTTP requests handled, by route template, method and status code.",
+    labels=["route", "method", "status"],
+)
+http_seconds = metrics.histogram(
+    "bitorch_http_request_duration_seconds",
+    "Time from receiving a request to sending the last byte of its response.",
+    labels=["route", "method"],
+)
+http_in_flight = metrics.gauge(
+    "bitorch_http_requests_in_flight", "Requests being handled, including streaming responses."
+)
+
+
+class TelemetryMiddleware(BaseHTTPMiddleware):
+    """
+    Starts a trace for every request and records its duration per route. The trace is finished once the
+    last byte of the response is sent, so streamed responses are measured in full. Spans finished before
+    the response starts are reported in the Server-Timing header.
+
+    Sampled requests of the routes selected for profiling are also profiled, see Profiler.
+    """
+
+    @staticmethod
+    def route_template(request: Request) -> str:
+        # The path template rather than the path keeps the number of label values bounded
+        route = request.scope.get("route")
+        return getattr(route, "path", None) or "<unmatched>"
+
+    async def dispatch(self, request: Request, call_next) -> ASGIApp:
+        start = time.perf_counter()
+        trace = Tracing.start_trace(f"{request.method} {request.url.path}", method=request.method)
+        profile = Profiler.start(request.method, request.url.path)
+        http_in_flight.inc()
+        finished = False
+
+        def finish(status_code: int):
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            route = TelemetryMiddleware.route_template(request)
+            http_in_flight.dec()
+            http_requests.inc(route=route, method=request.method, status=status_code)
+            http_seconds.observe(time.perf_counter() - start, route=route, method=request.method)
+            if trace is not None:
+                trace.attributes.update(route=route, status=status_code)
+                Tracing.finish_trace(trace)
+            Profiler.finish(profile, route, status_code)
+
+        try:
+            response = await call_next(request)
+        except BaseException:
+            finish(500)
+            raise
+
+        if trace is not None:
+            response.headers["X-Trace-Id"] = trace.trace_id
+            server_timing = trace.server_timing()
+            if server_timing:
+                response.headers["Server-Timing"] = server_timing
+
+        body_iterator = response.body_iterator
+
+        async def timed_iterator():
+            try:
+                async for chunk in body_iterator:
+                    yield chunk
+            finally:
+                finish(response.status_code)
+
+        response.body_iterator = timed_iterator()
+        return response
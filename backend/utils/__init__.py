@@ -4,7 +4,9 @@ import os
 import re
 import sys
 import json
+import time
 import socket
+import importlib
 from bson import ObjectId
 from datetime import datetime
 from ipaddress import ip_address, IPv4Address, IPv6Address
@@ -15,6 +17,11 @@ import httpx
 from fastapi import APIRouter
 from fastapi.routing import APIRoute
 
+from .capabilities import Capabilities
+from .logger import Logger
+
+logger = Logger.get("utils")
+
 
 class Utils:
     @staticmethod
@@ -88,6 +95,7 @@ class Utils:
             "ip": await Utils.get_ip_address(),
             "port": os.getenv("BACKEND_PORT"),
             "name": os.getenv("PEER_NAME"),
+            "capabilities": Capabilities.get_manifest(),
         }
         return Peer.Public(**peer_info)
 
@@ -111,6 +119,41 @@ class Utils:
 
     router = APIRouter(route_class=BitorchAPIRoute)
 
+    startup_profile = os.getenv("STARTUP_PROFILE", "false").lower() in ("1", "true", "yes")
+
+    class LazyImport:
+        """
+        Stand-in for a heavy module (torch, diffusers, gpt4all, etc.) that is only imported the first
+        time one of its attributes is accessed. Endpoint files declare their heavy dependencies with
+        this so that mounting the api routes stays cheap and nodes that never serve a route never pay
+        for its imports.
+
+        Example:
+            torch = Utils.LazyImport("torch")
+            torch.float16  # torch is imported here, not when the endpoint file is mounted.
+        """
+
+        def __init__(self, module_name: str):
+            self.module_name = module_name
+            self._module = None
+
+        @property
+        def loaded(self) -> bool:
+            return self._module is not None
+
+        def load(self):
+            if self._module is None:
+                start = time.perf_counter()
+                self._module = importlib.import_module(self.module_name)
+                if Utils.startup_profile:
+                    logger.info(
+                        "Lazy import of '%s' took %.3fs", self.module_name, time.perf_counter() - start
+                    )
+            return self._module
+
+        def __getattr__(self, name: str):
+            return getattr(self.load(), name)
+
 
 class Peer:
     class Public(BaseModel):
@@ -128,6 +171,7 @@ class Peer:
         ip: str = Field(..., example="127.0.0.1", max_length=45)
         port: Optional[int] = Field(None, gt=1023, lt=65536, example=8080)
         name: Optional[str] = Field(None, max_length=100)
+        capabilities: Optional[Capabilities.Manifest] = None  # Advertised during /register, None for peers that don't advertise.
 
         @validator("ip")
         def validate_ip(cls, v: str) -> str:
@@ -250,6 +294,97 @@ class Peer:
             # Return a Public instance with those fields
             return Peer.Public(**public_attrs)
 
+    class Record:
+        """
+        Compact read only view of a stored peer for internal bookkeeping, e.g. sampling the peer list or
+        picking peers able to serve a request. Stored peers were validated as Peer.Internal before they
+        were written, so records are built straight from the documents without running the validators
+        again, and without the request history. The capability manifest is only parsed when accessed.
+
+        Use Peer.Internal for peers received from the network and for updating stored peers.
+        """
+
+        __slots__ = (
+            "ip",
+            "port",
+            "name",
+            "last_seen",
+            "activated",
+            "registered",
+            "white_listed",
+            "black_listed",
+            "rate_limited",
+            "complies_with_network_standards",
+            "_capabilities",
+        )
+
+        # Document fields read by from_document, request_history is left in the database
+        projection = {"_id": 0, "request_history": 0}
+
+        def __init__(
+            self,
+            ip: str,
+            port: Optional[int] = None,
+            name: Optional[str] = None,
+            last_seen: str = "",
+            activated: bool = False,
+            registered: bool = False,
+            white_listed: bool = False,
+            black_listed: bool = False,
+            rate_limited: str = "",
+            complies_with_network_standards: bool = True,
+            capabilities: Union[Dict[str, Any], Capabilities.Manifest, None] = None,
+        ):
+            self.ip = ip
+            self.port = port
+            self.name = name
+            self.last_seen = last_seen
+            self.activated = activated
+            self.registered = registered
+            self.white_listed = white_listed
+            self.black_listed = black_listed
+            self.rate_limited = rate_limited
+            self.complies_with_network_standards = complies_with_network_standards
+            self._capabilities = capabilities
+
+        @classmethod
+        def from_document(cls, document: Dict[str, Any]) -> "Peer.Record":
+            get = document.get
+            return cls(
+                document["ip"],
+                get("port"),
+                get("name"),
+                get("last_seen", ""),
+                get("activated", False),
+                get("registered", False),
+                get("white_listed", False),
+                get("black_listed", False),
+                get("rate_limited", ""),
+                get("complies_with_network_standards", True),
+                get("capabilities"),
+            )
+
+        @property
+        def capabilities(self) -> Optional[Capabilities.Manifest]:
+            if isinstance(self._capabilities, dict):
+                self._capabilities = Capabilities.Manifest.parse_obj(self._capabilities)
+            return self._capabilities
+
+        def to_public(self) -> "Peer.Public":
+            return Peer.Public.construct(
+                ip=self.ip, port=self.port, name=self.name, capabilities=self.capabilities
+            )
+
+        def to_internal(self) -> "Peer.Internal":
+            """Validated Peer.Internal of the record, with an empty request history."""
+            return Peer.Internal(
+                **{field: getattr(self, field) for field in self.__slots__[:-1]},
+                capabilities=self.capabilities,
+            )
+
+        def __repr__(self) -> str:
+            return f"Peer.Record(ip={self.ip!r}, port={self.port!r}, name={self.name!r})"
+
     class RequestInfo(BaseModel):
         timestamp: str
         request_type: str
@@ -259,18 +394,19 @@ class Peer:
         req_body: Optional[Any] = Field(default=None)
         res_body: Optional[Any] = Field(default=None)
         headers: Optional[Dict[str, str]] = Field(default=None)
+        duration_ms: Optional[float] = Field(default=None)  # Until the last byte of the response was sent
 
     # TODO: Handle validation and sanatization, ensure that we save requests, but disregard malicous params, headers, or form data, and the request.
 
     T = TypeVar("T", bound=Union[Iterable[Any], Dict[str, Any]])
 
     @staticmethod
-    def to_public(data: Union[T, "Peer.Public", "Peer.Internal"]) -> T:
+    def to_public(data: Union[T, "Peer.Public", "Peer.Internal", "Peer.Record"]) -> T:
         """
-        Converts Peer.Internal instances to their public representation, and passes
+        Converts Peer.Internal instances and Peer.Record instances to their public representation, and passes
         Peer.Public instances directly. For iterables and dictionaries, it applies conversion recursively.
         """
-        if isinstance(data, Peer.Internal):
+        if isinstance(data, (Peer.Internal, Peer.Record)):
             return data.to_public()
         elif isinstance(data, Peer.Public):
             # Public instances are returned without modification
@@ -0,0 +1,100 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+
+class LRUCache:
+    """
+    Thread safe least recently used cache bounded by the total size of its entries rather than their
+    count, so that entries of very different sizes (model contexts, responses, images) can share one
+    memory budget.
+
+    The size of an entry is given by the caller when it is stored. When storing an entry would go over
+    the budget the least recently used entries are evicted first, on_evict is called with every evicted
+    key and value outside of the cache's lock so that it can release resources held by the value.
+    """
+
+    def __init__(
+        self, max_bytes: int, on_evict: Optional[Callable[[Hashable, Any], None]] = None
+    ):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.size = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the value of a key and marks it as the most recently used entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> bool:
+        """
+        Stores a value, evicting least recently used entries until it fits in the budget.
+
+        Returns:
+        - bool: False if the value is larger than the whole budget, it is then passed to on_evict
+          right away instead of being stored.
+        """
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+                if previous[0] is not value:
+                    evicted.append((key, previous[0]))
+
+            stored = size <= self.max_bytes
+            if stored:
+                while self._entries and self.size + size > self.max_bytes:
+                    evicted_key, (evicted_value, evicted_size) = self._entries.popitem(last=False)
+                    self.size -= evicted_size
+                    evicted.append((evicted_key, evicted_value))
+                self._entries[key] = (value, size)
+                self.size += size
+            else:
+                evicted.append((key, value))
+
+        self._evict(evicted)
+        return stored
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Removes a key without calling on_evict, e.g. to take ownership of its value."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.size -= entry[1]
+            return entry[0]
+
+    def pop_lru(self) -> Optional[Tuple[Hashable, Any]]:
+        """Removes the least recently used entry without calling on_evict and returns (key, value)."""
+        with self._lock:
+            if not self._entries:
+                return None
+            key, (value, size) = self._entries.popitem(last=False)
+            self.size -= size
+            return key, value
+
+    def clear(self) -> None:
+        with self._lock:
+            evicted = [(key, value) for key, (value, _) in self._entries.items()]
+            self._entries.clear()
+            self.size = 0
+        self._evict(evicted)
+
+    def _evict(self, evicted) -> None:
+        if self.on_evict is None:
+            return
+        for key, value in evicted:
+            self.on_evict(key, value)
@@ -0,0 +1,180 @@
+import os
+import shutil
+import subprocess
+import importlib.util
+from pydantic import BaseModel, Field
+from typing import List, Dict, Optional
+
+
+class Capabilities:
+    """
+    Describes what this node is able to serve (hardware, RAM, installed models and libraries, max
+    concurrency). The manifest decides which api routes get mounted in backend/api/__init__.py and is
+    advertised to other peers during /register so requesters only send work to nodes that can serve it.
+
+    Detection is done once per process and is intentionally cheap, heavy libraries like torch are only
+    looked up with importlib.util.find_spec and never imported here.
+    """
+
+    class Shard(BaseModel):
+        """Contiguous block of layers [start, end) of a pipeline parallel model hosted by a node."""
+
+        start: int = Field(..., ge=0)
+        end: int = Field(..., gt=0)
+
+    class Manifest(BaseModel):
+        cpu_count: int = Field(0, ge=0)
+        ram_mb: int = Field(0, ge=0)
+        gpus: List[str] = Field(default_factory=list, max_items=64)
+        libraries: List[str] = Field(default_factory=list, max_items=64)
+        models: List[str] = Field(default_factory=list, max_items=1024)
+        max_concurrency: int = Field(1, ge=0)
+        inference: bool = True  # False for light nodes that only take part in pex
+        shards: Dict[str, "Capabilities.Shard"] = Field(default_factory=dict)  # model_id -> hosted layers
+
+        def satisfies(self, requirements: "Capabilities.Requirements") -> bool:
+            return not self.missing(requirements)
+
+        def missing(self, requirements: "Capabilities.Requirements") -> List[str]:
+            """
+            Returns a human readable list of requirements this manifest does not meet, empty if the
+            requirements are met.
+            """
+            missing = []
+            if requirements.inference and not self.inference:
+                missing.append("inference disabled")
+            if requirements.gpu and not self.gpus:
+                missing.append("gpu")
+            if requirements.min_ram_mb and self.ram_mb < requirements.min_ram_mb:
+                missing.append(f"{requirements.min_ram_mb}MB ram")
+            missing.extend(
+                f"library '{library}'"
+                for library in requirements.libraries
+                if library not in self.libraries
+            )
+            missing.extend(
+                f"model '{model}'" for model in requirements.models if model not in self.models
+            )
+            return missing
+
+    class Requirements(BaseModel):
+        """
+        Declared at module level in an endpoint file as `requirements = Capabilities.Requirements(...)`,
+        the file's router is only mounted if this node's manifest satisfies it.
+        """
+
+        inference: bool = False
+        gpu: bool = False
+        min_ram_mb: int = 0
+        libraries: List[str] = Field(default_factory=list)
+        models: List[str] = Field(default_factory=list)
+
+    # Libraries that inference routes may depend on, checked for availability without importing them.
+    known_libraries = ["torch", "diffusers", "transformers", "accelerate", "gpt4all"]
+    model_path = os.path.join("models")
+
+    _manifest: Optional["Capabilities.Manifest"] = None
+
+    @staticmethod
+    def get_manifest() -> "Capabilities.Manifest":
+        """
+        Returns this node's capability manifest, detecting it on first call.
+        """
+        if Capabilities._manifest is None:
+            Capabilities._manifest = Capabilities.detect()
+        return Capabilities._manifest
+
+    @staticmethod
+    def detect() -> "Capabilities.Manifest":
+        """
+        Detects the capabilities of this node. Each value can be overridden with an env var:
+        - HOST_INFERENCE: set to false for a light node that doesn't mount inference routes.
+        - MAX_CONCURRENCY: max number of inference requests this node runs at once.
+        - NODE_GPUS: comma separated list of gpu names, set to an empty string to disable gpus.
+        - PIPELINE_SHARDS: layer blocks of pipeline parallel models hosted by this node, e.g.
+          "tiny-mlp:0-4,other-model:12-24".
+        """
+        cpu_count = os.cpu_count() or 1
+        inference = os.getenv("HOST_INFERENCE", "true").lower() not in ("0", "false", "no")
+
+        try:
+            max_concurrency = int(os.getenv("MAX_CONCURRENCY", 1))
+        except ValueError:
+            raise ValueError("Environment variable 'MAX_CONCURRENCY' must be an integer")
+
+        libraries = [
+            library
+            for library in Capabilities.known_libraries
+            if importlib.util.find_spec(library) is not None
+        ]
+
+        return Capabilities.Manifest(
+            cpu_count=cpu_count,
+            ram_mb=Capabilities.get_ram_mb(),
+            gpus=Capabilities.get_gpus(),
+            libraries=libraries,
+            models=Capabilities.get_installed_models(),
+            max_concurrency=max_concurrency if inference else 0,
+            inference=inference,
+            shards=Capabilities.get_shards() if inference and "torch" in libraries else {},
+        )
+
+    @staticmethod
+    def get_shards() -> Dict[str, "Capabilities.Shard"]:
+        shards = {}
+        for entry in os.getenv("PIPELINE_SHARDS", "").split(","):
+            if not entry.strip():
+                continue
+            try:
+                model_id, layers = entry.strip().rsplit(":", 1)
+                start, end = (int(layer) for layer in layers.split("-"))
+            except ValueError:
+                raise ValueError(
+                    f"Invalid PIPELINE_SHARDS entry '{entry}', expected 'model_id:start-end'"
+                )
+            shards[model_id] = Capabilities.Shard(start=start, end=end)
+        return shards
+
+    @staticmethod
+    def get_ram_mb() -> int:
+        try:
+            return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+        except (ValueError, OSError, AttributeError):
+            return 0  # Not available on this platform
+
+    @staticmethod
+    def get_gpus() -> List[str]:
+        """
+        Lists the names of the CUDA gpus on this node using nvidia-smi, so that torch doesn't need to be
+        imported just to find out if there is a gpu.
+        """
+        env_gpus = os.getenv("NODE_GPUS")
+        if env_gpus is not None:
+            return [gpu.strip() for gpu in env_gpus.split(",") if gpu.strip()]
+
+        if os.getenv("CUDA_VISIBLE_DEVICES") == "" or not shutil.which("nvidia-smi"):
+            return []
+
+        try:
+            result = subprocess.run(
+                ["nvidia-smi", "--query-gpu=name", "--format=csv,noheader"],
+                capture_output=True,
+                text=True,
+                timeout=5,
+            )
+        except (OSError, subprocess.SubprocessError):
+            return []
+        if result.returncode != 0:
+            return []
+        return [line.strip() for line in result.stdout.splitlines() if line.strip()]
+
+    @staticmethod
+    def get_installed_models() -> List[str]:
+        if not os.path.isdir(Capabilities.model_path):
+            return []
+        return sorted(
+            entry for entry in os.listdir(Capabilities.model_path) if not entry.startswith(".")
+        )
+
+
+Capabilities.Manifest.update_forward_refs()
@@ -0,0 +1,110 @@
+"""
+Ownership of periodic jobs between the worker processes of a node.
+
+Every worker runs its own scheduler, jobs whose work only touches the database take a lease in Mongo
+before running so that they run once per node however many workers there are. A lease is held by one
+worker until it stops renewing it, the worker that owns a job keeps running it on every interval and
+another worker takes over once the lease expires, e.g. after the owner crashed.
+
+Large jobs can be sharded instead: every live worker announces itself with a heartbeat, and a sharded
+job run by worker i of n handles the items whose crc32(key) % n == i, e.g. the peers of its share of
+the ip space. Workers joining or leaving rebalance the shards on the next heartbeat.
+"""
+
+import os
+import time
+import zlib
+import uuid
+import socket
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from pydantic import BaseModel
+from pymongo.errors import DuplicateKeyError
+
+from .mongo import MongoDBManager
+
+leases_collection = "scheduler_leases"
+workers_collection = "scheduler_workers"
+
+
+class Lease:
+    class Shard(BaseModel):
+        index: int = 0
+        count: int = 1
+
+        def owns(self, key: str) -> bool:
+            return zlib.crc32(key.encode()) % self.count == self.index
+
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    worker_seconds = 45  # A worker missing 3 heartbeats is considered gone
+    heartbeat_seconds = 15
+
+    @staticmethod
+    async def acquire(name: str, seconds: float) -> bool:
+        """Takes or renews the lease for seconds, returns False if another worker holds it."""
+        now = time.time()
+        try:
+            lease = await MongoDBManager().find_one_and_update(
+                leases_collection,
+                {"_id": name, "$or": [{"owner": Lease.owner}, {"expires_at": {"$lt": now}}]},
+                {"owner": Lease.owner, "expires_at": now + seconds},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False  # Held by another worker, the upsert collided with its lease document
+        return lease is not None and lease["owner"] == Lease.owner
+
+    @staticmethod
+    @asynccontextmanager
+    async def hold(name: str, seconds: float) -> AsyncIterator[bool]:
+        """
+        Acquires the lease and yields whether this worker holds it. The lease is renewed in the
+        background while the block runs so that a long run doesn't lose it, and is kept afterwards so
+        other workers skip the job until this worker stops running it.
+        """
+        if not await Lease.acquire(name, seconds):
+            yield False
+            return
+
+        async def renew():
+            while True:
+                await asyncio.sleep(seconds / 3)
+                await Lease.acquire(name, seconds)
+
+        renewal = asyncio.create_task(renew())
+        try:
+            yield True
+        finally:
+            renewal.cancel()
+            await asyncio.gather(renewal, return_exceptions=True)
+            await Lease.acquire(name, seconds)
+
+    @staticmethod
+    async def heartbeat() -> None:
+        """Announces this worker as alive and forgets the workers that stopped sending heartbeats."""
+        now = time.time()
+        await MongoDBManager().update_document(
+            workers_collection,
+            {"_id": Lease.owner},
+            {"expires_at": now + Lease.worker_seconds},
+            upsert=True,
+        )
+        await MongoDBManager().delete_documents(workers_collection, {"expires_at": {"$lt": now}})
+
+    @staticmethod
+    async def get_shard() -> "Lease.Shard":
+        """This worker's shard among the live workers of the node."""
+        workers = await MongoDBManager().find_documents(
+            workers_collection,
+            {"expires_at": {"$gte": time.time()}},
+            sort=[("_id", 1)],
+            projection={"_id": 1},
+        )
+        owners = [worker["_id"] for worker in workers]
+        if Lease.owner not in owners:
+            # Sharded jobs can run before the first heartbeat of the worker
+            await Lease.heartbeat()
+            owners = sorted(owners + [Lease.owner])
+        return Lease.Shard(index=owners.index(Lease.owner), count=len(owners))
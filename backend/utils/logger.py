@@ -0,0 +1,180 @@
+"""
+Structured, non-blocking logging.
+
+Records are handed to a queue by the thread that logs them and written to stdout by a QueueListener
+thread, so a slow or blocked stdout never stalls the event loop. Output is one JSON object per line
+(LOG_FORMAT=json, the default in production) or plain text (LOG_FORMAT=text, the default in
+development), uvicorn's own loggers are routed through the same queue.
+
+Every subsystem logs to its own logger, bitorch.<subsystem> (api, pex, inference, models, batch, mongo,
+scheduler, profiler, ...), whose level can be set with LOG_LEVELS, e.g. "mongo=WARNING,pex=DEBUG". Log
+messages should be %-style templates with their values passed as arguments rather than f-strings:
+warnings and errors are rate limited per logger and template, so e.g. a storm of failing peers logs
+LOG_RATE_LIMIT_BURST records per LOG_RATE_LIMIT_SECONDS and the count of the suppressed ones instead of
+one record per peer.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+env = os.getenv("ENV", "development").lower()
+log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+log_levels = os.getenv("LOG_LEVELS", "")
+log_format = os.getenv("LOG_FORMAT", "json" if env == "production" else "text").lower()
+rate_limit_seconds = float(os.getenv("LOG_RATE_LIMIT_SECONDS", 10))
+rate_limit_burst = int(os.getenv("LOG_RATE_LIMIT_BURST", 5))
+
+uvicorn_loggers = ("uvicorn", "uvicorn.error", "uvicorn.access")
+
+# Attributes of every LogRecord, anything else was passed with extra= and is added to the JSON output
+record_attributes = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message"}
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `burst` warnings and errors per logger and message template every `seconds`.
+    The first record let through after some were dropped carries their count as `suppressed`.
+    """
+
+    max_keys = 1000
+
+    def __init__(self, seconds: float, burst: int):
+        super().__init__()
+        self.seconds = seconds
+        self.burst = burst
+        self._lock = threading.Lock()
+        # (logger, template) -> [window start, records in the window, suppressed records]
+        self._windows: Dict[Tuple[str, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.seconds <= 0:
+            return True
+
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.seconds:
+                if window is None and len(self._windows) >= self.max_keys:
+                    self._windows.clear()
+                suppressed = window[2] if window is not None else 0
+                window = self._windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+        }
+        worker = os.getenv("WORKER_INDEX")
+        if worker is not None:
+            entry["worker"] = worker
+        for name, value in vars(record).items():
+            if name not in record_attributes:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(levelname)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            text += f" ({suppressed} similar messages suppressed)"
+        return text
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    Only resolves the message and the traceback in the logging thread, the record is formatted by the
+    listener thread so that the JSON output keeps the exception as its own field.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record = logging.makeLogRecord(vars(record))
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class Logger:
+    _listener: Optional[QueueListener] = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(subsystem: str) -> logging.Logger:
+        """Returns the logger of a subsystem, e.g. Logger.get("pex") -> bitorch.pex."""
+        Logger.setup()
+        return logging.getLogger(f"bitorch.{subsystem}")
+
+    @staticmethod
+    def setup() -> None:
+        """
+        Routes the bitorch and uvicorn loggers through the queue, once per process. Called by the first
+        Logger.get so that records logged while the app is imported aren't lost.
+        """
+        if Logger._listener is not None:
+            return
+        with Logger._lock:
+            if Logger._listener is not None:
+                return
+
+            stream_handler = logging.StreamHandler(sys.stdout)
+            stream_handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+            log_queue = queue.SimpleQueue()
+            queue_handler = LogQueueHandler(log_queue)
+            queue_handler.addFilter(RateLimitFilter(rate_limit_seconds, rate_limit_burst))
+
+            for name in ("bitorch", *uvicorn_loggers):
+                logger = logging.getLogger(name)
+                logger.handlers = [queue_handler]
+                logger.propagate = False
+            logging.getLogger("bitorch").setLevel(log_level)
+
+            for entry in log_levels.split(","):
+                if "=" not in entry:
+                    continue
+                name, level = (part.strip() for part in entry.split("=", 1))
+                if not name.startswith("uvicorn"):
+                    name = f"bitorch.{name}"
+                logging.getLogger(name).setLevel(level.upper())
+
+            listener = QueueListener(log_queue, stream_handler)
+            listener.start()
+            atexit.register(listener.stop)  # Flushes the records still in the queue
+            Logger._listener = listener
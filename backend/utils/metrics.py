@@ -0,0 +1,312 @@
+"""
+In-process metrics and request traces.
+
+Metrics are kept in a process wide registry (`metrics`) and rendered in the Prometheus text exposition
+format on /metrics. Every worker process has its own registry, scrape each worker or run a single
+worker per port. Label values should come from a small set (route templates, model ids), never from
+user input like urls or prompts, every distinct combination is kept in memory.
+
+Traces record the spans of a single request, e.g. middleware, database calls and model execution.
+The telemetry middleware starts a trace per request, code running within the request adds spans with
+`with Tracing.span("name"):`, including code running on worker threads that copied the request's
+context. Span durations are also observed in the bitorch_span_duration_seconds histogram and the most
+recent traces are kept for /telemetry/traces.
+"""
+
+import os
+import time
+import uuid
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from pydantic import BaseModel, Field
+from typing import Any, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Seconds, from a cached prompt lookup to a long generation
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], Any] = {}
+
+    def label_values(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def format_labels(self, values: Tuple[str, ...], extra: Optional[Dict[str, str]] = None) -> str:
+        pairs = list(zip(self.label_names, values)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{self.format_labels(key)} {format_value(value)}" for key, value in values]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.label_values(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = self.format_labels(key, {"le": format_value(bound)})
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self.format_labels(key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{self.format_labels(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Creates metrics by name, asking for an existing name returns the metric registered first so that
+    modules can declare the metrics they update without coordinating.
+    """
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric_class, name: str, help: str, labels: Sequence[str] = (), **kwargs) -> Any:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, help, labels, **kwargs)
+            elif not isinstance(metric, metric_class) or metric.label_names != tuple(labels):
+                raise ValueError(f"Metric {name} is already registered as a different metric")
+            return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge, name, help, labels)
+
+    def histogram(
+        self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+class Span(BaseModel):
+    name: str
+    start: float  # Seconds since the start of the trace
+    duration: Optional[float] = None  # Seconds, None while the span is open
+    parent: Optional[int] = None  # Index of the parent span in the trace
+    attributes: Dict[str, Any] = Field(default_factory=dict)
+
+
+class Trace(BaseModel):
+    trace_id: str
+    name: str
+    started: float  # Unix time
+    duration: Optional[float] = None
+    attributes: Dict[str, Any] = Field(default_factory=dict)
+    spans: List[Span] = Field(default_factory=list)
+
+    class Config:
+        underscore_attrs_are_private = True
+
+    _start: float = 0.0  # perf_counter at the start of the trace
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def server_timing(self) -> str:
+        """Durations of the finished top level spans for the Server-Timing response header."""
+        return ", ".join(
+            f"{span.name.replace('.', '_')};dur={span.duration * 1000:.1f}"
+            for span in self.spans
+            if span.parent is None and span.duration is not None
+        )
+
+
+class Tracing:
+    enabled = os.getenv("TELEMETRY", "true").lower() in ("1", "true", "yes")
+    buffer_size = int(os.getenv("TRACE_BUFFER_SIZE", 200))
+
+    recent: Deque[Trace] = deque(maxlen=buffer_size)
+    span_seconds = metrics.histogram(
+        "bitorch_span_duration_seconds", "Duration of trace spans.", labels=["span"]
+    )
+
+    _trace: contextvars.ContextVar = contextvars.ContextVar("bitorch_trace", default=None)
+    _span: contextvars.ContextVar = contextvars.ContextVar("bitorch_span", default=None)
+
+    @staticmethod
+    def start_trace(name: str, **attributes) -> Optional[Trace]:
+        """Starts a trace in the current context, returns None if telemetry is disabled."""
+        if not Tracing.enabled:
+            return None
+        trace = Trace(trace_id=uuid.uuid4().hex, name=name, started=time.time(), attributes=attributes)
+        trace._start = time.perf_counter()
+        Tracing._trace.set(trace)
+        Tracing._span.set(None)
+        return trace
+
+    @staticmethod
+    def finish_trace(trace: Optional[Trace]) -> None:
+        if trace is None or trace.duration is not None:
+            return
+        trace.duration = trace.elapsed()
+        Tracing.recent.append(trace)
+
+    @staticmethod
+    def current_trace() -> Optional[Trace]:
+        return Tracing._trace.get()
+
+    @staticmethod
+    @contextmanager
+    def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+        """
+        Records a span in the current trace, nested in the enclosing span. Spans outside of a trace, e.g.
+        in scheduled tasks, are only observed in the span duration histogram.
+        """
+        if not Tracing.enabled:
+            yield None
+            return
+
+        trace = Tracing.current_trace()
+        start = time.perf_counter()
+        span = None
+        token = None
+        if trace is not None:
+            span = Span(
+                name=name,
+                start=start - trace._start,
+                parent=Tracing._span.get(),
+                attributes=attributes,
+            )
+            trace.spans.append(span)
+            token = Tracing._span.set(len(trace.spans) - 1)
+        try:
+            yield span
+        except BaseException as e:
+            if span is not None:
+                span.attributes["error"] = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            if span is not None:
+                span.duration = duration
+                Tracing._span.reset(token)
+            Tracing.span_seconds.observe(duration, span=name)
+
+    @staticmethod
+    def add_span(name: str, start: float, duration: float, **attributes) -> None:
+        """
+        Records a span measured by the caller, e.g. a phase that ends in a callback. start is a
+        time.perf_counter() value.
+        """
+        if not Tracing.enabled:
+            return
+        trace = Tracing.current_trace()
+        if trace is not None:
+            trace.spans.append(
+                Span(
+                    name=name,
+                    start=start - trace._start,
+                    duration=duration,
+                    parent=Tracing._span.get(),
+                    attributes=attributes,
+                )
+            )
+        Tracing.span_seconds.observe(duration, span=name)
+
+    @staticmethod
+    def get_traces(limit: int = 50, min_duration: float = 0.0) -> List[Trace]:
+        """Most recent finished traces first, optionally only the ones slower than min_duration seconds."""
+        traces = [trace for trace in reversed(Tracing.recent) if trace.duration >= min_duration]
+        return traces[:limit]
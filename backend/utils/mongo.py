@@ -1,12 +1,38 @@
 import os
-import traceback
-from typing import List, Dict
+import functools
+from typing import Any, List, Dict, Optional, Tuple
 
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+
+from .metrics import metrics, Tracing
+from .logger import Logger
 
 load_dotenv()
 
+logger = Logger.get("mongo")
+
+db_seconds = metrics.histogram(
+    "bitorch_db_operation_seconds",
+    "Duration of MongoDB operations by operation and collection.",
+    labels=["operation", "collection"],
+)
+
+
+def instrumented(method):
+    """Records a span and the duration of a MongoDBManager method operating on a collection."""
+
+    @functools.wraps(method)
+    async def wrapper(self, collection_name: str, *args, **kwargs):
+        operation = method.__name__
+        with Tracing.span(f"mongo.{operation}", collection=collection_name), db_seconds.time(
+            operation=operation, collection=collection_name
+        ):
+            return await method(self, collection_name, *args, **kwargs)
+
+    return wrapper
+
 # TODO: implement race conditions
 # TODO: Investigate and take advantage of connection pooling in motor.
 
@@ -19,7 +45,7 @@ class MongoDBManager:
             self.client = AsyncIOMotorClient(mongo_url)
             self.db = self.client[db_name]
         except Exception as e:
-            print(f"Error connecting to MongoDB: {e}")
+            logger.error("Error connecting to MongoDB: %s", e)
             self.client = None
             self.db = None
 
@@ -27,32 +53,125 @@ class MongoDBManager:
         if self.client:
             self.client.close()
 
+    @instrumented
     async def insert_document(self, collection_name: str, document: Dict) -> bool:
         collection = self.db[collection_name]
         await collection.insert_one(document)
         return True
 
-    async def find_documents(self, collection_name: str, query: Dict) -> List[Dict]:
+    @instrumented
+    async def insert_documents(self, collection_name: str, documents: List[Dict]) -> int:
+        collection = self.db[collection_name]
+        result = await collection.insert_many(documents, ordered=False)
+        return len(result.inserted_ids)
+
+    @instrumented
+    async def find_documents(
+        self,
+        collection_name: str,
+        query: Dict,
+        sort: Optional[List[Tuple[str, int]]] = None,
+        limit: int = 0,
+        projection: Optional[Dict] = None,
+    ) -> List[Dict]:
         collection = self.db[collection_name]
-        cursor = collection.find(query)
+        cursor = collection.find(query, projection, sort=sort, limit=limit)
         documents = [doc async for doc in cursor]
         return documents
 
+    @instrumented
+    async def find_one_and_update(
+        self,
+        collection_name: str,
+        query: Dict,
+        update: Dict,
+        sort: Optional[List[Tuple[str, int]]] = None,
+        upsert: bool = False,
+    ) -> Optional[Dict]:
+        """
+        Atomically updates the first document matching the query and returns it after the update, None
+        if no document matched. With upsert a document is inserted if none matched.
+        """
+        collection = self.db[collection_name]
+        if not any(key.startswith("$") for key in update):
+            update = {"$set": update}
+        return await collection.find_one_and_update(
+            query, update, sort=sort, upsert=upsert, return_document=ReturnDocument.AFTER
+        )
+
+    @instrumented
+    async def update_documents(self, collection_name: str, query: Dict, update: Dict) -> int:
+        collection = self.db[collection_name]
+        if not any(key.startswith("$") for key in update):
+            update = {"$set": update}
+        result = await collection.update_many(query, update)
+        return result.modified_count
+
+    @instrumented
+    async def bulk_write(self, collection_name: str, operations: List[Any]) -> int:
+        """
+        Runs pymongo write operations (UpdateOne, InsertOne, etc.) in a single round trip and returns
+        the number of documents matched by the updates.
+        """
+        if not operations:
+            return 0
+        collection = self.db[collection_name]
+        result = await collection.bulk_write(operations, ordered=False)
+        return result.matched_count
+
+    @instrumented
+    async def count_documents(self, collection_name: str, query: Dict) -> int:
+        collection = self.db[collection_name]
+        return await collection.count_documents(query)
+
+    @instrumented
+    async def estimated_document_count(self, collection_name: str) -> int:
+        """Number of documents from the collection's metadata, without reading the documents."""
+        collection = self.db[collection_name]
+        return await collection.estimated_document_count()
+
+    @instrumented
+    async def aggregate(self, collection_name: str, pipeline: List[Dict]) -> List[Dict]:
+        collection = self.db[collection_name]
+        return [doc async for doc in collection.aggregate(pipeline)]
+
+    @instrumented
+    async def create_index(self, collection_name: str, keys: List[Tuple[str, int]], **kwargs) -> str:
+        collection = self.db[collection_name]
+        return await collection.create_index(keys, **kwargs)
+
+    @instrumented
+    async def drop_index(self, collection_name: str, name: str) -> None:
+        collection = self.db[collection_name]
+        await collection.drop_index(name)
+
+    @instrumented
     async def update_document(
-        self, collection_name: str, query: Dict, update: Dict
+        self, collection_name: str, query: Dict, update: Dict, upsert: bool = False
     ) -> bool:
+        """
+        Updates the first document matching the query, with upsert a document is inserted if none
+        matched. Returns True if a document was modified or inserted.
+        """
         collection = self.db[collection_name]
         # Check if the update dict contains any key that starts with '$'
         if not any(key.startswith("$") for key in update):
             update = {"$set": update}  # Use '$set' as default if no $ operator is found
-        result = await collection.update_one(query, update)
-        return result.modified_count > 0
+        result = await collection.update_one(query, update, upsert=upsert)
+        return result.modified_count > 0 or result.upserted_id is not None
 
+    @instrumented
     async def delete_document(self, collection_name: str, query: Dict) -> bool:
         collection = self.db[collection_name]
         result = await collection.delete_one(query)
         return result.deleted_count > 0
 
+    @instrumented
+    async def delete_documents(self, collection_name: str, query: Dict) -> int:
+        collection = self.db[collection_name]
+        result = await collection.delete_many(query)
+        return result.deleted_count
+
     async def create_collection(self, collection_name: str) -> bool:
         if collection_name in await self.db.list_collection_names():
             return False
@@ -70,9 +189,17 @@ class MongoDBManager:
             collection_names = await self.db.list_collection_names()
             return collection_names
         except Exception as e:
-            print(f"Error listing collections: {e}")
+            logger.error("Error listing collections: %s", e)
             return []
 
+    async def ping(self) -> bool:
+        try:
+            await self.db.command("ping")
+            return True
+        except Exception as e:
+            logger.error("Error pinging MongoDB: %s", e)
+            return False
+
     # TODO: Setup proper unit tests using like pytest or something
     async def test(self):
         test_collection = "test"
@@ -82,15 +209,14 @@ class MongoDBManager:
             # Ensure the test collection is fresh
             if test_collection in await self.list_collections():
                 if not await self.drop_collection(test_collection):
-                    print("Failed to drop existing test collection.")
+                    logger.error("Failed to drop existing test collection.")
                     return False
 
             if not await self.create_collection(test_collection):
-                print("Failed to create test collection.")
+                logger.error("Failed to create test collection.")
                 return False
         except Exception as e:
-            print(f"Error ensuring fresh test collection: {e}")
-            print(traceback.format_exc())
+            logger.exception("Error ensuring fresh test collection: %s", e)
             return False
 
         try:
@@ -99,11 +225,10 @@ class MongoDBManager:
             if not await self.insert_document(
                 collection_name=test_collection, document=test_document
             ):
-                print("Failed to insert document.")
+                logger.error("Failed to insert document.")
                 return False
         except Exception as e:
-            print(f"Error inserting document: {e}")
-            print(traceback.format_exc())
+            logger.exception("Error inserting document: %s", e)
             return False
 
         try:
@@ -113,11 +238,10 @@ class MongoDBManager:
                 collection_name=test_collection, query=query
             )
             if not found_documents:
-                print("No documents found.")
+                logger.error("No documents found.")
                 return False
         except Exception as e:
-            print(f"Error finding documents: {e}")
-            print(traceback.format_exc())
+            logger.exception("Error finding documents: %s", e)
             return False
 
         try:
@@ -127,44 +251,40 @@ class MongoDBManager:
             if not await self.update_document(
                 collection_name=test_collection, query=update_query, update=update_data
             ):
-                print("Failed to update document.")
+                logger.error("Failed to update document.")
                 return False
         except Exception as e:
-            print(f"Error updating document: {e}")
-            print(traceback.format_exc())
+            logger.exception("Error updating document: %s", e)
             return False
 
         try:
             # Find documents again to verify update
             updated_documents = await self.find_documents(test_collection, query)
             if not updated_documents or updated_documents[0]["age"] != 31:
-                print("Document update verification failed.")
+                logger.error("Document update verification failed.")
                 return False
         except Exception as e:
-            print(f"Error verifying document update: {e}")
-            print(traceback.format_exc())
+            logger.exception("Error verifying document update: %s", e)
             return False
 
         try:
             # Delete a document
             delete_query = {"name": name}
             if not await self.delete_document(test_collection, delete_query):
-                print("Failed to delete document.")
+                logger.error("Failed to delete document.")
                 return False
         except Exception as e:
-            print(f"Error deleting document: {e}")
-            print(traceback.format_exc())
+            logger.exception("Error deleting document: %s", e)
             return False
 
         try:
             # Find documents to verify deletion
             post_delete_documents = await self.find_documents(test_collection, query)
             if post_delete_documents:
-                print("Document deletion verification failed.")
+                logger.error("Document deletion verification failed.")
                 return False
         except Exception as e:
-            print(f"Error verifying document deletion: {e}")
-            print(traceback.format_exc())
+            logger.exception("Error verifying document deletion: %s", e)
             return False
 
         # Test completed successfully
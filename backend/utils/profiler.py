@@ -0,0 +1,269 @@
+"""
+Opt-in statistical profiler for requests, cheap enough to leave on at a low sample rate in production.
+
+A sampled request (PROFILE_ROUTES and PROFILE_SAMPLE_RATE, or /debug/profile at runtime) is tracked in
+the tasks it runs on: the task handling it and every task created while handling it, e.g. by
+BaseHTTPMiddleware's call_next, are registered by an event loop task factory. While any request is
+profiled a background thread takes the event loop thread's stack every PROFILE_INTERVAL_MS and counts
+it for the request whose task is running. Work running on thread pools isn't sampled, it shows up as
+time the request waits.
+
+Every profiled request's stacks are appended to PROFILE_DIR/<route>.<pid>.folded in the collapsed
+stack format of flamegraph.pl, speedscope and inferno, duplicate stacks are summed by those tools. Its
+wall time, CPU time of its tasks on the event loop and sample count are appended to
+PROFILE_DIR/requests.<pid>.jsonl.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import inspect
+import sysconfig
+import threading
+import contextvars
+import collections.abc
+from collections import Counter, deque
+from weakref import WeakKeyDictionary
+from pydantic import BaseModel, Field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from .metrics import metrics
+from .logger import Logger
+
+logger = Logger.get("profiler")
+
+profiled_cpu_seconds = metrics.histogram(
+    "bitorch_profiled_request_cpu_seconds",
+    "CPU time profiled requests spent on the event loop, by route.",
+    labels=["route"],
+)
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, loop: asyncio.AbstractEventLoop):
+        self.method = method
+        self.path = path
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.cpu_seconds = 0.0  # Only updated on the event loop thread
+        self.stacks: Counter = Counter()  # Only updated on the sampler thread, under Profiler._lock
+
+
+class TimedCoroutine(collections.abc.Coroutine):
+    """
+    Wraps the coroutine of a task created by a profiled request, every step of the task is a send or
+    throw so their CPU time adds up to the task's CPU time.
+    """
+
+    def __init__(self, coro, profile: RequestProfile):
+        self._coro = coro
+        self._profile = profile
+
+    def send(self, value):
+        start = time.thread_time()
+        try:
+            return self._coro.send(value)
+        finally:
+            self._profile.cpu_seconds += time.thread_time() - start
+
+    def throw(self, *args):
+        start = time.thread_time()
+        try:
+            return self._coro.throw(*args)
+        finally:
+            self._profile.cpu_seconds += time.thread_time() - start
+
+    def close(self):
+        return self._coro.close()
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    def __getattr__(self, name: str):
+        # cr_frame, cr_running, __qualname__, etc. of the wrapped coroutine, used by asyncio and anyio
+        return getattr(self._coro, name)
+
+
+class Profiler:
+    class Settings(BaseModel):
+        # Paths of the requests to profile, "*" for every path, a trailing * matches a path prefix
+        routes: List[str] = Field(default_factory=list, max_items=64)
+        sample_rate: float = Field(0.01, ge=0, le=1)  # Share of matching requests that are profiled
+        interval_ms: float = Field(5, ge=1, le=1000)  # Time between two stack samples
+
+    settings = Settings(
+        routes=[route.strip() for route in os.getenv("PROFILE_ROUTES", "").split(",") if route.strip()],
+        sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", 0.01)),
+        interval_ms=float(os.getenv("PROFILE_INTERVAL_MS", 5)),
+    )
+    directory = os.getenv("PROFILE_DIR", os.path.join(".cache", "profiles"))
+
+    recent: Deque[Dict[str, Any]] = deque(maxlen=100)  # Summaries of the last profiled requests
+
+    _current: contextvars.ContextVar = contextvars.ContextVar("bitorch_profile", default=None)
+    _task_profiles: "WeakKeyDictionary[asyncio.Task, RequestProfile]" = WeakKeyDictionary()
+    _active: Dict[int, RequestProfile] = {}  # id -> profiles of the requests in progress
+    _lock = threading.Lock()
+    _sampler: Optional[threading.Thread] = None
+    _skip_file = os.path.abspath(__file__)  # TimedCoroutine.send frames
+    _stdlib_path = sysconfig.get_paths()["stdlib"]
+    _async_flags = inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE | inspect.CO_ASYNC_GENERATOR
+
+    @staticmethod
+    def matches(path: str) -> bool:
+        for route in Profiler.settings.routes:
+            if route == "*" or route == path or (route.endswith("*") and path.startswith(route[:-1])):
+                return True
+        return False
+
+    @staticmethod
+    def start(method: str, path: str) -> Optional[RequestProfile]:
+        """
+        Decides whether to profile a request, called from the task handling it. Returns the request's
+        profile if it's sampled, pass it to finish once the request is done.
+        """
+        settings = Profiler.settings
+        if not settings.routes or random.random() >= settings.sample_rate or not Profiler.matches(path):
+            return None
+
+        loop = asyncio.get_running_loop()
+        if not isinstance(loop.get_task_factory(), Profiler.TaskFactory):
+            loop.set_task_factory(Profiler.TaskFactory(loop.get_task_factory()))
+
+        profile = RequestProfile(method, path, loop)
+        Profiler._current.set(profile)
+        Profiler._task_profiles[asyncio.current_task()] = profile
+        with Profiler._lock:
+            Profiler._active[id(profile)] = profile
+            if Profiler._sampler is None:
+                Profiler._sampler = threading.Thread(target=Profiler.sample, name="profiler", daemon=True)
+                Profiler._sampler.start()
+        return profile
+
+    @staticmethod
+    def finish(profile: Optional[RequestProfile], route: str, status_code: int) -> None:
+        if profile is None:
+            return
+        Profiler._task_profiles.pop(asyncio.current_task(), None)
+        Profiler._current.set(None)
+        with Profiler._lock:
+            Profiler._active.pop(id(profile), None)
+            stacks = profile.stacks
+            profile.stacks = Counter()
+
+        summary = {
+            "time": time.time(),
+            "method": profile.method,
+            "path": profile.path,
+            "route": route,
+            "status": status_code,
+            "wall_seconds": round(time.perf_counter() - profile.start, 6),
+            "cpu_seconds": round(profile.cpu_seconds, 6),
+            "samples": sum(stacks.values()),
+            "interval_ms": Profiler.settings.interval_ms,
+        }
+        Profiler.recent.append(summary)
+        profiled_cpu_seconds.observe(profile.cpu_seconds, route=route)
+        try:
+            Profiler.write(route, f"{profile.method} {route}", stacks, summary)
+        except OSError as e:
+            logger.warning("Writing request profile failed: %s", e)
+
+    @staticmethod
+    def write(route: str, root: str, stacks: Counter, summary: Dict[str, Any]) -> None:
+        os.makedirs(Profiler.directory, exist_ok=True)
+        pid = os.getpid()
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+        if stacks:
+            lines = "".join(f"{root};{';'.join(stack)} {count}\n" for stack, count in stacks.items())
+            with open(os.path.join(Profiler.directory, f"{slug}.{pid}.folded"), "a") as f:
+                f.write(lines)
+        with open(os.path.join(Profiler.directory, f"requests.{pid}.jsonl"), "a") as f:
+            f.write(json.dumps(summary) + "\n")
+
+    class TaskFactory:
+        """
+        Event loop task factory that registers the tasks created while handling a profiled request, and
+        wraps their coroutine to measure their CPU time. Other tasks are created unchanged.
+        """
+
+        def __init__(self, previous=None):
+            self.previous = previous
+
+        def __call__(self, loop, coro, **kwargs):
+            profile = Profiler._current.get()
+            if profile is not None:
+                coro = TimedCoroutine(coro, profile)
+            if self.previous is not None:
+                task = self.previous(loop, coro, **kwargs)
+            else:
+                task = asyncio.Task(coro, loop=loop, **kwargs)
+            if profile is not None:
+                Profiler._task_profiles[task] = profile
+            return task
+
+    @staticmethod
+    def frame_name(code) -> str:
+        path = code.co_filename
+        if "site-packages" in path:
+            path = path.split("site-packages" + os.sep, 1)[1]
+        elif path.startswith(Profiler._stdlib_path):
+            path = os.path.relpath(path, Profiler._stdlib_path)
+        elif path.startswith(os.getcwd()):
+            path = os.path.relpath(path)
+        return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+    @staticmethod
+    def stack(frame) -> Tuple[str, ...]:
+        """
+        Names of the frames of the running task, outermost first. The task's outermost coroutine is
+        called by the event loop, the first plain function frame after a coroutine frame belongs to the
+        loop itself.
+        """
+        names = []
+        in_task = False
+        while frame is not None:
+            code = frame.f_code
+            if code.co_filename != Profiler._skip_file:
+                is_async = bool(code.co_flags & Profiler._async_flags)
+                if in_task and not is_async:
+                    break
+                in_task = in_task or is_async
+                names.append(Profiler.frame_name(code))
+            frame = frame.f_back
+        # Samples taken between two steps of the task don't belong to the request's code
+        return tuple(reversed(names)) if in_task else ()
+
+    @staticmethod
+    def sample() -> None:
+        """Sampler thread, runs while at least one request is profiled."""
+        while True:
+            with Profiler._lock:
+                if not Profiler._active:
+                    Profiler._sampler = None
+                    return
+                loops = {profile.loop: profile.loop_thread for profile in Profiler._active.values()}
+
+            frames = sys._current_frames()
+            for loop, thread_id in loops.items():
+                try:
+                    task = asyncio.current_task(loop)
+                except RuntimeError:
+                    continue
+                profile = Profiler._task_profiles.get(task) if task is not None else None
+                frame = frames.get(thread_id)
+                # Dropped if another task started running while the stack was taken
+                if profile is None or frame is None or asyncio.current_task(loop) is not task:
+                    continue
+                stack = Profiler.stack(frame)
+                if stack:
+                    with Profiler._lock:
+                        profile.stacks[stack] += 1
+            del frames
+
+            time.sleep(Profiler.settings.interval_ms / 1000)
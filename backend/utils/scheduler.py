@@ -1,15 +1,67 @@
+import random
+import asyncio
 from functools import wraps
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
 
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
+from .metrics import metrics
+from .logger import Logger
+from .leases import Lease
+
+logger = Logger.get("scheduler")
+
+job_seconds = metrics.histogram(
+    "bitorch_scheduled_job_duration_seconds", "Run time of scheduled jobs.", labels=["job"]
+)
+job_lag_seconds = metrics.histogram(
+    "bitorch_scheduled_job_lag_seconds",
+    "Time between the scheduled run time of a job and the moment it was started.",
+    labels=["job"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0),
+)
+job_runs = metrics.counter(
+    "bitorch_scheduled_job_runs_total",
+    "Scheduled job runs by result: success, error, timeout, cancelled or skipped (still running, missed).",
+    labels=["job", "result"],
+)
+
 
 class Scheduler:
+    """
+    Shared APScheduler instance, jobs are declared with the schedule_task decorator.
+
+    Runs of a job never overlap: a run that is due while the previous one is still running is skipped,
+    and runs missed while the event loop was busy are coalesced into one. On top of the APScheduler
+    triggers, schedule_task supports:
+    - trigger="delay": waits `seconds` after a run finished before starting the next one, so slow runs
+      under load space out instead of stacking up.
+    - jitter: random seconds added to every run time, by default 10% of the interval so that peers
+      started together don't run their periodic tasks (e.g. polling each other) in lockstep.
+    - timeout: seconds after which a run is cancelled.
+
+    With several workers every worker runs its own scheduler, see backend/utils/leases.py:
+    - lease=True: the job runs in only one worker of the node, for jobs that only update the database.
+      Jobs that update in-memory state of their worker (e.g. the model registry) run in every worker.
+    - shard=True: the job runs in every worker and gets a `shard` keyword argument (Lease.Shard), it
+      should only handle the items owned by its shard, e.g. `if shard.owns(peer.ip)`.
+    """
+
     _instance = None
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(Scheduler, cls).__new__(cls)
-            cls._instance.sched = AsyncIOScheduler()
+            cls._instance.sched = AsyncIOScheduler(
+                job_defaults={"max_instances": 1, "coalesce": True, "misfire_grace_time": None}
+            )
+            cls._instance.sched.add_listener(
+                cls._instance.on_job_event,
+                EVENT_JOB_SUBMITTED | EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED,
+            )
+            cls._instance.delay_jobs: Dict[str, Dict[str, Any]] = {}
         return cls._instance
 
     def run(self):
@@ -18,11 +70,69 @@ class Scheduler:
     def shutdown(self):
         self.sched.shutdown()
 
-    def schedule_task(self, *args, **kwargs):
+    def on_job_event(self, event) -> None:
+        if event.code == EVENT_JOB_SUBMITTED:
+            scheduled = event.scheduled_run_times[-1]
+            lag = (datetime.now(scheduled.tzinfo) - scheduled).total_seconds()
+            job_lag_seconds.observe(max(lag, 0.0), job=event.job_id)
+        else:
+            job_runs.inc(job=event.job_id, result="skipped")
+
+    def schedule_task(
+        self,
+        *args,
+        timeout: Optional[float] = None,
+        jitter: Optional[float] = None,
+        lease: bool = False,
+        shard: bool = False,
+        **kwargs,
+    ):
             def decorator(func):
+                job_id = kwargs.get("id") or getattr(func, "__name__", None) or repr(func)
+                trigger = kwargs.get("trigger", args[0] if args else None)
+                delay = trigger == "delay"
+                units = ("weeks", "days", "hours", "minutes", "seconds")
+                interval = timedelta(
+                    **{unit: kwargs[unit] for unit in units if unit in kwargs}
+                ).total_seconds()
+                job_jitter = jitter if jitter is not None else interval * 0.1
+                # Long enough that the owner keeps the lease from one run to the next
+                lease_seconds = max(2 * (interval + job_jitter), 30)
+
+                async def run(*func_args, **func_kwargs):
+                    if shard:
+                        func_kwargs["shard"] = await Lease.get_shard()
+                    if timeout is not None:
+                        return await asyncio.wait_for(func(*func_args, **func_kwargs), timeout)
+                    return await func(*func_args, **func_kwargs)
+
                 @wraps(func)
                 async def wrapper(*func_args, **func_kwargs):
-                    return await func(*func_args, **func_kwargs)
+                    start = asyncio.get_running_loop().time()
+                    result = "success"
+                    try:
+                        if not lease:
+                            return await run(*func_args, **func_kwargs)
+                        async with Lease.hold(f"job:{job_id}", lease_seconds) as held:
+                            if not held:
+                                result = "skipped"  # Owned by another worker
+                                return None
+                            return await run(*func_args, **func_kwargs)
+                    except asyncio.TimeoutError:
+                        result = "timeout"
+                        logger.warning("Scheduled task %s timed out after %ss", job_id, timeout)
+                    except asyncio.CancelledError:
+                        result = "cancelled"  # Scheduler shutdown
+                        raise
+                    except Exception:
+                        result = "error"
+                        raise
+                    finally:
+                        if result != "skipped":
+                            job_seconds.observe(asyncio.get_running_loop().time() - start, job=job_id)
+                        job_runs.inc(job=job_id, result=result)
+                        if delay and result != "cancelled" and job_id in self.delay_jobs:
+                            self.schedule_delay_job(job_id)
 
                 # Check if a job with the given ID already exists
                 try:
@@ -31,18 +141,45 @@ class Scheduler:
                         # Handle the existing job (e.g., remove it, log a warning, etc.)
                         self.remove_task(existing_job.id)
                 except Exception as e:
-                    print(f"Error checking for existing task: {e}")
-
-                self.sched.add_job(wrapper, *args, **kwargs)
+                    logger.error("Error checking for existing task: %s", e)
+
+                if shard:
+                    self.schedule_heartbeat()
+                if delay:
+                    self.delay_jobs[job_id] = {"func": wrapper, "delay": interval, "jitter": job_jitter}
+                    self.schedule_delay_job(job_id)
+                else:
+                    if trigger in ("interval", "cron") and job_jitter:
+                        kwargs.setdefault("jitter", job_jitter)
+                    self.sched.add_job(wrapper, *args, **kwargs)
                 return wrapper
 
             return decorator
 
+    def schedule_delay_job(self, job_id: str) -> None:
+        """Schedules the next run of a trigger="delay" job, delay (plus jitter) seconds from now."""
+        job = self.delay_jobs[job_id]
+        run_date = datetime.now() + timedelta(seconds=job["delay"] + random.uniform(0, job["jitter"]))
+        self.sched.add_job(
+            job["func"], trigger="date", run_date=run_date, id=job_id, replace_existing=True
+        )
+
+    def schedule_heartbeat(self) -> None:
+        """Keeps this worker in the list of live workers that sharded jobs are split between."""
+        if self.sched.get_job("scheduler_worker_heartbeat") is None:
+            self.sched.add_job(
+                Lease.heartbeat,
+                trigger="interval",
+                seconds=Lease.heartbeat_seconds,
+                id="scheduler_worker_heartbeat",
+            )
+
     def remove_task(self, task_id):
+        self.delay_jobs.pop(task_id, None)
         try:
             self.sched.remove_job(task_id)
         except Exception as e:
-            print(f"Error removing task: {e}")
+            logger.error("Error removing task: %s", e)
 
 
 # This will always return the same instance
@@ -59,3 +196,7 @@ scheduler = Scheduler()
 
 #     if result:
 #         scheduler.remove_task(task_id="request_register_source_peer")
+#
+# Periodic maintenance that shouldn't stack up under load, next run starts 60s (+ up to 6s of jitter)
+# after the previous one finished and is cancelled after 30s:
+# @scheduler.schedule_task(trigger="delay", seconds=60, timeout=30, id="cleanup")
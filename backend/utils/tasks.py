@@ -1,7 +1,11 @@
 from ..api.pex import PexTasks
+from ..api.distributed_inference.model_manager import ModelTasks
+from ..api.batch import BatchTasks
 
 
 class StartupTasks:
     @staticmethod
     async def run():
+        await ModelTasks.startup()
         await PexTasks.startup()
+        await BatchTasks.startup()
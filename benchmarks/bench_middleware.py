@@ -0,0 +1,43 @@
+"""
+Overhead of the middlewares on a request that does no work of its own.
+"""
+
+import pytest
+from fastapi import FastAPI
+
+from backend.api import router as api_router
+from backend.middleware.request_logger import RequestLoggerMiddleware
+from backend.middleware.telemetry import TelemetryMiddleware
+
+MIDDLEWARES = {
+    "none": [],
+    "telemetry": [TelemetryMiddleware],
+    "request_logger": [RequestLoggerMiddleware],
+    "all": [RequestLoggerMiddleware, TelemetryMiddleware],  # Same order as setup_middlewares
+}
+
+
+def make_app(middlewares) -> FastAPI:
+    app = FastAPI()
+    for middleware in middlewares:
+        app.add_middleware(middleware)
+    app.include_router(api_router)
+    return app
+
+
+@pytest.mark.benchmark(group="middleware")
+@pytest.mark.parametrize("middlewares", list(MIDDLEWARES), ids=list(MIDDLEWARES))
+def bench_middleware_overhead(benchmark, run, seed_peers, make_client, middlewares):
+    """GET /inference/load, which only reads counters, through each middleware stack."""
+    seed_peers(1_000)
+    seed_peers.invalidate()  # The request logger adds the client as a peer
+    client = make_client(make_app(MIDDLEWARES[middlewares]))
+
+    async def request():
+        response = await client.get("/inference/load")
+        await response.aread()
+        return response
+
+    response = benchmark(lambda: run(request()))
+    run(client.aclose())
+    assert response.status_code == 200
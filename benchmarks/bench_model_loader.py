@@ -0,0 +1,73 @@
+"""
+Loading models with ModelLoader, with tiny stand-in models written to a temporary models/ directory.
+"""
+
+import os
+import threading
+from types import SimpleNamespace
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from backend.api.distributed_inference import model_manager
+from backend.api.distributed_inference.model_manager import ModelLoader
+
+LOAD_TIMEOUT = 10  # Seconds, a load still running after this is deadlocked
+
+
+class TinyPipeline:
+    """Stands in for a diffusers pipeline made of one torch component."""
+
+    def __init__(self):
+        self.unet = torch.nn.Linear(64, 64)
+        self.components = {"unet": self.unet, "scheduler": object()}
+
+    def to(self, device):
+        return self
+
+
+@pytest.fixture
+def tiny_pipeline(tmp_path, monkeypatch):
+    """A diffusers model whose unet weights are a safetensors file, loaded by a fake diffusers."""
+    weights = TinyPipeline().unet.state_dict()
+    os.makedirs(tmp_path / "tiny-pipeline" / "unet")
+    save_file(weights, str(tmp_path / "tiny-pipeline" / "unet" / "diffusion_pytorch_model.safetensors"))
+
+    fake_diffusers = SimpleNamespace(
+        AutoPipelineForText2Image=SimpleNamespace(from_pretrained=lambda **kwargs: TinyPipeline())
+    )
+    monkeypatch.setattr(model_manager, "diffusers", fake_diffusers)
+    monkeypatch.setattr(model_manager, "model_path", str(tmp_path))
+    monkeypatch.setattr(ModelLoader, "_pipelines", {})
+    monkeypatch.setattr(ModelLoader, "_mapped_files", {})
+    return "tiny-pipeline", weights
+
+
+def load_in_thread(model_id: str):
+    """Loads a pipeline on the cpu in a thread, fails instead of hanging if the load deadlocks."""
+    result = {}
+    thread = threading.Thread(
+        target=lambda: result.update(pipeline=ModelLoader.get_diffusers_pipeline(model_id, device="cpu")),
+        daemon=True,
+    )
+    thread.start()
+    thread.join(LOAD_TIMEOUT)
+    assert not thread.is_alive(), f"Loading {model_id} on the cpu didn't finish in {LOAD_TIMEOUT}s"
+    return result["pipeline"]
+
+
+@pytest.mark.benchmark(group="model-loader")
+def bench_diffusers_pipeline_cpu(benchmark, tiny_pipeline):
+    """Loading a pipeline on the cpu memory maps its safetensors weights into the components."""
+    model_id, weights = tiny_pipeline
+
+    def setup():
+        ModelLoader._pipelines.clear()
+        ModelLoader._mapped_files.clear()
+
+    pipeline = benchmark.pedantic(lambda: load_in_thread(model_id), setup=setup, rounds=5, iterations=1)
+    for name, tensor in pipeline.unet.state_dict().items():
+        assert torch.equal(tensor, weights[name])
+    model_dir = os.path.join(model_manager.model_path, model_id)
+    assert any(path.startswith(model_dir) for path in ModelLoader._mapped_files)
@@ -0,0 +1,152 @@
+"""
+Downloading a model from other peers with POST /models/{id}/pull. The peers are in-process stand-in apps
+serving a small model over the model distribution protocol, one of them sends corrupted pieces.
+"""
+
+import os
+import shutil
+import hashlib
+import functools
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+
+from backend.api.distributed_inference import model_manager, model_transfer, get_model_endpoint
+from backend.api.distributed_inference.model_manager import model_registry
+from backend.api.distributed_inference.model_transfer import (
+    Manifest,
+    ManifestFile,
+    ModelTransfer,
+    FileRangeResponse,
+)
+
+from conftest import make_peer, peers_collection
+
+MODEL_ID = "tiny-model.gguf"
+MODEL_SIZE = 256 * 1024 + 123  # The last piece is shorter than the others
+PIECE_SIZE = 16 * 1024
+
+
+def make_source_app(file_path: str, manifest: Manifest, pieces=None, corrupt: bool = False) -> FastAPI:
+    """
+    A peer serving a model file: all of its pieces, only the given piece indices, or corrupted pieces.
+    """
+    app = FastAPI()
+    index = {
+        sha256: (offset, length)
+        for i, (_, offset, length, sha256) in enumerate(manifest.pieces())
+        if pieces is None or i in pieces
+    }
+
+    @app.get("/models/{model_id}/manifest")
+    async def manifest_endpoint(model_id: str):
+        return {"content": {"manifest": manifest.dict()}, "status_code": 200}
+
+    @app.get("/models/{model_id}/have")
+    async def have_endpoint(model_id: str):
+        if pieces is None:
+            return {"content": {"checksum": manifest.checksum, "complete": True}, "status_code": 200}
+        content = {"checksum": manifest.checksum, "complete": False, "pieces": sorted(pieces)}
+        return {"content": content, "status_code": 200}
+
+    @app.get("/models/{model_id}/pieces/{piece_hash}")
+    async def piece_endpoint(model_id: str, piece_hash: str):
+        if piece_hash not in index:
+            raise HTTPException(status_code=404)
+        offset, length = index[piece_hash]
+        # A corrupted peer sends the piece shifted by a byte
+        return FileRangeResponse(file_path, offset + corrupt, length)
+
+    return app
+
+
+@pytest.fixture
+def model_peers(tmp_path, mongo, run, monkeypatch):
+    """
+    A complete, a partial and a corrupted peer hosting a small model, and an empty models/ directory.
+    Returns the model file content.
+    """
+    data = os.urandom(MODEL_SIZE)
+    source_path = str(tmp_path / "source.gguf")
+    with open(source_path, "wb") as file:
+        file.write(data)
+    piece_hashes = [
+        hashlib.sha256(data[offset : offset + PIECE_SIZE]).hexdigest()
+        for offset in range(0, MODEL_SIZE, PIECE_SIZE)
+    ]
+    manifest = Manifest(
+        model_id=MODEL_ID,
+        checksum=hashlib.sha256(data).hexdigest(),
+        single_file=True,
+        piece_size=PIECE_SIZE,
+        files=[
+            ManifestFile(
+                path=MODEL_ID, size=MODEL_SIZE, sha256=hashlib.sha256(data).hexdigest(), pieces=piece_hashes
+            )
+        ],
+    )
+    apps = [
+        make_source_app(source_path, manifest),
+        make_source_app(source_path, manifest, pieces=set(range(0, len(piece_hashes), 2))),
+        make_source_app(source_path, manifest, corrupt=True),
+    ]
+
+    mounts = {}
+    peers = []
+    for app in apps:
+        peer = make_peer()
+        peer.capabilities.models = [MODEL_ID]
+        peers.append(peer)
+        mounts[f"http://{peer.ip}:{peer.port}"] = httpx.ASGITransport(app=app)
+    run(mongo[peers_collection].insert_many([peer.dict() for peer in peers]))
+
+    models_dir = str(tmp_path / "models")
+    monkeypatch.setattr(model_manager, "model_path", models_dir)
+    monkeypatch.setattr(model_transfer, "model_path", models_dir)
+    monkeypatch.setattr(model_transfer, "partial_path", os.path.join(models_dir, ".partial"))
+    monkeypatch.setattr(model_registry, "index_file", os.path.join(models_dir, ".registry.json"))
+    monkeypatch.setattr(model_registry, "models", {})
+    monkeypatch.setattr(
+        model_transfer,
+        "httpx",
+        SimpleNamespace(AsyncClient=functools.partial(httpx.AsyncClient, mounts=mounts)),
+    )
+    yield data
+    run(mongo[peers_collection].delete_many({"ip": {"$in": [peer.ip for peer in peers]}}))
+
+
+@pytest.mark.benchmark(group="model-transfer")
+def bench_pull_model(benchmark, run, model_peers):
+    app = FastAPI()
+    app.include_router(get_model_endpoint.router)
+
+    def setup():
+        shutil.rmtree(model_manager.model_path, ignore_errors=True)
+        model_registry.models = {}
+
+    async def pull():
+        local = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app, client=("127.0.0.1", 40000)), base_url="http://bench"
+        )
+        remote = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app, client=("10.255.0.1", 40000)), base_url="http://bench"
+        )
+        async with local, remote:
+            assert (await remote.post(f"/models/{MODEL_ID}/pull")).status_code == 403
+            assert (await local.post("/models/..bad/pull")).status_code == 400
+
+            response = await local.post(f"/models/{MODEL_ID}/pull")
+            assert response.status_code == 202
+            assert response.json()["content"]["state"] == "started"
+            assert await ModelTransfer.pulls[MODEL_ID]
+            return await local.post(f"/models/{MODEL_ID}/pull")
+
+    response = benchmark.pedantic(lambda: run(pull()), setup=setup, rounds=3, iterations=1)
+    assert response.status_code == 200
+    assert response.json()["content"]["state"] == "hosted"
+    with open(os.path.join(model_manager.model_path, MODEL_ID), "rb") as file:
+        assert file.read() == model_peers
+    assert model_registry.get_model(MODEL_ID).checksum is not None
+    assert not os.path.exists(os.path.join(model_transfer.partial_path, MODEL_ID))
@@ -0,0 +1,78 @@
+"""
+Peer exchange: validating peers, sampling the peer list and /register end to end.
+"""
+
+import pytest
+
+from backend.api.pex import PexMongo
+from backend.utils import Peer
+
+from conftest import make_peer
+
+
+@pytest.mark.benchmark(group="peer-validation")
+@pytest.mark.parametrize("history", [0, 100])
+def bench_peer_internal_from_document(benchmark, history):
+    """Peer.Internal validation of a stored peer document, e.g. PexMongo.get_peer."""
+    document = make_peer(history).dict()
+    peer = benchmark(lambda: Peer.Internal(**document))
+    assert len(peer.request_history) == history
+
+
+@pytest.mark.benchmark(group="peer-validation")
+def bench_peer_record_from_document(benchmark):
+    """Peer.Record of a stored peer document, done for every peer get_all_peers returns."""
+    document = make_peer().dict()
+    document.pop("request_history")
+    peer = benchmark(lambda: Peer.Record.from_document(document))
+    assert peer.ip == document["ip"]
+
+
+@pytest.mark.benchmark(group="peer-validation")
+def bench_peer_public_from_request(benchmark):
+    """Peer.Public validation of a /register request body."""
+    body = make_peer().to_public().dict()
+    benchmark(lambda: Peer.Public(**body))
+
+
+@pytest.mark.benchmark(group="peer-validation")
+def bench_peer_to_internal(benchmark):
+    public = make_peer().to_public()
+    benchmark(lambda: Peer.to_internal(public))
+
+
+# Fewer rounds for the larger peer lists, each round validates every peer
+PEER_COUNTS = [
+    pytest.param(1_000, 20, id="1k"),
+    pytest.param(10_000, 5, id="10k"),
+    pytest.param(100_000, 2, id="100k", marks=pytest.mark.slow),
+]
+
+
+@pytest.mark.benchmark(group="get-random-peers")
+@pytest.mark.parametrize("count,rounds", PEER_COUNTS)
+def bench_get_random_peers(benchmark, run, seed_peers, count, rounds):
+    seed_peers(count)
+    peers = benchmark.pedantic(lambda: run(PexMongo.get_random_peers()), rounds=rounds, iterations=1)
+    benchmark.extra_info["peers"] = count
+    assert len(peers) == min(50, count)
+
+
+@pytest.mark.benchmark(group="register")
+@pytest.mark.parametrize("count,rounds", PEER_COUNTS[:2])
+def bench_register(benchmark, run, seed_peers, make_client, count, rounds):
+    """/register through the full app and middleware stack, each round registers a new peer."""
+    from backend.main import app
+
+    seed_peers(count)
+    seed_peers.invalidate()  # Registered peers are added to the collection
+
+    async def register():
+        async with make_client(app) as client:
+            response = await client.post("/register", json=make_peer().to_public().dict())
+            await response.aread()
+            return response
+
+    response = benchmark.pedantic(lambda: run(register()), rounds=rounds * 4, iterations=1, warmup_rounds=1)
+    benchmark.extra_info["peers"] = count
+    assert response.status_code == 200
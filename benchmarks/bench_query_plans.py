@@ -0,0 +1,110 @@
+"""
+Query plans of the peer queries: every query PexMongo sends has to be served by an index, so that peer
+lookups stay O(log n) as the peers collection grows. Reading every peer (get_all_peers) is the only
+query allowed to scan the collection.
+
+The queries are recorded while running the PexMongo methods. Their filters are checked against the
+indexes of the collection on any backend, with BENCH_MONGO_URL set the winning plan of each query is
+also checked for collection scans.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from backend.api.pex import PexMongo, peers_collection
+from backend.utils import Peer
+from backend.utils.capabilities import Capabilities
+from backend.utils.mongo import MongoDBManager
+
+from conftest import make_peer
+
+# MongoDBManager methods taking a filter (a pipeline for aggregate) after the collection name
+QUERY_METHODS = [
+    "find_documents",
+    "find_one_and_update",
+    "update_document",
+    "update_documents",
+    "delete_document",
+    "count_documents",
+    "aggregate",
+]
+
+
+@pytest.fixture
+def recorded_queries(mongo):
+    """Records the filter of every query sent to the peers collection."""
+    queries = []
+
+    def record(name, method):
+        async def wrapper(self, collection_name, *args, **kwargs):
+            if collection_name == peers_collection:
+                query = args[0] if args else kwargs.get("query", kwargs.get("pipeline"))
+                if name == "aggregate":
+                    query = query[0].get("$match", {}) if query else {}
+                queries.append((name, query))
+            return await method(self, collection_name, *args, **kwargs)
+
+        return wrapper
+
+    with pytest.MonkeyPatch.context() as patch:
+        for name in QUERY_METHODS:
+            patch.setattr(MongoDBManager, name, record(name, getattr(MongoDBManager, name)))
+        yield queries
+
+
+def winning_stages(plan):
+    yield plan["stage"]
+    for child in plan.get("inputStages", []) + [plan[key] for key in ("inputStage",) if key in plan]:
+        yield from winning_stages(child)
+
+
+def bench_peer_queries_use_indexes(run, mongo, seed_peers, recorded_queries):
+    seed_peers(1000)
+    seed_peers.invalidate()  # Peers are added and removed below
+    run(PexMongo.create_indexes())
+
+    peer = make_peer(history=2)
+    other = make_peer()
+    now = datetime.utcnow()
+
+    async def exercise():
+        await PexMongo.add_peer(peer)
+        await PexMongo.add_peers([other, make_peer()])
+        await PexMongo.get_peer(peer.ip)
+        await PexMongo.get_known_ips([peer.ip, other.ip])
+        await PexMongo.get_peers([peer.ip, other.ip])
+        await PexMongo.get_peers_last_seen(after=now - timedelta(minutes=10), before=now)
+        await PexMongo.get_random_peers(exclude_peers={Peer.Record.from_document(peer.dict())})
+        await PexMongo.get_capable_peers(Capabilities.Requirements(inference=True))
+        await PexMongo.get_capable_peers(Capabilities.Requirements(models=peer.capabilities.models))
+        await PexMongo.update_peer(peer, peer)
+        await PexMongo.update_peer_request_history(
+            peer.ip, Peer.RequestInfo(timestamp=now.isoformat(), request_type="GET", endpoint="/", response_code="200")
+        )
+        await PexMongo.remove_peer(other)
+
+    run(exercise())
+
+    indexes = run(mongo[peers_collection].index_information())
+    indexed_fields = {index["key"][0][0] for index in indexes.values()} - {"_id"}
+    assert {"ip", "last_seen", "black_listed", "activated"} <= indexed_fields
+    assert {"capabilities.inference", "capabilities.models"} <= indexed_fields
+
+    assert recorded_queries
+    for name, query in recorded_queries:
+        assert query, f"{name} reads every peer"
+        assert set(query) & indexed_fields, f"{name} filters on unindexed fields: {query}"
+
+    if not os.getenv("BENCH_MONGO_URL"):
+        return  # The in-memory stand-in has no query planner
+
+    for name, query in recorded_queries:
+        explain = run(
+            mongo.command(
+                {"explain": {"find": peers_collection, "filter": query}, "verbosity": "queryPlanner"}
+            )
+        )
+        stages = set(winning_stages(explain["queryPlanner"]["winningPlan"]))
+        assert "COLLSCAN" not in stages, f"{name} scans the peers collection: {query}"
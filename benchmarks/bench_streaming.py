@@ -0,0 +1,54 @@
+"""
+Token streaming throughput from a generator thread to the client, without a model.
+"""
+
+import asyncio
+
+import pytest
+
+from backend.api.distributed_inference.token_stream import TokenStream
+
+TOKENS = 5_000
+
+
+def fake_generate(callback):
+    """Stands in for a model generating TOKENS tokens as fast as possible."""
+    for token_id in range(TOKENS):
+        if not callback(token_id, f" tok{token_id}"):
+            return
+
+
+@pytest.mark.benchmark(group="streaming")
+@pytest.mark.parametrize("stream_format", list(TokenStream.formats))
+def bench_token_stream(benchmark, run, stream_format):
+    async def stream():
+        token_stream = TokenStream(max_tokens=TOKENS)
+        token_stream.run(fake_generate)
+        size = 0
+        async for chunk in token_stream.encode(stream_format):
+            size += len(chunk)
+        return token_stream, size
+
+    token_stream, size = benchmark.pedantic(lambda: run(stream()), rounds=10, iterations=1, warmup_rounds=1)
+    benchmark.extra_info["tokens"] = TOKENS
+    if benchmark.stats is not None:  # None with --benchmark-disable
+        benchmark.extra_info["tokens_per_second"] = round(TOKENS / benchmark.stats.stats.mean)
+    assert token_stream.token_count == TOKENS
+
+
+@pytest.mark.benchmark(group="streaming")
+def bench_token_stream_slow_client(benchmark, run):
+    """A client reading slower than the model, tokens are coalesced into fewer frames."""
+
+    async def stream():
+        token_stream = TokenStream(max_tokens=TOKENS)
+        token_stream.run(fake_generate)
+        frames = 0
+        async for _ in token_stream.encode("ndjson"):
+            frames += 1
+            await asyncio.sleep(0.001)
+        return token_stream, frames
+
+    token_stream, frames = benchmark.pedantic(lambda: run(stream()), rounds=5, iterations=1)
+    benchmark.extra_info["frames"] = frames
+    assert token_stream.token_count == TOKENS
@@ -0,0 +1,141 @@
+"""
+Shared fixtures of the benchmark suite.
+
+Benchmarks run against an in-memory stand-in of MongoDB (mongomock-motor) by default so that they
+don't need a database server. Set BENCH_MONGO_URL, e.g. mongodb://localhost:27017/, to run them against
+a real server instead, in a throwaway bitorch_benchmarks database. The stand-in doesn't use indexes and
+scans collections in Python, compare database bound results between runs on the same backend only.
+"""
+
+import os
+import asyncio
+import itertools
+
+os.environ.setdefault("ENV", "development")  # Skips the public ip validation of peers
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from backend.utils import Peer
+from backend.utils.mongo import MongoDBManager
+from backend.utils.capabilities import Capabilities
+
+peers_collection = "peers"
+
+
+@pytest.fixture(scope="session")
+def loop():
+    """One event loop for the whole session, motor clients are bound to the loop they are first used in."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def run(loop):
+    """Runs a coroutine to completion on the session's event loop."""
+    return loop.run_until_complete
+
+
+@pytest.fixture(scope="session")
+def mongo(run):
+    """Points every MongoDBManager at the benchmark database and returns that database."""
+    url = os.getenv("BENCH_MONGO_URL")
+    if url:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        client = AsyncIOMotorClient(url)
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+
+        client = AsyncMongoMockClient()
+    db = client["bitorch_benchmarks"]
+
+    def init(self):
+        self.client = None  # Shared client, not closed by each manager
+        self.db = db
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(MongoDBManager, "__init__", init)
+        from backend.api.pex import PexMongo
+
+        run(PexMongo.create_indexes())
+        yield db
+        run(client.drop_database("bitorch_benchmarks"))
+
+
+_ips = itertools.count(1)
+
+
+def make_peer(history: int = 0, capabilities: bool = True) -> Peer.Internal:
+    """A registered peer with a unique ip, its capability manifest and request history entries."""
+    n = next(_ips)
+    return Peer.Internal(
+        ip=f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}",
+        port=8000 + n % 1000,
+        name=f"peer{n}",
+        activated=True,
+        capabilities=Capabilities.Manifest(
+            cpu_count=8,
+            ram_mb=32768,
+            gpus=["NVIDIA GeForce RTX 3090"] if n % 4 == 0 else [],
+            libraries=["torch", "gpt4all"],
+            models=["mistral-7b-openorca.gguf2.Q4_0.gguf"],
+            max_concurrency=2,
+            inference=True,
+        )
+        if capabilities
+        else None,
+        request_history=[
+            Peer.RequestInfo(
+                timestamp="2024-05-01T12:00:00",
+                request_type="POST",
+                endpoint="/register",
+                response_code="200",
+                req_body={"ip": "10.0.0.1", "port": 8000, "name": "peer"},
+                headers={"content-type": "application/json"},
+            )
+            for _ in range(history)
+        ],
+    )
+
+
+@pytest.fixture(scope="session")
+def seed_peers(mongo, run):
+    """
+    Replaces the peers collection with count peers, each with history request history entries.
+    Seeding the same collection twice in a row is skipped.
+    """
+    seeded = {}
+
+    def seed(count: int, history: int = 0) -> None:
+        if seeded.get("peers") == (count, history):
+            return
+        run(mongo[peers_collection].delete_many({}))
+        batch = []
+        for _ in range(count):
+            batch.append(make_peer(history).dict())
+            if len(batch) == 5000:
+                run(mongo[peers_collection].insert_many(batch))
+                batch = []
+        if batch:
+            run(mongo[peers_collection].insert_many(batch))
+        seeded["peers"] = (count, history)
+
+    seed.invalidate = lambda: seeded.clear()
+    return seed
+
+
+@pytest.fixture(scope="session")
+def make_client():
+    """Returns an httpx client sending requests straight to an ASGI app, without a network."""
+
+    def make(app: FastAPI) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app, client=("10.255.0.1", 40000)),
+            base_url="http://bench",
+        )
+
+    return make
@@ -1,15 +1,205 @@
 import os
 import sys
+import json
 import time
+import hashlib
 import signal
 import socket
 import threading
 from urllib.parse import urlparse
+import importlib.util
 import importlib.metadata as importlib_metadata
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "backend")))
 
 
+def run_worker(config, sockets, index, cpus, ready):
+    """Entry point of a worker process started by WorkerSupervisor.
+
+    Pins the worker to its share of the cpus and serves the app on the sockets
+    bound by the supervisor. The ready event is set once the app's lifespan
+    startup (including model warm-up) completed and the worker accepts
+    connections.
+
+    Args:
+        config (uvicorn.Config): Server configuration shared by all workers.
+        sockets (list): Listening sockets bound by the supervisor.
+        index (int): Index of the worker, exposed to the app as WORKER_INDEX.
+        cpus (list): Cpus the worker is pinned to, empty to not pin it.
+        ready (multiprocessing.Event): Set once the worker accepts connections.
+    """
+    import uvicorn
+
+    os.environ["WORKER_INDEX"] = str(index)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+        # Keep torch's and llama.cpp's thread pools within the worker's cpus
+        os.environ.setdefault("OMP_NUM_THREADS", str(len(cpus)))
+
+    class WorkerServer(uvicorn.Server):
+        async def startup(self, sockets=None):
+            await super().startup(sockets=sockets)
+            if not self.should_exit:
+                ready.set()
+
+    config.configure_logging()
+    WorkerServer(config).run(sockets=sockets)
+
+
+class WorkerSupervisor:
+    """Pre-fork supervisor running the production server on all cores.
+
+    The supervisor binds the listening socket once and starts WORKERS uvicorn
+    worker processes accepting connections on it, with uvloop and httptools
+    when they're installed. Workers that die are restarted, and SIGHUP
+    restarts the workers one at a time: a replacement is started and only once
+    it has loaded its models and accepts connections is the old worker asked
+    to finish its in-flight requests and exit, so the server keeps serving
+    during a deploy. SIGTERM and SIGINT stop all workers gracefully.
+
+    Attributes:
+        host (str): Host to bind to.
+        port (int): Port to bind to.
+        workers (int): Number of worker processes, WORKERS ("auto" for one per cpu).
+        cpu_affinity (bool): Pin every worker to its own share of the cpus.
+        start_timeout (float): Seconds a new worker has to become ready.
+        graceful_timeout (float): Seconds a stopping worker has to finish its requests.
+    """
+    def __init__(self, host, port):
+        """Initializes the supervisor from the WORKER* environment variables."""
+        self.host = host
+        self.port = port
+        workers = os.getenv("WORKERS", "1").strip().lower()
+        self.workers = (os.cpu_count() or 1) if workers == "auto" else max(int(workers), 1)
+        self.cpu_affinity = (
+            os.getenv("WORKER_CPU_AFFINITY", "true").lower() not in ("0", "false", "no")
+            and hasattr(os, "sched_setaffinity")
+        )
+        self.start_timeout = float(os.getenv("WORKER_START_TIMEOUT", 600))
+        self.graceful_timeout = float(os.getenv("WORKER_GRACEFUL_TIMEOUT", 30))
+        self.processes = {}  # Worker index -> (process, ready event)
+        self.restart_delays = {}  # Worker index -> seconds to wait before the next restart
+        self.should_exit = threading.Event()
+        self.should_reload = threading.Event()
+
+    def _worker_cpus(self, index):
+        """Returns the contiguous slice of the available cpus of a worker."""
+        if not self.cpu_affinity:
+            return []
+        cpus = sorted(os.sched_getaffinity(0))
+        if self.workers >= len(cpus):
+            return [cpus[index % len(cpus)]]
+        size, extra = divmod(len(cpus), self.workers)
+        start = index * size + min(index, extra)
+        return cpus[start:start + size + (index < extra)]
+
+    def _spawn(self, index):
+        """Starts a worker process, returns the process and its ready event."""
+        ready = self.context.Event()
+        process = self.context.Process(
+            target=run_worker,
+            args=(self.config, self.sockets, index, self._worker_cpus(index), ready),
+            name=f"worker-{index}",
+        )
+        process.start()
+        return process, ready
+
+    def _wait_ready(self, process, ready):
+        """Waits until a worker accepts connections, returns False if it exited or timed out."""
+        deadline = time.monotonic() + self.start_timeout
+        while time.monotonic() < deadline and not self.should_exit.is_set():
+            if ready.wait(0.5):
+                return True
+            if not process.is_alive():
+                return False
+        return False
+
+    def _stop(self, process):
+        """Asks a worker to finish its in-flight requests and exit, kills it after graceful_timeout."""
+        if process.is_alive():
+            process.terminate()
+        process.join(self.graceful_timeout + 5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def _rolling_restart(self):
+        """Replaces the workers one at a time, keeping the old worker if its replacement fails."""
+        print("> Rolling restart of the workers...")
+        for index in sorted(self.processes):
+            process, ready = self._spawn(index)
+            if not self._wait_ready(process, ready):
+                self._stop(process)
+                if not self.should_exit.is_set():
+                    print(f"> Worker {index} failed to start, rolling restart aborted.")
+                return
+            old_process, _ = self.processes[index]
+            self.processes[index] = (process, ready)
+            self._stop(old_process)
+        print("> Rolling restart completed.")
+
+    def _check_workers(self):
+        """Restarts the workers that exited, backing off while they keep failing to start."""
+        for index, (process, ready) in list(self.processes.items()):
+            if process.is_alive():
+                if ready.is_set():
+                    self.restart_delays.pop(index, None)
+                continue
+            delay = self.restart_delays.get(index, 0)
+            print(f"> Worker {index} exited with code {process.exitcode}, restarting in {delay}s.")
+            if self.should_exit.wait(delay):
+                return
+            self.restart_delays[index] = min(max(delay * 2, 1), 30)
+            self.processes[index] = self._spawn(index)
+
+    def _handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.should_reload.set()
+        else:
+            self.should_exit.set()
+
+    def run(self):
+        """Binds the socket, starts the workers and supervises them until SIGTERM or SIGINT."""
+        import multiprocessing
+        import uvicorn
+
+        multiprocessing.allow_connection_pickling()
+        self.context = multiprocessing.get_context("spawn")
+        self.config = uvicorn.Config(
+            "backend.main:app",
+            host=self.host,
+            port=self.port,
+            workers=self.workers,
+            loop="auto",  # uvloop when installed
+            http="auto",  # httptools when installed
+            timeout_graceful_shutdown=self.graceful_timeout,
+        )
+        self.sockets = [self.config.bind_socket()]
+
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(sig, self._handle_signal)
+
+        print(f"> Starting {self.workers} worker(s) on {self.host}:{self.port}.")
+        for index in range(self.workers):
+            self.processes[index] = self._spawn(index)
+
+        while not self.should_exit.wait(0.5):
+            if self.should_reload.is_set():
+                self.should_reload.clear()
+                self._rolling_restart()
+            self._check_workers()
+
+        print("> Stopping the workers...")
+        for process, _ in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process, _ in self.processes.values():
+            self._stop(process)
+        for sock in self.sockets:
+            sock.close()
+        print("Successfully exited.")
+
+
 class ServerManager:
     """Manages the server environment and process for a web application.
 
@@ -24,6 +214,7 @@ class ServerManager:
         exe_dir (str): Directory where the executable resides.
         child_process (subprocess.Popen): Reference to the child server process.
         stop_spinner (threading.Event): Event to stop the progress spinner.
+        environment_cache (str): File caching the fingerprint of the last checked environment.
     """
     def __init__(self):
         """Initializes the server manager with environment configurations."""
@@ -33,6 +224,7 @@ class ServerManager:
         self.exe_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
         self.child_process = None
         self.stop_spinner = threading.Event()
+        self.environment_cache = os.path.join(".cache", "environment.json")
 
     def _find_available_port(self, start_port):
         """Finds an available network port to use.
@@ -90,13 +282,71 @@ class ServerManager:
                         required_packages.add(package_name.strip('"'))
         return required_packages
 
+    @staticmethod
+    def _environment_fingerprint():
+        """Computes a fingerprint of the Pipfile, Pipfile.lock and installed packages.
+
+        Installed packages are identified by the names of the *.dist-info and
+        *.egg-info entries (which include their versions) of the directories on
+        sys.path, the same metadata the environment checks look packages up in.
+        Listing them is much cheaper than resolving every required package.
+
+        Returns:
+            str: The sha256 hex digest of the environment.
+        """
+        digest = hashlib.sha256(sys.version.encode())
+        digest.update(sys.executable.encode())
+        for file_name in ("Pipfile", "Pipfile.lock"):
+            try:
+                with open(file_name, "rb") as f:
+                    digest.update(f.read())
+            except FileNotFoundError:
+                digest.update(b"missing")
+        for path in sys.path:
+            try:
+                with os.scandir(path or ".") as entries:
+                    names = sorted(
+                        entry.name for entry in entries
+                        if entry.name.endswith((".dist-info", ".egg-info"))
+                    )
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+            digest.update(f"{path}\0{','.join(names)}\0".encode())
+        return digest.hexdigest()
+
+    def _read_environment_cache(self):
+        """Returns the fingerprint of the last environment that passed the checks, if any."""
+        try:
+            with open(self.environment_cache, "r") as f:
+                return json.load(f).get("fingerprint")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def _write_environment_cache(self, fingerprint):
+        """Records the fingerprint of an environment that passed the checks."""
+        try:
+            os.makedirs(os.path.dirname(self.environment_cache), exist_ok=True)
+            with open(self.environment_cache, "w") as f:
+                json.dump({"fingerprint": fingerprint, "checked_at": time.time()}, f)
+        except OSError as e:
+            print(f"> Could not cache the environment checks: {e}")
+
     def _development_checks(self):
-        """Performs environment checks for development mode."""
+        """Performs environment checks for development mode.
+
+        The checks are skipped when the Pipfile, Pipfile.lock and installed
+        packages haven't changed since they last passed.
+        """
         print("> Operating in development mode. Initiating environment checks...")
 
         if not os.path.exists("Pipfile"):
             raise EnvironmentError("Pipfile not found. Please ensure it exists.")
 
+        fingerprint = self._environment_fingerprint()
+        if fingerprint == self._read_environment_cache():
+            print("> Environment unchanged since the last checks, skipping them.\n")
+            return
+
         required_packages = self._parse_pipfile_for_packages("Pipfile")
 
         for package in required_packages:
@@ -105,6 +355,7 @@ class ServerManager:
             except importlib_metadata.PackageNotFoundError:
                 raise ImportError(f"Required package {package} not installed.")
 
+        self._write_environment_cache(fingerprint)
         print("> Environment checks passed successfully.\n")
 
     def _start_spinner(self):
@@ -135,6 +386,38 @@ class ServerManager:
         print("Successfully exited.")
         sys.exit(0)
 
+    def _run_production(self, host, port):
+        """Runs the multi-worker server, inside the pipenv environment."""
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            # Not started with the environment's interpreter, restart through pipenv
+            os.execvp("pipenv", ["pipenv", "run", "python", *sys.argv])
+
+        WorkerSupervisor(host, port).run()
+
+    @staticmethod
+    def _in_process():
+        """Decides whether uvicorn runs in this process instead of a `pipenv run` subprocess.
+
+        SERVER_IN_PROCESS=true runs it in-process whenever uvicorn is importable,
+        false always goes through pipenv. The default, auto, runs it in-process
+        when run.py already runs in a virtualenv (e.g. `pipenv run python run.py`),
+        which saves starting pipenv and resolving the virtualenv again.
+
+        Returns:
+            bool: True to run uvicorn in-process.
+        """
+        option = os.getenv("SERVER_IN_PROCESS", "auto").lower()
+        if option in ("0", "false", "no"):
+            return False
+        if option == "auto" and sys.prefix == sys.base_prefix and "PIPENV_ACTIVE" not in os.environ:
+            return False
+        if importlib.util.find_spec("uvicorn") is None:
+            print("> uvicorn isn't installed in this environment, starting it through pipenv.")
+            return False
+        return True
+
     def run(self):
         """Runs the server process and handles graceful shutdown."""
         signal.signal(signal.SIGINT, self._exit)
@@ -149,6 +432,18 @@ class ServerManager:
         parsed_url = urlparse(self.backend_url)
         host, port = parsed_url.hostname, parsed_url.port
 
+        if self.env == "production":
+            self._run_production(host, port)
+            return
+
+        reload = os.getenv("ENV") == "development"
+
+        if self._in_process():
+            import uvicorn
+
+            uvicorn.run("backend.main:app", host=host, port=port, reload=reload)
+            return
+
         command = [
             "pipenv",
             "run",
@@ -160,7 +455,7 @@ class ServerManager:
             str(port),
         ]
 
-        if os.getenv("ENV") == "development":
+        if reload:
             command.append("--reload")
 
         try:
@@ -0,0 +1,124 @@
+"""
+Checks pipeline parallel inference on the cpu: starts a few local nodes, each hosting a different block of
+the "tiny-mlp" model's layers, runs the model along a route through them and compares the output with the
+whole model run locally. A second run stops one node to check that the coordinator fails over to a node
+hosting overlapping layers.
+
+Only the shard routes are served and the nodes know each other from the list below, so no database is
+needed:
+    python scripts/pipeline_parallel_test.py
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import subprocess
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# (port, hosted layers of tiny-mlp)
+nodes = [(8101, "0-4"), (8102, "4-8"), (8103, "2-6"), (8104, "6-8")]
+
+
+def get_hosts():
+    return [
+        (f"http://127.0.0.1:{port}", *(int(layer) for layer in layers.split("-")))
+        for port, layers in nodes
+    ]
+
+
+def serve(port: int):
+    import uvicorn
+    from fastapi import FastAPI
+    from backend.api.distributed_inference import shard_forward_endpoint
+    from backend.api.distributed_inference.pipeline_parallel import PipelineCoordinator
+
+    async def get_known_hosts(model_id: str, ips=None):
+        return get_hosts()  # Stands in for the peers of the database, nodes only forward to known hosts
+
+    PipelineCoordinator.get_hosts = staticmethod(get_known_hosts)
+    app = FastAPI()
+    app.include_router(shard_forward_endpoint.router)
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def start_node(port: int, layers: str) -> subprocess.Popen:
+    env = {**os.environ, "PIPELINE_SHARDS": f"tiny-mlp:{layers}", "HOST_INFERENCE": "true"}
+    return subprocess.Popen([sys.executable, __file__, "--serve", str(port)], env=env)
+
+
+def wait_for(port: int, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/shards").raise_for_status()
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Node on port {port} didn't start")
+
+
+async def check(hosts, expected, inputs):
+    from backend.api.distributed_inference.pipeline_parallel import PipelineCoordinator
+    import torch
+
+    output = await PipelineCoordinator.run("tiny-mlp", inputs, hosts=hosts)
+    assert torch.allclose(output, expected, atol=1e-6), "pipeline output differs from the local model"
+
+
+def main():
+    import torch
+    from backend.api.distributed_inference.pipeline_parallel import build_tiny_mlp_layers
+
+    processes = {port: start_node(port, layers) for port, layers in nodes}
+    try:
+        for port, _ in nodes:
+            wait_for(port)
+
+        inputs = torch.randn(4, 64)
+        with torch.inference_mode():
+            expected = inputs
+            for layer in build_tiny_mlp_layers(0, 8):
+                expected = layer(expected)
+
+        hosts = get_hosts()
+        for _ in range(5):
+            asyncio.run(check(hosts, expected, inputs))
+        print("OK: pipeline output matches the local model")
+
+        # Hops that aren't known hosts of the layers are rejected instead of being sent requests
+        unknown_hops = [
+            {"url": "http://127.0.0.1:27017", "start": 4, "end": 8},  # Not a peer
+            {"url": "http://127.0.0.1:8103", "start": 0, "end": 4},  # Doesn't host layers 0-2
+        ]
+        for hop in unknown_hops:
+            response = httpx.post(
+                "http://127.0.0.1:8101/shards/tiny-mlp/forward",
+                params={"start": 0, "end": 4},
+                headers={"X-Pipeline-Route": json.dumps([hop])},
+            )
+            assert response.status_code == 400, f"route through {hop} wasn't rejected"
+        print("OK: routes through unknown hosts are rejected")
+
+        # Stop the node hosting 4-8, the route has to fail over to the nodes hosting 2-6 and 6-8
+        processes[8102].terminate()
+        processes[8102].wait()
+        for _ in range(5):
+            asyncio.run(check(hosts, expected, inputs))
+        print("OK: failed over after a node went down")
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--serve":
+        serve(int(sys.argv[2]))
+    else:
+        main()